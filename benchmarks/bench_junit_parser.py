@@ -0,0 +1,69 @@
+"""
+Benchmark of the incremental JUnit result parser.
+
+Parses a synthetic PHPSpec JUnit document of 20k examples, fed in the same
+size chunks as read from a phpspec process. The number of examples is
+multiplied by the scale.
+
+Usage: python benchmarks/bench_junit_parser.py [scale]
+"""
+import json
+import sys
+
+from harness import install, measure
+
+plugin, sublime = install()
+
+
+def junit_fixture(examples, examples_per_spec=40):
+    lines = ['<?xml version="1.0" encoding="UTF-8" ?>', '<testsuites time="1" tests="%d">' % examples]
+    for i in range(examples):
+        if i % examples_per_spec == 0:
+            if i:
+                lines.append('</testsuite>')
+            lines.append('<testsuite name="Acme\\Module%d\\Thing" time="0.5" tests="%d">' % (i, examples_per_spec))
+
+        name = 'it does thing number %d' % i
+        classname = 'spec\\Acme\\Module%d\\ThingSpec' % (i - i % examples_per_spec)
+        if i % 20 == 0:
+            lines.append('<testcase name="%s" time="0.012" classname="%s" status="failed">' % (name, classname))
+            lines.append('<failure type="PhpSpec\\Exception\\Example\\FailureException" '
+                         'message="expected [integer:1], but got [integer:2]." />')
+            lines.append('<system-err><![CDATA[%s]]></system-err>' % ('#0 trace line\n' * 20))
+            lines.append('</testcase>')
+        else:
+            lines.append('<testcase name="%s" time="0.001" classname="%s" status="passed" />' % (name, classname))
+
+    lines.append('</testsuite>')
+    lines.append('</testsuites>')
+
+    return '\n'.join(lines) + '\n'
+
+
+def benchmarks(scale=1.0):
+    """Yield the results of the parser benchmark at {scale}."""
+    examples = max(100, int(20000 * scale))
+
+    fixture = junit_fixture(examples)
+    chunk_size = plugin.JunitResultParser.max_buffer
+    chunks = [fixture[i:i + chunk_size] for i in range(0, len(fixture), chunk_size)]
+
+    def parse():
+        result = plugin.RunResult()
+        parser = plugin.JunitResultParser(on_example=result.add)
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+
+        assert len(result.examples) == examples, len(result.examples)
+
+    yield measure('junit_parser', parse, repeat=5, examples=examples, bytes=len(fixture))
+
+
+def main():
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    print(json.dumps(list(benchmarks(scale)), indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""
+Benchmarks of the plugin hot paths on synthetic large projects.
+
+The project has 50k PHP files (half classes, half specs) in a deep tree,
+the specs views are 5k lines long. Sizes are multiplied by the scale.
+
+Usage: python benchmarks/bench_plugin.py [scale]
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from harness import install, measure, write_file
+
+plugin, sublime = install()
+
+MODULES = 50
+
+
+def class_path(i, depth):
+    """Return the path, relative to src/ or spec/, of class {i} nested {depth} levels deep."""
+    parts = ['Module{}'.format(i % MODULES)]
+    for level in range(depth - 1):
+        parts.append('Level{}'.format((i // MODULES + level) % 7))
+
+    return '/'.join(parts) + '/Thing{}'.format(i)
+
+
+def make_project(root, files, depth=8):
+    write_file(os.path.join(root, 'composer.json'), json.dumps({
+        'autoload': {'psr-4': {'Acme\\': 'src/'}}
+    }))
+    write_file(os.path.join(root, 'phpspec.yml'), 'suites:\n    acme_suite:\n        namespace: Acme\n'
+                                                  '        psr4_prefix: Acme\n')
+
+    for i in range(files // 2):
+        path = class_path(i, depth)
+        namespace = 'Acme\\' + '\\'.join(path.split('/')[:-1])
+        name = path.split('/')[-1]
+        write_file(os.path.join(root, 'src', path + '.php'),
+                   '<?php\n\nnamespace {};\n\nclass {}\n{{\n}}\n'.format(namespace, name))
+        write_file(os.path.join(root, 'spec', path + 'Spec.php'),
+                   '<?php\n\nnamespace spec\\{};\n\nuse PhpSpec\\ObjectBehavior;\n\n'
+                   'class {}Spec extends ObjectBehavior\n{{\n}}\n'.format(namespace, name))
+
+
+def spec_source(lines):
+    """Return the source of a spec class of about {lines} lines."""
+    source = [
+        '<?php',
+        '',
+        'namespace spec\\Acme\\Module0;',
+        '',
+        'use Acme\\Module0\\Thing0;',
+        'use PhpSpec\\ObjectBehavior;',
+        '',
+        'class Thing0Spec extends ObjectBehavior',
+        '{',
+    ]
+    example = 0
+    while len(source) < lines - 1:
+        source.append('    function it_does_thing_number_{}()'.format(example))
+        source.append('    {')
+        for i in range(16):
+            source.append('        $this->thing({})->shouldReturn({});'.format(i, example))
+        source.append('    }')
+        source.append('')
+        example += 1
+    source.append('}')
+
+    return '\n'.join(source) + '\n'
+
+
+def tmtheme_source(rules):
+    settings = []
+    for i in range(rules):
+        settings.append(
+            '<dict><key>name</key><string>Rule {0}</string><key>scope</key><string>scope.rule{0}</string>'
+            '<key>settings</key><dict><key>foreground</key><string>#{0:06x}</string></dict></dict>'.format(i))
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<plist version="1.0"><dict><key>name</key>'
+            '<string>Bench</string><key>settings</key><array>\n' + '\n'.join(settings) +
+            '\n</array><key>uuid</key><string>bench</string></dict></plist>\n')
+
+
+def bench_find_php_classes(view):
+    def cold():
+        plugin.discard_view_structure(view)
+        return plugin.find_php_classes(view, with_namespace=True)
+
+    assert cold()[0]['class'] == 'Thing0Spec'
+
+    yield measure('find_php_classes.cold', cold, repeat=5, lines=view.rowcol(view.size())[0])
+    yield measure('find_php_classes.warm', lambda: plugin.find_php_classes(view), repeat=5, number=1000,
+                  lines=view.rowcol(view.size())[0])
+
+
+def bench_find_line_number(view):
+    view.sel().clear()
+    view.sel().add(sublime.Region(view.size() - 100))
+    expected = plugin.find_line_number(view)
+    assert expected, expected
+
+    def cold():
+        plugin.discard_view_structure(view)
+        return plugin.find_line_number(view)
+
+    lines = view.rowcol(view.size())[0]
+    yield measure('find_line_number.cold', cold, repeat=5, lines=lines)
+    yield measure('find_line_number.warm', lambda: plugin.find_line_number(view), repeat=5, number=1000,
+                  lines=lines)
+
+    view.sel().clear()
+    for point in range(0, view.size(), view.size() // 100):
+        view.sel().add(sublime.Region(point))
+    yield measure('find_line_number.warm_100_selections', lambda: plugin.find_line_number(view),
+                  repeat=5, number=100, lines=lines)
+
+
+def bench_refine_switchable_locations(root, count):
+    # The same class name in every module, with the counterpart last.
+    locations = []
+    for i in range(count):
+        path = 'src/Module{}/Handler.php'.format(i)
+        locations.append((os.path.join(root, path), path, (3, 7)))
+    file = os.path.join(root, 'spec', 'Module{}'.format(count - 1), 'HandlerSpec.php')
+
+    refined, exact = plugin.refine_switchable_locations(locations, file)
+    assert exact and refined == [locations[-1]], refined
+
+    yield measure('refine_switchable_locations', lambda: plugin.refine_switchable_locations(locations, file),
+                  repeat=5, number=100, locations=count)
+
+
+def bench_find_phpspec_configuration_file(root, depth):
+    directory = os.path.join(root, *['deep{}'.format(i) for i in range(depth)])
+    file = os.path.join(directory, 'ThingSpec.php')
+    write_file(file)
+    folders = [root]
+
+    assert plugin.find_phpspec_configuration_file(file, folders) == os.path.join(root, 'phpspec.yml')
+
+    yield measure('find_phpspec_configuration_file',
+                  lambda: plugin.find_phpspec_configuration_file(file, folders),
+                  repeat=5, number=100, depth=depth)
+
+    cache = plugin.PHPSpecConfigurationCache()
+    yield measure('configuration_cache.find', lambda: cache.find(file, folders),
+                  repeat=5, number=100, depth=depth)
+
+
+def bench_build_cmd_options():
+    options = {
+        'format': 'progress',
+        'no-code-generation': True,
+        'stop-on-failure': True,
+        'no-rerun': False,
+        'fake': True,
+        'v': True,
+        'c': ['config/a.yml', 'config/b.yml'],
+        'bootstrap': 'vendor/autoload.php'
+    }
+
+    yield measure('build_cmd_options', lambda: plugin.build_cmd_options(options, ['phpspec', 'run']),
+                  repeat=5, number=10000, options=len(options))
+
+
+def bench_get_auto_generated_color_scheme(root, rules):
+    color_scheme = 'Packages/Bench/Bench.tmTheme'
+    sublime.resources[color_scheme] = tmtheme_source(rules)
+
+    window = sublime.Window([root])
+    window.add_view(sublime.View('', settings={'color_scheme': color_scheme,
+                                               'phpspec-run.color_scheme_override': True}))
+    sublime._windows[:] = [window]
+    phpspec = plugin.PHPSpecRun(window)
+
+    def clear():
+        plugin.clear_color_scheme_cache()
+        shutil.rmtree(sublime.packages_path(), ignore_errors=True)
+        shutil.rmtree(sublime.cache_path(), ignore_errors=True)
+
+    for build, override in (('4169', True), ('3126', False)):
+        sublime._version = build
+        clear()
+        assert phpspec.get_auto_generated_color_scheme()
+        name = 'get_auto_generated_color_scheme.' + ('override' if override else 'patched')
+        yield measure(name + '.cold', phpspec.get_auto_generated_color_scheme, repeat=5, setup=clear,
+                      rules=rules)
+        yield measure(name + '.warm', phpspec.get_auto_generated_color_scheme, repeat=5, number=1000,
+                      rules=rules)
+
+    sublime._windows[:] = []
+
+
+def bench_project_index(root, files):
+    yield measure('project_index.build',
+                  lambda: plugin.ProjectIndex(root, os.path.join(root, 'phpspec.yml')).build(),
+                  repeat=3, files=files)
+
+
+def bench_example_index(root, project, lines):
+    spec = os.path.join(root, 'ExampleSpec.php')
+    write_file(spec, spec_source(lines))
+    header = plugin.scan_spec_file(spec)
+    assert header['class'] == 'Thing0Spec' and header['examples'][0] == ['it_does_thing_number_0', 10]
+    yield measure('scan_spec_file', lambda: plugin.scan_spec_file(spec), repeat=5, number=20, lines=lines)
+
+    def cold():
+        index = plugin.ExampleIndex(project, os.path.join(project, 'phpspec.yml'))
+        index.files = {}
+        index.refresh()
+
+        return index
+
+    index = cold()
+    yield measure('example_index.refresh.cold', cold, repeat=3, files=len(index.files))
+    yield measure('example_index.refresh.warm', index.refresh, repeat=3, files=len(index.files))
+
+
+def bench_spec_fingerprints(project, files):
+    """Fingerprints every spec of the project, as a suite run with `phpspec-run.skip_unchanged` does."""
+    index = plugin.ProjectIndex(project, os.path.join(project, 'phpspec.yml'))
+    index.build()
+    specs = sorted(os.path.relpath(file, project) for file in index.specs.values())
+    context = {'working_dir': project, 'configuration_file': index.configuration_file, 'executables': {'php': None}}
+
+    # Files modified in the last seconds are hashed again every time, the
+    # fixtures were just written.
+    modified_at = time.time() - 60
+    for directory, dirs, names in os.walk(project):
+        for name in names:
+            os.utime(os.path.join(directory, name), (modified_at, modified_at))
+
+    def fingerprint():
+        environment = plugin.environment_digest(context, ['--no-interaction'])
+        return [plugin.spec_fingerprint(index, environment, spec) for spec in specs]
+
+    def cold():
+        plugin._file_digests.clear()
+        return fingerprint()
+
+    yield measure('spec_fingerprints.cold', cold, repeat=3, files=files)
+    yield measure('spec_fingerprints.warm', fingerprint, repeat=3, files=files)
+
+
+def bench_backends(root, project):
+    """Runs through each backend, with a local `sh` standing in for the container shell."""
+    mounted = os.path.join(root, 'mounted')
+    os.symlink(project, mounted)
+    mappings = {project: mounted}
+    session = plugin.SessionBackend(['sh'], mappings)
+
+    backends = [
+        ('local', plugin.LocalBackend()),
+        ('wrapper', plugin.WrapperBackend(['sh', '-c', 'cd "$0" && exec "$@"', '${working_dir}'], mappings)),
+        ('session', session),
+    ]
+
+    try:
+        for name, backend in backends:
+            def run():
+                output = []
+                proc = backend.process(['sh', '-c', 'pwd'], project, {}, output.append)
+                proc.start()
+                assert proc.wait() == 0
+
+                return ''.join(output)
+
+            assert run().strip() == project, run()
+            yield measure('backend.' + name, run, repeat=5, number=20)
+    finally:
+        session.close()
+
+
+def benchmarks(scale=1.0):
+    """Yield the results of all the benchmarks at {scale}."""
+    files = max(100, int(50000 * scale))
+    lines = max(100, int(5000 * scale))
+
+    root = tempfile.mkdtemp(prefix='phpspec-run-bench-')
+    sublime.set_paths(cache=os.path.join(root, 'Cache'), packages=os.path.join(root, 'Packages'))
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'res',
+                           'text-ui-result-theme-partial.txt'), encoding='utf8') as f:
+        sublime.resources['Packages/plugin/res/text-ui-result-theme-partial.txt'] = f.read()
+
+    try:
+        project = os.path.join(root, 'project')
+        make_project(project, files)
+
+        view = sublime.View(spec_source(lines), os.path.join(project, 'spec', 'Module0', 'Thing0Spec.php'))
+
+        for results in (
+            bench_find_php_classes(view),
+            bench_find_line_number(view),
+            bench_refine_switchable_locations(project, max(10, int(1000 * scale))),
+            bench_find_phpspec_configuration_file(project, max(5, int(40 * scale))),
+            bench_build_cmd_options(),
+            bench_get_auto_generated_color_scheme(project, max(10, int(2000 * scale))),
+            bench_project_index(project, files),
+            bench_example_index(root, project, lines),
+            bench_spec_fingerprints(project, files),
+            bench_backends(root, project),
+        ):
+            for result in results:
+                yield result
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    print(json.dumps(list(benchmarks(scale)), indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+"""
+A stand-in for the Sublime Text `sublime` module.
+
+Enough of the API for plugin.py to be imported and its hot paths to be run
+outside of Sublime Text: settings, regions, views over a text buffer with a
+small regex based PHP scope scanner for find_by_selector(), windows, and
+package resources. Timeouts run immediately.
+
+State that the real API gets from the editor is held in module globals,
+set up by the caller: resources (name -> contents), the cache and packages
+paths, the version and the list of windows.
+"""
+import bisect
+import os
+import re
+import tempfile
+
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+ENCODED_POSITION = 1
+TRANSIENT = 4
+
+resources = {}
+_paths = {
+    'cache': os.path.join(tempfile.gettempdir(), 'fake-sublime', 'Cache'),
+    'packages': os.path.join(tempfile.gettempdir(), 'fake-sublime', 'Packages')
+}
+_version = '4169'
+_windows = []
+_statuses = []
+_settings = {}
+
+
+def set_paths(cache=None, packages=None):
+    if cache:
+        _paths['cache'] = cache
+    if packages:
+        _paths['packages'] = packages
+
+
+def cache_path():
+    return _paths['cache']
+
+
+def packages_path():
+    return _paths['packages']
+
+
+def version():
+    return _version
+
+
+def platform():
+    return 'linux'
+
+
+def load_resource(name):
+    try:
+        return resources[name]
+    except KeyError:
+        raise IOError('resource not found: ' + name)
+
+
+def load_settings(name):
+    return _settings.setdefault(name, Settings())
+
+
+def status_message(message):
+    _statuses.append(message)
+
+
+def message_dialog(message):
+    _statuses.append(message)
+
+
+def set_timeout(callback, delay=0):
+    callback()
+
+
+def set_timeout_async(callback, delay=0):
+    callback()
+
+
+def windows():
+    return list(_windows)
+
+
+def active_window():
+    return _windows[0] if _windows else None
+
+
+class Settings():
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def has(self, key):
+        return key in self.values
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+
+class Region():
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, point):
+        return self.begin() <= point <= self.end()
+
+    def intersects(self, region):
+        return self.begin() < region.end() and region.begin() < self.end()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+
+    def __repr__(self):
+        return 'Region({}, {})'.format(self.a, self.b)
+
+
+class Selection(list):
+
+    def add(self, region):
+        self.append(region)
+
+    def clear(self):
+        del self[:]
+
+
+_PHP_SCOPE_PATTERNS = [
+    ('entity.name.namespace', re.compile('^[ \\t]*namespace\\s+([a-zA-Z_\\\\][a-zA-Z0-9_\\\\]*)', re.MULTILINE)),
+    ('entity.name.class', re.compile('^[ \\t]*(?:(?:abstract|final)\\s+)*class\\s+([a-zA-Z_][a-zA-Z0-9_]*)',
+                                     re.MULTILINE)),
+    ('entity.name.function', re.compile('\\bfunction\\s+&?\\s*([a-zA-Z_][a-zA-Z0-9_]*)')),
+]
+
+
+def scan_php_scopes(text):
+    """Return a dict of scope name -> list of Regions for PHP {text}."""
+    scopes = {}
+    for scope, pattern in _PHP_SCOPE_PATTERNS:
+        scopes[scope] = [Region(match.start(1), match.end(1)) for match in pattern.finditer(text)]
+
+    functions = []
+    for name in scopes['entity.name.function']:
+        begin = text.rfind('function', 0, name.begin())
+        body = text.find('{', name.end())
+        semicolon = text.find(';', name.end())
+        if body == -1 or (semicolon != -1 and semicolon < body):
+            functions.append(Region(begin, semicolon + 1))
+            continue
+
+        depth = 0
+        end = body
+        for end in range(body, len(text)):
+            if text[end] == '{':
+                depth += 1
+            elif text[end] == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+        functions.append(Region(begin, end + 1))
+
+    scopes['meta.function'] = functions
+
+    return scopes
+
+
+class View():
+    _next_id = 1
+
+    def __init__(self, text='', file_name=None, window=None, settings=None,
+                 syntax='Packages/PHP/PHP.sublime-syntax'):
+        self._id = View._next_id
+        View._next_id += 1
+        self._file_name = file_name
+        self._window = window
+        self._settings = Settings(settings)
+        self._settings.set('syntax', syntax)
+        self._sel = Selection()
+        self._change_count = 0
+        self._statuses = {}
+        self._regions = {}
+        self._dirty = False
+        self.set_text(text)
+
+    def set_text(self, text):
+        self._text = text
+        self._change_count += 1
+        self._line_starts = [0] + [match.end() for match in re.finditer('\n', text)]
+        self._scopes = None
+
+    def id(self):
+        return self._id
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._file_name
+
+    def settings(self):
+        return self._settings
+
+    def change_count(self):
+        return self._change_count
+
+    def is_dirty(self):
+        return self._dirty
+
+    def size(self):
+        return len(self._text)
+
+    def sel(self):
+        return self._sel
+
+    def substr(self, region):
+        if isinstance(region, int):
+            return self._text[region:region + 1]
+
+        return self._text[region.begin():region.end()]
+
+    def rowcol(self, point):
+        row = bisect.bisect_right(self._line_starts, point) - 1
+        return row, point - self._line_starts[row]
+
+    def text_point(self, row, col):
+        row = max(0, min(row, len(self._line_starts) - 1))
+        return self._line_starts[row] + col
+
+    def line(self, point):
+        if isinstance(point, Region):
+            point = point.begin()
+        row, col = self.rowcol(point)
+        end = self._line_starts[row + 1] - 1 if row + 1 < len(self._line_starts) else len(self._text)
+        return Region(self._line_starts[row], end)
+
+    def word(self, point):
+        if isinstance(point, Region):
+            point = point.begin()
+        begin = end = point
+        while begin > 0 and re.match('\\w', self._text[begin - 1]):
+            begin -= 1
+        while end < len(self._text) and re.match('\\w', self._text[end]):
+            end += 1
+        return Region(begin, end)
+
+    def scopes(self):
+        if self._scopes is None:
+            self._scopes = scan_php_scopes(self._text) if 'PHP' in self._settings.get('syntax', '') else {}
+        return self._scopes
+
+    def find_by_selector(self, selector):
+        """
+        Return the regions of a selector of the form 'scope' or
+        '[source.php] scope - excluded'; only the last scope of the positive
+        part is matched, exclusions are ignored.
+        """
+        positive = selector.split(' - ')[0].split()
+        if not positive:
+            return []
+
+        if positive[0].startswith('source.') and 'PHP' not in self._settings.get('syntax', ''):
+            return []
+
+        return list(self.scopes().get(positive[-1], []))
+
+    def score_selector(self, point, selector):
+        scope = selector.split()[-1].rsplit('.php', 1)[0]
+        for region in self.scopes().get(scope, []):
+            if region.contains(point):
+                return 1
+        return 0
+
+    def match_selector(self, point, selector):
+        return self.score_selector(point, selector) > 0
+
+    def set_status(self, key, value):
+        self._statuses[key] = value
+
+    def erase_status(self, key):
+        self._statuses.pop(key, None)
+
+    def add_regions(self, key, regions, *args, **kwargs):
+        self._regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return list(self._regions.get(key, []))
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def assign_syntax(self, syntax):
+        self._settings.set('syntax', syntax)
+
+    def set_syntax_file(self, syntax):
+        self.assign_syntax(syntax)
+
+    def run_command(self, name, args=None):
+        if name == 'append':
+            self.set_text(self._text + args['characters'])
+        elif name == 'save':
+            self._dirty = False
+
+
+class Window():
+    _next_id = 1
+
+    def __init__(self, folders=None, settings=None):
+        self._id = Window._next_id
+        Window._next_id += 1
+        self._folders = list(folders or [])
+        self._settings = Settings(settings)
+        self._views = []
+        self._active_view = None
+        self._panels = {}
+        self.commands = []
+        self.symbols = {}
+
+    def id(self):
+        return self._id
+
+    def folders(self):
+        return list(self._folders)
+
+    def settings(self):
+        return self._settings
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        return self._active_view
+
+    def add_view(self, view):
+        view._window = self
+        self._views.append(view)
+        self._active_view = view
+        return view
+
+    def open_file(self, file_name, flags=0):
+        for view in self._views:
+            if view.file_name() == file_name:
+                self._active_view = view
+                return view
+
+        text = ''
+        if os.path.isfile(file_name):
+            with open(file_name, encoding='utf8') as f:
+                text = f.read()
+
+        return self.add_view(View(text, file_name))
+
+    def focus_view(self, view):
+        self._active_view = view
+
+    def num_groups(self):
+        return 1
+
+    def get_view_index(self, view):
+        return 0, self._views.index(view) if view in self._views else -1
+
+    def set_view_index(self, view, group, index):
+        pass
+
+    def create_output_panel(self, name, unlisted=False):
+        panel = self._panels[name] = View('', syntax='')
+        return panel
+
+    def get_output_panel(self, name):
+        return self._panels.get(name)
+
+    def run_command(self, name, args=None):
+        self.commands.append((name, args))
+
+    def show_quick_panel(self, items, on_select, *args, **kwargs):
+        self.commands.append(('show_quick_panel', items))
+
+    def lookup_symbol_in_index(self, symbol):
+        return list(self.symbols.get(symbol, []))
+
+    def lookup_symbol_in_open_files(self, symbol):
+        return []
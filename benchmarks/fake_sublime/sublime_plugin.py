@@ -0,0 +1,33 @@
+"""A stand-in for the Sublime Text `sublime_plugin` module, see sublime.py."""
+
+
+class Command():
+
+    def __init__(self, *args):
+        pass
+
+
+class WindowCommand(Command):
+
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(Command):
+
+    def __init__(self, view):
+        self.view = view
+
+
+class ApplicationCommand(Command):
+    pass
+
+
+class EventListener():
+    pass
+
+
+class ViewEventListener():
+
+    def __init__(self, view):
+        self.view = view
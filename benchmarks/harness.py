@@ -0,0 +1,62 @@
+"""
+Shared setup and timing for the benchmarks.
+
+install() puts the fake Sublime Text modules in benchmarks/fake_sublime on
+the import path and imports plugin.py. measure() times a callable and
+returns a JSON serializable result.
+"""
+import os
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def install():
+    """Import plugin.py against the fake sublime modules and return (plugin, sublime)."""
+    for path in (ROOT_DIR, os.path.join(BENCHMARKS_DIR, 'fake_sublime')):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    import sublime
+    import plugin
+
+    return plugin, sublime
+
+
+def measure(name, fn, repeat=5, number=1, setup=None, **params):
+    """
+    Time {fn}: {repeat} rounds of {number} calls, each round after {setup}.
+
+    Returns a dict of the benchmark {name}, {params} and the min, median and
+    mean seconds per call.
+    """
+    timings = []
+    for i in range(repeat):
+        if setup:
+            setup()
+
+        started_at = time.perf_counter()
+        for j in range(number):
+            fn()
+        timings.append((time.perf_counter() - started_at) / number)
+
+    return {
+        'name': name,
+        'params': params,
+        'repeat': repeat,
+        'number': number,
+        'min_seconds': round(min(timings), 9),
+        'median_seconds': round(sorted(timings)[len(timings) // 2], 9),
+        'mean_seconds': round(sum(timings) / len(timings), 9)
+    }
+
+
+def write_file(path, contents=''):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path, 'w', encoding='utf8') as f:
+        f.write(contents)
@@ -0,0 +1,90 @@
+"""
+Run the benchmark suite and print the results as JSON.
+
+Usage: python benchmarks/run.py [--scale SCALE] [--filter TEXT] [--output FILE]
+                                [--compare BASELINE] [--fail-above RATIO]
+
+--scale multiplies the fixture sizes, e.g. 0.05 for a quick run. With
+--compare each result gets the min time of the same benchmark in a
+baseline results file, and the ratio to it; --fail-above exits with an
+error if a ratio is above RATIO.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from harness import ROOT_DIR
+
+import bench_junit_parser
+import bench_plugin
+
+SUITES = [bench_plugin, bench_junit_parser]
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    baseline_results = dict((result['name'], result) for result in baseline['results'])
+    for result in results:
+        base = baseline_results.get(result['name'])
+        if base and base['params'] == result['params'] and base['min_seconds']:
+            result['baseline_min_seconds'] = base['min_seconds']
+            result['ratio'] = round(result['min_seconds'] / base['min_seconds'], 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the phpspec-run benchmarks.')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--filter', default='')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--fail-above', type=float)
+    args = parser.parse_args()
+
+    results = []
+    for suite in SUITES:
+        for result in suite.benchmarks(args.scale):
+            if args.filter in result['name']:
+                results.append(result)
+                print('{name}: {min_seconds:.6f}s'.format(**result), file=sys.stderr)
+
+    report = {
+        'meta': {
+            'revision': revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': args.scale,
+            'timestamp': int(time.time())
+        },
+        'results': results
+    }
+
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            compare(results, json.load(f))
+
+    contents = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            f.write(contents + '\n')
+    else:
+        print(contents)
+
+    if args.fail_above:
+        regressions = [result['name'] for result in results if result.get('ratio', 0) > args.fail_above]
+        if regressions:
+            print('regressions: ' + ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
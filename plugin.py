@@ -1,14 +1,37 @@
+import bisect
+import codecs
+import difflib
+import hashlib
+import heapq
+import json
 import re
 import os
+import shlex
 import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.parsers import expat
 
 from sublime import active_window
 from sublime import cache_path
+from sublime import DRAW_NO_FILL
+from sublime import DRAW_NO_OUTLINE
 from sublime import ENCODED_POSITION
 from sublime import load_resource
+from sublime import load_settings
 from sublime import message_dialog
+from sublime import packages_path
 from sublime import platform
+from sublime import set_timeout
+from sublime import set_timeout_async
 from sublime import status_message
+from sublime import version
+from sublime import windows
 import sublime_plugin
 
 
@@ -53,46 +76,68 @@ def set_window_setting(key, value, window):
     window.settings().set(key, value)
 
 
-def find_phpspec_configuration_file(file_name, folders):
+def find_phpspec_ancestor_folders(file_name, folders):
     """
-    Find the first PHPSpec configuration file.
+    Return the folders to search for a PHPSpec configuration file.
 
-    Finds either phpspec.yml or phpspec.yml.dist, in {file_name} directory or
-    the nearest common ancestor directory in {folders}.
+    The folders are {file_name} directory and each of its ancestors up to the
+    nearest common ancestor directory in {folders}, deepest first.
     """
-    debug_message('find configuration for \'%s\'', file_name)
-    debug_message('found %d folders %s', len(folders) if folders else 0, folders)
+    ancestor_folders = []
+    common_prefix = os.path.commonprefix(folders)
+    parent = os.path.dirname(file_name)
+    while parent not in ancestor_folders and parent.startswith(common_prefix):
+        ancestor_folders.append(parent)
+        parent = os.path.dirname(parent)
+
+    ancestor_folders.sort(reverse=True)
+
+    return ancestor_folders
+
 
+def is_valid_configuration_search(file_name, folders):
     if file_name is None:
-        return None
+        return False
 
     if not isinstance(file_name, str):
-        return None
+        return False
 
     if not len(file_name) > 0:
-        return None
+        return False
 
     if folders is None:
-        return None
+        return False
 
     if not isinstance(folders, list):
-        return None
+        return False
 
     if not len(folders) > 0:
-        return None
+        return False
 
-    ancestor_folders = []
-    common_prefix = os.path.commonprefix(folders)
-    parent = os.path.dirname(file_name)
-    while parent not in ancestor_folders and parent.startswith(common_prefix):
-        ancestor_folders.append(parent)
-        parent = os.path.dirname(parent)
+    return True
 
-    ancestor_folders.sort(reverse=True)
+
+_CONFIGURATION_FILE_NAMES = ['phpspec.yml', 'phpspec.yml.dist']
+
+
+def find_phpspec_configuration_file(file_name, folders):
+    """
+    Find the first PHPSpec configuration file.
+
+    Finds either phpspec.yml or phpspec.yml.dist, in {file_name} directory or
+    the nearest common ancestor directory in {folders}.
+    """
+    debug_message('find configuration for \'%s\'', file_name)
+    debug_message('found %d folders %s', len(folders) if folders else 0, folders)
+
+    if not is_valid_configuration_search(file_name, folders):
+        return None
+
+    ancestor_folders = find_phpspec_ancestor_folders(file_name, folders)
 
     debug_message('found %d common ancestors %s', len(ancestor_folders), ancestor_folders)
 
-    candidate_configuration_file_names = ['phpspec.yml', 'phpspec.yml.dist']
+    candidate_configuration_file_names = _CONFIGURATION_FILE_NAMES
     debug_message('candidate configuration files %s', candidate_configuration_file_names)
     for folder in ancestor_folders:
         debug_message('looking at \'%s\'', folder)
@@ -114,6 +159,94 @@ def find_phpspec_working_directory(file_name, folders):
         return os.path.dirname(configuration_file)
 
 
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class PHPSpecConfigurationCache():
+    """
+    Cache of PHPSpec configuration file resolutions.
+
+    A resolution records the mtime of every directory that was searched and of
+    the configuration file found. Creating or removing a configuration file
+    changes the mtime of its directory, so a cached resolution is reused until
+    one of those mtimes changes.
+    """
+
+    def __init__(self):
+        self.resolutions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, file_name, folders):
+        """Return a (configuration_file, working_dir) tuple."""
+        if not is_valid_configuration_search(file_name, folders):
+            return None, None
+
+        key = (os.path.dirname(file_name), tuple(folders))
+        resolution = self.resolutions.get(key)
+        if resolution and self.is_fresh(resolution):
+            self.hits += 1
+            debug_message('configuration cache hit \'%s\' (hits=%d, misses=%d)',
+                          resolution['configuration_file'], self.hits, self.misses)
+            return resolution['configuration_file'], resolution['working_dir']
+
+        self.misses += 1
+        resolution = self.resolve(file_name, folders)
+        self.resolutions[key] = resolution
+        debug_message('configuration cache miss \'%s\' (hits=%d, misses=%d)',
+                      resolution['configuration_file'], self.hits, self.misses)
+
+        return resolution['configuration_file'], resolution['working_dir']
+
+    def resolve(self, file_name, folders):
+        stamps = []
+        configuration_file = None
+        for folder in find_phpspec_ancestor_folders(file_name, folders):
+            stamps.append((folder, get_mtime(folder)))
+            for candidate in _CONFIGURATION_FILE_NAMES:
+                candidate_file = os.path.join(folder, candidate)
+                if os.path.isfile(candidate_file):
+                    configuration_file = candidate_file
+                    break
+
+            if configuration_file:
+                stamps.append((configuration_file, get_mtime(configuration_file)))
+                break
+
+        return {
+            'configuration_file': configuration_file,
+            'working_dir': os.path.dirname(configuration_file) if configuration_file else None,
+            'stamps': stamps
+        }
+
+    def is_fresh(self, resolution):
+        for path, mtime in resolution['stamps']:
+            if get_mtime(path) != mtime:
+                debug_message('configuration cache stale \'%s\'', path)
+                return False
+
+        return True
+
+    def clear(self):
+        self.resolutions = {}
+
+
+_configuration_caches = {}
+
+
+def get_configuration_cache(window):
+    """Return the configuration discovery cache for {window}."""
+    cache = _configuration_caches.get(window.id())
+    if cache is None:
+        cache = _configuration_caches[window.id()] = PHPSpecConfigurationCache()
+
+    return cache
+
+
 def is_valid_php_identifier(string):
     return re.match('^[a-zA-Z_][a-zA-Z0-9_]*$', string)
 
@@ -126,74 +259,117 @@ def has_test_spec(view):
     return False
 
 
-def find_php_classes(view, with_namespace=False):
-    """Return list of class names defined in the view."""
-    classes = []
-
-    namespace = None
-    for namespace_region in view.find_by_selector('source.php entity.name.namespace'):
-        namespace = view.substr(namespace_region)
-        break
-
-    for class_as_region in view.find_by_selector('source.php entity.name.class - meta.use'):
-        class_as_string = view.substr(class_as_region)
-        if is_valid_php_identifier(class_as_string):
-            if with_namespace:
-                classes.append({
-                    'namespace': namespace,
-                    'class': class_as_string
-                })
-            else:
-                classes.append(class_as_string)
+class ViewStructure():
+    """
+    The namespace, classes and methods defined in a view.
 
-    # BC: < 3114
-    if not classes:  # pragma: no cover
-        for class_as_region in view.find_by_selector('source.php entity.name.type.class - meta.use'):
+    Built from a single pass of selector scans; valid for as long as the view
+    change count and syntax are unchanged.
+    """
+
+    def __init__(self, view):
+        self.key = view_structure_key(view)
+
+        self.namespace = None
+        for namespace_region in view.find_by_selector('source.php entity.name.namespace'):
+            self.namespace = view.substr(namespace_region)
+            break
+
+        self.classes = []
+        for class_as_region in view.find_by_selector('source.php entity.name.class - meta.use'):
             class_as_string = view.substr(class_as_region)
             if is_valid_php_identifier(class_as_string):
-                classes.append(class_as_string)
+                self.classes.append(class_as_string)
+
+        # BC: < 3114
+        if not self.classes:  # pragma: no cover
+            for class_as_region in view.find_by_selector('source.php entity.name.type.class - meta.use'):
+                class_as_string = view.substr(class_as_region)
+                if is_valid_php_identifier(class_as_string):
+                    self.classes.append(class_as_string)
+
+        # Only include areas that contain function declarations. Both are
+        # in document order, so they are paired in one pass.
+        self.methods = []
+        function_regions = view.find_by_selector('entity.name.function')
+        i = 0
+        for function_area in view.find_by_selector('meta.function'):
+            while i < len(function_regions) and function_regions[i].end() <= function_area.begin():
+                i += 1
+            if i < len(function_regions) and function_regions[i].intersects(function_area):
+                function_region = function_regions[i]
+                self.methods.append({
+                    'name': view.substr(function_region),
+                    'line': find_line_number_from_row(view, function_region),
+                    'begin': function_area.begin(),
+                    'end': function_area.end()
+                })
+
+        self.methods.sort(key=lambda method: method['begin'])
+        self.method_begins = [method['begin'] for method in self.methods]
+
+    def find_method_at(self, point):
+        """Return the method enclosing {point}, or None. Methods do not nest."""
+        i = bisect.bisect_right(self.method_begins, point) - 1
+        if i >= 0 and point <= self.methods[i]['end']:
+            return self.methods[i]
+
+        return None
+
+
+def view_structure_key(view):
+    return (view.change_count(), view.settings().get('syntax'))
+
+
+_view_structures = {}
+
+
+def get_view_structure(view):
+    """Return the ViewStructure for the view, reusing it while unchanged."""
+    structure = _view_structures.get(view.id())
+    if structure is None or structure.key != view_structure_key(view):
+        structure = _view_structures[view.id()] = ViewStructure(view)
+
+    return structure
+
+
+def discard_view_structure(view):
+    _view_structures.pop(view.id(), None)
+
+
+def find_php_classes(view, with_namespace=False):
+    """Return list of class names defined in the view."""
+    structure = get_view_structure(view)
+
+    if with_namespace:
+        return [{'namespace': structure.namespace, 'class': c} for c in structure.classes]
 
-    return classes
+    return list(structure.classes)
 
 def find_line_number_from_row(view, region):
     (row, col) = view.rowcol(region.begin())
     return row + 1
 
-def find_line_number(view):
+def find_selected_examples(view):
     """
-    Return a list of selected test method names.
-
-    Return an empty list if no selections found.
+    Return a list of the selected test methods.
 
-    Selection can be anywhere inside one or more test methods.
+    Each method is a dict with a 'name' and a 'line' number. Selections can
+    be anywhere inside one or more test methods; each method is only
+    returned once, in selection order.
     """
-    method_names = []
-    line_number = ''
-
-    function_regions = view.find_by_selector('entity.name.function')
-    function_areas = []
-    # Only include areas that contain function declarations.
-    for function_area in view.find_by_selector('meta.function'):
-        for function_region in function_regions:
-            if function_region.intersects(function_area):
-                function_areas.append(function_area)
+    structure = get_view_structure(view)
 
+    examples = []
+    seen = set()
     for region in view.sel():
-        for i, area in enumerate(function_areas):
-            if not area.a <= region.a <= area.b:
-                continue
-
-            if i not in function_regions and not area.intersects(function_regions[i]):
-                continue
-
-            word = view.substr(function_regions[i])
-            if is_valid_php_identifier(word):
-                method_names.append(word)
-                line_number = find_line_number_from_row(view, function_regions[i])
-            break
+        method = structure.find_method_at(region.a)
+        if method and method['line'] not in seen and is_valid_php_identifier(method['name']):
+            seen.add(method['line'])
+            examples.append({'name': method['name'], 'line': method['line']})
 
     # BC: < 3114
-    if not method_names:  # pragma: no cover
+    if not examples:  # pragma: no cover
         for region in view.sel():
             word_region = view.word(region)
             word = view.substr(word_region)
@@ -202,15 +378,24 @@ def find_line_number(view):
 
             scope_score = view.score_selector(word_region.begin(), 'entity.name.function.php')
             if scope_score > 0:
-                method_names.append(word)
-                line_number = find_line_number_from_row(view, word_region)
+                examples.append({'name': word, 'line': find_line_number_from_row(view, word_region)})
             else:
                 return []
 
-    ignore_methods = ['setup', 'teardown']
+    return examples
+
+
+def find_line_number(view):
+    """
+    Return the line number of the last selected test method.
+
+    Return an empty string if no selections found.
+    """
+    examples = find_selected_examples(view)
+    if examples:
+        return examples[-1]['line']
 
-    return line_number
-    # return [m for m in method_names if m.lower() not in ignore_methods]
+    return ''
 
 
 class ShowInPanel:
@@ -272,6 +457,396 @@ class Switchable:
         return file + encoded_postion
 
 
+def parse_yaml_scalar(value):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"':
+        return value[1:-1]
+
+    if value in ('~', 'null', ''):
+        return None
+
+    return value
+
+
+def strip_yaml_comment(line):
+    if line.lstrip().startswith('#'):
+        return ''
+
+    return re.sub('\\s+#.*$', '', line).rstrip()
+
+
+def parse_phpspec_suites(contents):
+    """
+    Return a dict of the suites defined in a PHPSpec configuration file.
+
+    Only the subset of YAML used to define suites is supported: block
+    mappings of scalars, and flow mappings e.g. `{ namespace: Acme }`.
+    """
+    suites = {}
+    in_suites = False
+    suite = None
+    suite_indent = None
+
+    for line in contents.splitlines():
+        line = strip_yaml_comment(line)
+        if not line.strip():
+            continue
+
+        indent = len(line) - len(line.lstrip())
+        match = re.match('^\\s*([^:]+?)\\s*:(?:\\s+(.*))?$', line)
+
+        if indent == 0:
+            in_suites = bool(match) and match.group(1) == 'suites'
+            suite = None
+            suite_indent = None
+            continue
+
+        if not in_suites or not match:
+            continue
+
+        key = parse_yaml_scalar(match.group(1))
+        value = match.group(2)
+
+        if suite_indent is None or indent <= suite_indent:
+            suite_indent = indent
+            suite = suites[key] = {}
+            if value and value.strip().startswith('{'):
+                for pair in value.strip()[1:-1].split(','):
+                    if ':' in pair:
+                        k, v = pair.split(':', 1)
+                        suite[parse_yaml_scalar(k)] = parse_yaml_scalar(v)
+        elif suite is not None:
+            suite[key] = parse_yaml_scalar(value or '')
+
+    return suites
+
+
+def read_composer_psr4(working_dir):
+    """Return a list of (prefix, directory) tuples from composer.json."""
+    try:
+        with open(os.path.join(working_dir, 'composer.json'), 'r', encoding='utf8') as f:
+            composer = json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+    psr4 = []
+    for section in ('autoload', 'autoload-dev'):
+        autoload = composer.get(section)
+        if not isinstance(autoload, dict):
+            continue
+
+        for prefix, directories in sorted((autoload.get('psr-4') or {}).items()):
+            if isinstance(directories, str):
+                directories = [directories]
+            for directory in directories:
+                psr4.append((prefix, directory))
+
+    return psr4
+
+
+def build_phpspec_suite(working_dir, config):
+    namespace = (config.get('namespace') or '').strip('\\')
+    psr4_prefix = (config.get('psr4_prefix') or '').strip('\\')
+    spec_prefix = (config.get('spec_prefix') or 'spec').strip('\\')
+
+    return {
+        'namespace': namespace,
+        'psr4_prefix': psr4_prefix,
+        'spec_prefix': spec_prefix,
+        'src_root': os.path.normpath(os.path.join(working_dir, config.get('src_path') or 'src')),
+        'spec_root': os.path.normpath(os.path.join(
+            working_dir, config.get('spec_path') or '.', *spec_prefix.split('\\')))
+    }
+
+
+def load_phpspec_suites(working_dir, configuration_file=None):
+    """
+    Return the suites of the project in {working_dir}.
+
+    Suites are read from the PHPSpec configuration file, or derived from the
+    Composer PSR-4 autoload sections if the configuration defines none.
+    """
+    configs = []
+    if configuration_file:
+        contents = read_file(configuration_file)
+        if contents:
+            configs = [config for name, config in sorted(parse_phpspec_suites(contents).items())]
+
+    if not configs:
+        for prefix, directory in read_composer_psr4(working_dir):
+            prefix = prefix.strip('\\')
+            if prefix == 'spec' or prefix.startswith('spec\\'):
+                continue
+
+            configs.append({'namespace': prefix, 'psr4_prefix': prefix, 'src_path': directory})
+
+    if not configs:
+        configs = [{}]
+
+    return [build_phpspec_suite(working_dir, config) for config in configs]
+
+
+def walk_php_files(roots):
+    """Yield every PHP file under {roots}, skipping vendor and hidden directories."""
+    seen = set()
+    for root in roots:
+        for directory, directories, files in os.walk(root):
+            directories[:] = [d for d in directories if d not in ('vendor', 'node_modules') and d[0] != '.']
+            for file in files:
+                if file.endswith('.php'):
+                    file = os.path.join(directory, file)
+                    if file not in seen:
+                        seen.add(file)
+                        yield file
+
+
+class ProjectIndex():
+    """
+    Index of the classes and specs in a project.
+
+    Maps fully qualified class names to their class file and their spec file,
+    using the PSR-4 layout of the project suites. The index is built on a
+    background thread while it is looked up and updated on the main thread,
+    the maps are guarded by {lock}.
+
+    Files renamed or removed outside of a save, e.g. from the side bar, are
+    found on lookup: an indexed file that no longer exists is dropped and
+    the index is rebuilt in the background.
+    """
+
+    def __init__(self, working_dir, configuration_file=None):
+        self.working_dir = working_dir
+        self.configuration_file = configuration_file
+        self.suites = load_phpspec_suites(working_dir, configuration_file)
+        self.classes = {}
+        self.specs = {}
+        self.lock = threading.RLock()
+        self.is_built = False
+        self.rebuilding = False
+        self.stamps = [(file, get_mtime(file)) for file in self.watched_files()]
+
+    def watched_files(self):
+        files = [os.path.join(self.working_dir, 'composer.json')]
+        if self.configuration_file:
+            files.append(self.configuration_file)
+
+        return files
+
+    def is_fresh(self):
+        for file, mtime in self.stamps:
+            if get_mtime(file) != mtime:
+                return False
+
+        return True
+
+    def roots(self):
+        roots = set()
+        for suite in self.suites:
+            roots.add(suite['src_root'])
+            roots.add(suite['spec_root'])
+
+        return sorted(roots)
+
+    def build(self):
+        classes = {}
+        specs = {}
+        for file in walk_php_files(self.roots()):
+            fqcn, is_spec = self.class_for_file(file)
+            if fqcn:
+                (specs if is_spec else classes)[fqcn] = file
+
+        with self.lock:
+            self.classes = classes
+            self.specs = specs
+            self.is_built = True
+        debug_message('indexed %d classes and %d specs in \'%s\'', len(classes), len(specs), self.working_dir)
+
+    def class_for_file(self, file):
+        """Return a (fully qualified class name, is_spec) tuple for {file}."""
+        for suite in self.suites:
+            for root, is_spec in ((suite['spec_root'], True), (suite['src_root'], False)):
+                if not file.startswith(root + os.sep):
+                    continue
+
+                relative = os.path.relpath(file, root)[:-4]
+                if is_spec:
+                    if not relative.endswith('Spec'):
+                        continue
+                    relative = relative[:-4]
+
+                fqcn = relative.replace(os.sep, '\\')
+                if suite['psr4_prefix']:
+                    fqcn = suite['psr4_prefix'] + '\\' + fqcn
+
+                if suite['namespace'] and not (fqcn + '\\').startswith(suite['namespace'] + '\\'):
+                    continue
+
+                return fqcn, is_spec
+
+        return None, False
+
+    def file_for_class(self, fqcn, is_spec):
+        """Return the expected class or spec file for {fqcn}."""
+        for suite in self.suites:
+            if suite['namespace'] and not (fqcn + '\\').startswith(suite['namespace'] + '\\'):
+                continue
+
+            relative = fqcn
+            if suite['psr4_prefix']:
+                if not relative.startswith(suite['psr4_prefix'] + '\\'):
+                    continue
+                relative = relative[len(suite['psr4_prefix']) + 1:]
+
+            relative = relative.replace('\\', os.sep)
+            if is_spec:
+                return os.path.join(suite['spec_root'], relative + 'Spec.php')
+            else:
+                return os.path.join(suite['src_root'], relative + '.php')
+
+        return None
+
+    def file_for_spec_class(self, spec_fqcn):
+        """Return the spec file of the spec class {spec_fqcn} e.g. 'spec\\Acme\\FooSpec'."""
+        if not spec_fqcn.endswith('Spec'):
+            return None
+
+        for suite in self.suites:
+            prefix = suite['spec_prefix'] + '\\'
+            if spec_fqcn.startswith(prefix):
+                fqcn = spec_fqcn[len(prefix):-4]
+                spec_file = self.indexed_file(fqcn, True) or self.file_for_class(fqcn, True)
+                if spec_file and os.path.isfile(spec_file):
+                    return spec_file
+
+        return None
+
+    def spec_for_class(self, fqcn):
+        with self.lock:
+            return self.specs.get(fqcn)
+
+    def class_for_spec(self, fqcn):
+        with self.lock:
+            return self.classes.get(fqcn)
+
+    def indexed_file(self, fqcn, is_spec):
+        """
+        Return the indexed spec or class file of {fqcn}, or None if it is not
+        indexed or no longer exists, in which case the index is rebuilt.
+        """
+        file = self.spec_for_class(fqcn) if is_spec else self.class_for_spec(fqcn)
+        if file and not os.path.isfile(file):
+            debug_message('indexed file \'%s\' is gone', file)
+            self.remove_file(file)
+            self.rebuild_async()
+            return None
+
+        return file
+
+    def rebuild_async(self):
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+
+        def rebuild():
+            try:
+                self.build()
+            finally:
+                with self.lock:
+                    self.rebuilding = False
+
+        set_timeout_async(rebuild)
+
+    def spec_files(self):
+        with self.lock:
+            return list(self.specs.values())
+
+    def find_counterpart(self, file):
+        """Return the spec file for a class file, or the class file for a spec file."""
+        fqcn, is_spec = self.class_for_file(file)
+        if not fqcn:
+            return None
+
+        counterpart = None
+        if self.is_built:
+            counterpart = self.indexed_file(fqcn, not is_spec)
+
+        if not counterpart:
+            counterpart = self.file_for_class(fqcn, not is_spec)
+            if counterpart and not os.path.isfile(counterpart):
+                counterpart = None
+
+        debug_message('index counterpart for \'%s\' is \'%s\'', fqcn, counterpart)
+
+        return counterpart
+
+    def add_file(self, file):
+        fqcn, is_spec = self.class_for_file(file)
+        if fqcn:
+            with self.lock:
+                (self.specs if is_spec else self.classes)[fqcn] = file
+
+    def remove_file(self, file):
+        fqcn, is_spec = self.class_for_file(file)
+        if fqcn:
+            with self.lock:
+                index = self.specs if is_spec else self.classes
+                if index.get(fqcn) == file:
+                    del index[fqcn]
+
+    def rename_file(self, old_file, new_file):
+        with self.lock:
+            self.remove_file(old_file)
+            self.add_file(new_file)
+
+
+_project_indexes = {}
+_project_indexes_lock = threading.Lock()
+
+
+def get_project_index(working_dir, configuration_file=None, build=True):
+    """
+    Return the project index for {working_dir}.
+
+    A new index is created if the Composer or PHPSpec configuration changed,
+    and, if {build} is true, built asynchronously. Until it is built, lookups
+    resolve the expected file from the suites.
+    """
+    with _project_indexes_lock:
+        index = _project_indexes.get(working_dir)
+        if index is None or index.configuration_file != configuration_file or not index.is_fresh():
+            index = _project_indexes[working_dir] = ProjectIndex(working_dir, configuration_file)
+            if build:
+                set_timeout_async(index.build)
+
+    return index
+
+
+def find_project_index(window, file):
+    """Return the existing project index for {file}, if any."""
+    configuration_file, working_dir = get_configuration_cache(window).find(file, window.folders())
+    if working_dir:
+        index = _project_indexes.get(working_dir)
+        if index and index.configuration_file == configuration_file:
+            return index
+
+
+def find_indexed_switchable(view):
+    """Return a Switchable for the view from the project index, if any."""
+    file = view.file_name()
+    window = view.window()
+    if not file or not window:
+        return None
+
+    configuration_file, working_dir = get_configuration_cache(window).find(file, window.folders())
+    if not working_dir:
+        return None
+
+    counterpart = get_project_index(working_dir, configuration_file).find_counterpart(file)
+    if counterpart:
+        return Switchable((counterpart, os.path.relpath(counterpart, working_dir), (1, 1)))
+
+
 def refine_switchable_locations(locations, file):
     debug_message('refine location')
     if not file:
@@ -312,27 +887,8 @@ def refine_switchable_locations(locations, file):
     return locations, False
 
 
-def find_switchable(view, on_select=None):
-    # Args:
-    #   view (View)
-    #   on_select (callable)
-    #
-    # Returns:
-    #   void
-    window = view.window()
-
-    if on_select is None:
-        raise ValueError('a callable is required')
-
-    file = view.file_name()
-    debug_message('file=%s', file)
-
-    classes = find_php_classes(view, with_namespace=True)
-    if len(classes) == 0:
-        return message_dialog('PHPSpec\n\nCould not find a test spec or class under test.')
-
-    debug_message('file contains %s class %s', len(classes), classes)
-
+def lookup_switchable_locations(window, classes):
+    """Return the unique symbol index locations of the counterparts of {classes}."""
     locations = []
     for _class in classes:
         class_name = _class['class']
@@ -357,7 +913,60 @@ def find_switchable(view, on_select=None):
 
         return locs
 
-    locations = unique_locations(locations)
+    return unique_locations(locations)
+
+
+def find_exact_switchable(view):
+    """
+    Return the Switchable of the view if it can be found without asking.
+
+    Returns None if there is no counterpart or more than one candidate.
+    """
+    switchable = find_indexed_switchable(view)
+    if switchable:
+        return switchable
+
+    classes = find_php_classes(view, with_namespace=True)
+    if not classes:
+        return None
+
+    locations = lookup_switchable_locations(view.window(), classes)
+    if not locations:
+        return None
+
+    locations, is_exact = refine_switchable_locations(locations=locations, file=view.file_name())
+    if is_exact and len(locations) == 1:
+        return Switchable(locations[0])
+
+    return None
+
+
+def find_switchable(view, on_select=None):
+    # Args:
+    #   view (View)
+    #   on_select (callable)
+    #
+    # Returns:
+    #   void
+    window = view.window()
+
+    if on_select is None:
+        raise ValueError('a callable is required')
+
+    file = view.file_name()
+    debug_message('file=%s', file)
+
+    switchable = find_indexed_switchable(view)
+    if switchable:
+        return on_select(switchable)
+
+    classes = find_php_classes(view, with_namespace=True)
+    if len(classes) == 0:
+        return message_dialog('PHPSpec\n\nCould not find a test spec or class under test.')
+
+    debug_message('file contains %s class %s', len(classes), classes)
+
+    locations = lookup_switchable_locations(window, classes)
 
     if len(locations) == 0:
         if has_test_spec(view):
@@ -523,123 +1132,4299 @@ def _get_php_executable(working_dir, php_versions_path, php_executable=None):
         return php_executable
 
 
-class PHPSpecRun():
+class ExecutableResolver():
+    """
+    Cache of phpspec, php and winry executable resolutions.
 
-    def __init__(self, window):
-        self.window = window
-        self.view = self.window.active_view()
-        if not self.view:
-            raise ValueError('view not found')
+    Resolutions are keyed by working directory, the executable settings and
+    the system PATH. A resolution is reused until the .php-version file, the
+    Composer installed phpspec, the winry script, or the resolved php and
+    phpspec executables are created, removed or modified.
+    """
 
-        debug_message('view %d %s', self.view.id(), self.view.file_name())
+    def __init__(self):
+        self.resolutions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, working_dir, composer=True, winry=False, php_versions_path=None, php_executable=None):
+        """
+        Return a dict of the resolved 'winry', 'php' and 'phpspec' executables.
+
+        Raises ValueError if the executables cannot be resolved. Failed
+        resolutions are cached the same as successful ones.
+        """
+        key = (working_dir, bool(composer), bool(winry), php_versions_path, php_executable, os.environ.get('PATH'))
+        resolution = self.resolutions.get(key)
+        if resolution and self.is_fresh(resolution):
+            self.hits += 1
+            debug_message('executable cache hit (hits=%d, misses=%d)', self.hits, self.misses)
+        else:
+            self.misses += 1
+            debug_message('executable cache miss (hits=%d, misses=%d)', self.hits, self.misses)
+            resolution = self.resolutions[key] = self._resolve(
+                working_dir, composer, winry, php_versions_path, php_executable)
+
+        if resolution['error']:
+            raise ValueError(resolution['error'])
+
+        return resolution['executables']
+
+    def _resolve(self, working_dir, composer, winry, php_versions_path, php_executable):
+        watched_files = [
+            os.path.join(working_dir, '.php-version'),
+            os.path.join(working_dir, 'vendor', 'bin', 'phpspec'),
+            os.path.join(working_dir, 'vendor', 'bin', 'phpspec-run.bat'),
+            os.path.join(working_dir, 'winry')
+        ]
+        executables = {'winry': None, 'php': None, 'phpspec': None}
+        error = None
+        try:
+            executables['winry'] = _get_winry_executable(working_dir, winry)
+            if not executables['winry']:
+                executables['php'] = _get_php_executable(working_dir, php_versions_path, php_executable)
+                executables['phpspec'] = _get_phpspec_executable(working_dir, composer)
+        except ValueError as e:
+            error = str(e)
 
-    def run(self, working_dir=None, file=None, options=None, line_number=None, directory=None):
-        debug_message('phpspec run with working_dir=%s, file=%s, line_number=%s, directory=%s, options=%s', working_dir, file, line_number, directory, options)
+        # An upgrade of the executables found on the PATH replaces them.
+        for name in ('php', 'phpspec'):
+            if executables[name] and executables[name] not in watched_files:
+                watched_files.append(executables[name])
 
-        # Kill any currently running tests
-        self.window.run_command('exec', {'kill': True})
+        stamps = [(file, get_mtime(file)) for file in watched_files]
 
-        env = {}
-        cmd = []
-        original_file = ''
+        return {
+            'working_dir': working_dir,
+            'executables': executables,
+            'error': error,
+            'stamps': stamps
+        }
 
-        try:
-            if not working_dir:
-                working_dir = find_phpspec_working_directory(self.view.file_name(), self.window.folders())
-                if not working_dir:
-                    raise ValueError('working directory not found')
+    def is_fresh(self, resolution):
+        for file, mtime in resolution['stamps']:
+            if get_mtime(file) != mtime:
+                debug_message('executable cache stale \'%s\'', file)
+                return False
 
-            if not os.path.isdir(working_dir):
-                raise ValueError('working directory does not exist or is not a valid directory')
+        return True
 
-            debug_message('working dir \'%s\'', working_dir)
+    def clear(self):
+        self.resolutions = {}
 
 
-            winry_executable = self.get_winry_executable(working_dir)
+_executable_resolver = ExecutableResolver()
 
-            if winry_executable:
-                cmd.append(winry_executable)
-                cmd.append('phpspec')
-            else:
-                php_executable = self.get_php_executable(working_dir)
-                if php_executable:
-                    env['PATH'] = os.path.dirname(php_executable) + os.pathsep + os.environ['PATH']
-                    debug_message('php executable = %s', php_executable)
 
-                phpspec_executable = self.get_phpspec_executable(working_dir)
-                cmd.append(phpspec_executable)
-                debug_message('executable \'%s\'', phpspec_executable)
+_color_scheme_cache = {}
 
-            options = self.filter_options(options)
-            debug_message('options %s', options)
 
-            cmd.append('run')
-            cmd = build_cmd_options(options, cmd)
+def clear_color_scheme_cache():
+    _color_scheme_cache.clear()
 
-            if file:
-                if os.path.isfile(file):
-                    file = os.path.relpath(file, working_dir)
-                    original_file = file
-                    if line_number:
-                        file+= ':' + str(line_number)
+
+def read_file(file):
+    try:
+        with open(file, 'r', encoding='utf8') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def color_scheme_rules_from_partial(partial):
+    """Convert the tmTheme partial settings into sublime-color-scheme rules."""
+    rules = []
+    for scope, settings in re.findall(
+            '<key>scope</key>\\s*<string>([^<]*)</string>\\s*<key>settings</key>\\s*<dict>(.*?)</dict>',
+            partial, re.DOTALL):
+        rule = {'scope': scope}
+        for key, value in re.findall('<key>(\\w+)</key>\\s*<string>([^<]*)</string>', settings):
+            rule['font_style' if key == 'fontStyle' else key] = value
+        rules.append(rule)
+
+    return rules
+
+
+_COLOR_SCHEME_OVERRIDE_MARKER = '// phpspec-run: '
+
+
+def color_scheme_override_file(color_scheme):
+    cs_name = os.path.splitext(os.path.basename(color_scheme))[0]
+
+    return os.path.join(packages_path(), 'User', cs_name + '.sublime-color-scheme')
+
+
+def remove_color_scheme_override(color_scheme):
+    """Remove the color scheme override of {color_scheme} written by the plugin, if any."""
+    abs_file = color_scheme_override_file(color_scheme)
+    contents = read_file(abs_file)
+    if contents is not None and contents.startswith(_COLOR_SCHEME_OVERRIDE_MARKER):
+        debug_message('removing color scheme override \'%s\'', abs_file)
+        try:
+            os.remove(abs_file)
+        except OSError as e:
+            debug_message('cannot remove color scheme override \'%s\': %s', abs_file, e)
+
+
+def write_color_scheme_override(color_scheme, partial, digest):
+    """
+    Write a color scheme override into the User package.
+
+    Sublime Text merges the override with the color scheme of the same name.
+    Returns {color_scheme}, or None if the user has their own override.
+    """
+    abs_file = color_scheme_override_file(color_scheme)
+    marker = _COLOR_SCHEME_OVERRIDE_MARKER
+
+    contents = read_file(abs_file)
+    if contents is not None:
+        if not contents.startswith(marker):
+            debug_message('color scheme override \'%s\' is user defined', abs_file)
+            return None
+
+        if contents.startswith(marker + digest):
+            debug_message('color scheme override \'%s\' is up to date', abs_file)
+            return color_scheme
+
+    debug_message('writing color scheme override \'%s\'', abs_file)
+
+    if not os.path.exists(os.path.dirname(abs_file)):
+        os.makedirs(os.path.dirname(abs_file))
+
+    with open(abs_file, 'w', encoding='utf8') as f:
+        f.write(marker + digest + '\n')
+        f.write(json.dumps({'rules': color_scheme_rules_from_partial(partial)}, indent=4))
+
+    return color_scheme
+
+
+def write_patched_color_scheme(color_scheme, color_scheme_resource, partial, digest):
+    """
+    Write {color_scheme} patched with the test result colors into the cache.
+
+    The patch is skipped if the cached file was generated from the same color
+    scheme and partial. Returns the resource name of the patched scheme.
+    """
+    cs_head, cs_tail = os.path.split(color_scheme)
+    cs_package = os.path.split(cs_head)[1]
+    cs_name = os.path.splitext(cs_tail)[0]
+
+    file_name = cs_package + '__' + cs_name + '.hidden-tmTheme'
+    abs_file = os.path.join(cache_path(), __name__.split('.')[0], 'color-schemes', file_name)
+    rel_file = 'Cache/{}/color-schemes/{}'.format(__name__.split('.')[0], file_name)
+    digest_file = abs_file + '.sha1'
+
+    debug_message('auto generated color scheme = %s', rel_file)
+
+    if os.path.isfile(abs_file) and read_file(digest_file) == digest:
+        debug_message('auto generated color scheme is up to date')
+        return rel_file
+
+    if not os.path.exists(os.path.dirname(abs_file)):
+        os.makedirs(os.path.dirname(abs_file))
+
+    with open(abs_file, 'w', encoding='utf8') as f:
+        f.write(re.sub(
+            '</array>\\s*'
+            '((<!--\\s*)?<key>.*</key>\\s*<string>[^<]*</string>\\s*(-->\\s*)?)*'
+            '</dict>\\s*</plist>\\s*'
+            '$',
+
+            partial + '\\n</array></dict></plist>',
+            color_scheme_resource
+        ))
+
+    with open(digest_file, 'w', encoding='utf8') as f:
+        f.write(digest)
+
+    return rel_file
+
+
+def results_syntax():
+    return 'Packages/{}/res/text-ui-result.sublime-syntax'.format(__name__.split('.')[0])
+
+
+_resource_files = {}
+
+
+def get_resource_file(name):
+    """
+    Return the path of the {name} script in the package res directory.
+
+    The script is copied out of the package into the cache directory, so
+    that it can be run when the package is installed as a .sublime-package.
+    """
+    if name not in _resource_files:
+        contents = load_resource('Packages/{}/res/{}'.format(__name__.split('.')[0], name))
+        file = plugin_cache_path(name)
+
+        if read_file(file) != contents:
+            if not os.path.exists(os.path.dirname(file)):
+                os.makedirs(os.path.dirname(file))
+
+            with open(file, 'w', encoding='utf8') as f:
+                f.write(contents)
+
+        _resource_files[name] = file
+
+    return _resource_files[name]
+
+
+def cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:  # pragma: no cover
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def subprocess_startupinfo():
+    if platform() == 'windows':  # pragma: no cover
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        return startupinfo
+
+
+def find_spec_files(working_dir, configuration_file=None):
+    """Return the spec files of the project suites, relative to {working_dir}."""
+    index = get_project_index(working_dir, configuration_file, build=False)
+    if not index.is_built:
+        index.build()
+
+    return sorted(os.path.relpath(file, working_dir) for file in index.spec_files())
+
+
+_SPEC_DECLARATION_PATTERN = re.compile(
+    '/\\*.*?\\*/'
+    '|<<<[ \\t]*(?P<quote>[\'"]?)(?P<label>[a-zA-Z_][a-zA-Z0-9_]*)(?P=quote)\\r?\\n.*?^[ \\t]*(?P=label)\\b'
+    '|^[ \\t]*(?:'
+    'namespace[ \\t]+(?P<namespace>[a-zA-Z_\\\\][a-zA-Z0-9_\\\\]*)'
+    '|(?:(?:abstract|final)[ \\t]+)*class[ \\t]+(?P<class>[a-zA-Z_][a-zA-Z0-9_]*)'
+    '|(?:public[ \\t]+)?function[ \\t]+(?P<example>its?_[a-zA-Z0-9_]*)[ \\t]*\\('
+    ')', re.MULTILINE | re.DOTALL)
+
+
+def scan_spec_file(file):
+    """
+    Return a dict of the 'namespace', 'class' and 'examples' of the spec
+    {file}, or None if it cannot be read.
+
+    The examples are [name, line] lists of the it_ and its_ methods. Only
+    lines starting with a declaration are matched, so method bodies are
+    skipped by the regular expression engine without being tokenized.
+    Block comments and heredocs are matched as a whole and ignored, so that
+    commented out examples are not listed.
+    """
+    contents = read_file(file)
+    if contents is None:
+        return None
+
+    header = {'namespace': None, 'class': None, 'examples': []}
+    line = 1
+    position = 0
+    for match in _SPEC_DECLARATION_PATTERN.finditer(contents):
+        line += contents.count('\n', position, match.start())
+        position = match.start()
+        if match.group('example'):
+            header['examples'].append([match.group('example'), line])
+        elif match.group('class'):
+            header['class'] = header['class'] or match.group('class')
+        elif match.group('namespace') and not header['namespace']:
+            header['namespace'] = match.group('namespace')
+
+    return header
+
+
+class ExampleIndex():
+    """
+    Index of the examples of the spec files of a project, read from disk.
+
+    Spec files are scanned in a thread pool and rescanned only when their
+    mtime changed. The index is persisted as JSON under the cache directory,
+    keyed by the project working directory, so that it is available as
+    soon as Sublime Text starts.
+    """
+
+    max_workers = 8
+
+    def __init__(self, working_dir, configuration_file=None):
+        self.working_dir = working_dir
+        self.configuration_file = configuration_file
+        self.file = plugin_cache_path('examples', project_key(working_dir) + '.json')
+        self.lock = threading.Lock()
+        self.files = {}
+        self.refreshing = False
+        self.on_refreshed = []
+
+        contents = read_file(self.file)
+        if contents:
+            try:
+                data = json.loads(contents)
+                if data.get('working_dir') == working_dir:
+                    self.files = data.get('files', {})
+            except ValueError:
+                debug_message('invalid example index \'%s\'', self.file)
+
+    def refresh(self):
+        """Scan the new and modified spec files and drop the removed ones. Returns the number of files scanned."""
+        spec_files = find_spec_files(self.working_dir, self.configuration_file)
+
+        stale = []
+        for file in spec_files:
+            mtime = get_mtime(os.path.join(self.working_dir, file))
+            entry = self.files.get(file)
+            if not entry or entry['mtime'] != mtime:
+                stale.append((file, mtime))
+
+        def scan(item):
+            file, mtime = item
+            header = scan_spec_file(os.path.join(self.working_dir, file))
+            if header:
+                header['mtime'] = mtime
+
+            return file, header
+
+        scanned = []
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, cpu_count(), len(stale))) as executor:
+                scanned = list(executor.map(scan, stale))
+
+        with self.lock:
+            existing = set(spec_files)
+            files = dict((file, entry) for file, entry in self.files.items() if file in existing)
+            removed = len(self.files) - len(files)
+            for file, header in scanned:
+                if header:
+                    files[file] = header
+            self.files = files
+
+        debug_message('scanned %d spec files for examples in \'%s\'', len(stale), self.working_dir)
+        if stale or removed:
+            self.save()
+
+        return len(stale)
+
+    def refresh_async(self, on_done=None):
+        """
+        Refresh the index in a background thread and call {on_done} on the
+        main thread when done. A refresh requested while one is running
+        waits for it, its {on_done} is called when that refresh is done.
+        """
+        with self.lock:
+            if on_done:
+                self.on_refreshed.append(on_done)
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.refresh()
+            finally:
+                with self.lock:
+                    self.refreshing = False
+                    callbacks = self.on_refreshed
+                    self.on_refreshed = []
+
+            for callback in callbacks:
+                set_timeout(callback)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def examples(self):
+        """Return a list of (spec file, class, example, line) tuples sorted by spec file and line."""
+        with self.lock:
+            files = list(self.files.items())
+
+        examples = []
+        for file, entry in sorted(files):
+            class_name = entry['class'] or os.path.basename(file)[:-4]
+            if entry['namespace']:
+                class_name = entry['namespace'] + '\\' + class_name
+            for name, line in entry['examples']:
+                examples.append((file, class_name, name, line))
+
+        return examples
+
+    def save(self):
+        with self.lock:
+            contents = json.dumps({
+                'working_dir': self.working_dir,
+                'files': self.files
+            }, separators=(',', ':'), sort_keys=True)
+
+        if not os.path.exists(os.path.dirname(self.file)):
+            os.makedirs(os.path.dirname(self.file))
+
+        with open(self.file, 'w', encoding='utf8') as f:
+            f.write(contents)
+
+
+_example_indexes = {}
+
+
+def get_example_index(working_dir, configuration_file=None):
+    index = _example_indexes.get(working_dir)
+    if index is None or index.configuration_file != configuration_file:
+        index = _example_indexes[working_dir] = ExampleIndex(working_dir, configuration_file)
+
+    return index
+
+
+_EXAMPLES_SUMMARY_PATTERN = re.compile('(\\d+) examples? \\(([^)]*)\\)')
+_DRIVER_TARGET_PATTERN = re.compile('^##phpspec-run:target (\\d+) ([0-9.]+) (.*)$')
+_EXAMPLE_STATUSES = ['passed', 'skipped', 'pending', 'failed', 'broken']
+
+
+def parse_examples_summary(line):
+    """
+    Return a dict of example counts by status from a phpspec summary line.
+
+    e.g. '10 examples (8 passed, 1 failed, 1 broken)'. Returns None if the
+    line is not a summary line.
+    """
+    match = _EXAMPLES_SUMMARY_PATTERN.search(line)
+    if not match:
+        return None
+
+    counts = {}
+    for count, status in re.findall('(\\d+) (\\w+)', match.group(2)):
+        counts[status] = counts.get(status, 0) + int(count)
+
+    return counts
+
+
+def format_examples_summary(counts):
+    total = sum(counts.values())
+    statuses = [s for s in _EXAMPLE_STATUSES if counts.get(s)]
+    statuses += sorted(s for s in counts if s not in _EXAMPLE_STATUSES and counts[s])
+
+    return '{} examples ({})'.format(total, ', '.join('{} {}'.format(counts[s], s) for s in statuses))
+
+
+def plugin_cache_path(*paths):
+    return os.path.join(cache_path(), __name__.split('.')[0], *paths)
+
+
+def project_key(working_dir):
+    return hashlib.sha1(working_dir.encode('utf-8')).hexdigest()
+
+
+class TimingHistory():
+    """
+    History of spec file and example durations for a project.
+
+    The last few durations of each spec file and example are stored as JSON
+    under the cache directory, keyed by the project working directory, with
+    the CPU time and peak memory of the last few runs of each target. The
+    spec files and examples that no longer exist are dropped on save.
+    """
+
+    max_samples = 5
+    min_usage_samples = 3
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.file = plugin_cache_path('timings', project_key(working_dir) + '.json')
+        self.lock = threading.Lock()
+        self.data = {'working_dir': working_dir, 'files': {}, 'examples': {}, 'usage': {}}
+
+        contents = read_file(self.file)
+        if contents:
+            try:
+                data = json.loads(contents)
+                if data.get('working_dir') == working_dir:
+                    self.data['files'] = data.get('files', {})
+                    self.data['examples'] = data.get('examples', {})
+                    self.data['usage'] = data.get('usage', {})
+            except ValueError:
+                debug_message('invalid timing history \'%s\'', self.file)
+
+    def _record(self, section, key, duration):
+        with self.lock:
+            samples = self.data[section].setdefault(key, [])
+            samples.append(round(duration, 3))
+            del samples[:-self.max_samples]
+
+    def record_file(self, file, duration):
+        self._record('files', file, duration)
+
+    def record_example(self, example, duration):
+        """Record the duration of an example, e.g. 'spec/FooSpec.php:12'."""
+        self._record('examples', example, duration)
+
+    def record_usage(self, target, usage):
+        """Record the CPU time and peak memory of a run of {target}, 'suite' for the whole suite."""
+        with self.lock:
+            samples = self.data['usage'].setdefault(target, [])
+            samples.append([round(usage['user'] + usage['sys'], 3), usage['max_rss']])
+            del samples[:-self.max_samples]
+
+    def usage_baseline(self, target):
+        """
+        Return a dict of the median 'cpu' seconds and 'max_rss' bytes of the
+        recorded runs of {target}, or None if there are too few of them.
+        """
+        samples = self.data['usage'].get(target)
+        if not samples or len(samples) < self.min_usage_samples:
+            return None
+
+        cpu = sorted(sample[0] for sample in samples)
+        max_rss = sorted(sample[1] for sample in samples)
+
+        return {'cpu': cpu[len(cpu) // 2], 'max_rss': max_rss[len(max_rss) // 2]}
+
+    def expected_duration(self, target, default=None):
+        """
+        Return the mean duration of {target}, a spec file or a 'file:line'
+        example, or the one of its spec file if the example has not been
+        recorded, or {default}.
+        """
+        samples = None
+        if target != target_file(target):
+            samples = self.data['examples'].get(target)
+        if not samples:
+            samples = self.data['files'].get(target_file(target))
+        if not samples:
+            return default
+
+        return sum(samples) / len(samples)
+
+    def median_duration(self):
+        durations = sorted(samples[-1] for samples in self.data['files'].values() if samples)
+        if not durations:
+            return 1.0
+
+        return durations[len(durations) // 2]
+
+    def slowest(self, section='files', limit=20):
+        """Return a list of (key, latest duration, trend) tuples, slowest first."""
+        entries = []
+        for key, samples in self.data[section].items():
+            if samples:
+                entries.append((key, samples[-1], duration_trend(samples)))
+
+        entries.sort(key=lambda entry: entry[1], reverse=True)
+
+        return entries[:limit]
+
+    def prune(self):
+        """
+        Drop the history of the spec files that are no longer in the project
+        index, and of the examples that are no longer in the example index.
+
+        Nothing is pruned until the project index is built, and the examples
+        of a spec file are kept while its example index entry is stale.
+        """
+        index = _project_indexes.get(self.working_dir)
+        if not index or not index.is_built:
+            return
+
+        specs = set(os.path.relpath(file, self.working_dir) for file in index.spec_files())
+
+        example_index = _example_indexes.get(self.working_dir)
+        lines = {}
+
+        def example_lines(file):
+            """Return the lines of the examples of {file}, or None if unknown."""
+            if file not in lines:
+                lines[file] = None
+                entry = example_index.files.get(file) if example_index else None
+                if entry and entry['mtime'] == get_mtime(os.path.join(self.working_dir, file)):
+                    lines[file] = set(str(line) for name, line in entry['examples'])
+
+            return lines[file]
+
+        def exists(key):
+            file = target_file(key)
+            if file not in specs:
+                return False
+
+            if file == key:
+                return True
+
+            known = example_lines(file)
+
+            return known is None or key[len(file) + 1:] in known
+
+        with self.lock:
+            for section in ('files', 'examples', 'usage'):
+                self.data[section] = dict((key, samples) for key, samples in self.data[section].items()
+                                          if (section == 'usage' and key == 'suite') or exists(key))
+
+    def save(self):
+        self.prune()
+
+        with self.lock:
+            contents = json.dumps(self.data, separators=(',', ':'), sort_keys=True)
+
+        if not os.path.exists(os.path.dirname(self.file)):
+            os.makedirs(os.path.dirname(self.file))
+
+        with open(self.file, 'w', encoding='utf8') as f:
+            f.write(contents)
+
+
+def duration_trend(samples):
+    """Return an arrow comparing the latest duration to the previous ones."""
+    if len(samples) < 2:
+        return '\u2192'
+
+    previous = sum(samples[:-1]) / (len(samples) - 1)
+    if samples[-1] > previous * 1.1:
+        return '\u2191'
+
+    if samples[-1] < previous * 0.9:
+        return '\u2193'
+
+    return '\u2192'
+
+
+_timing_histories = {}
+
+
+def get_timing_history(working_dir):
+    history = _timing_histories.get(working_dir)
+    if history is None:
+        history = _timing_histories[working_dir] = TimingHistory(working_dir)
+
+    return history
+
+
+def schedule_shards(files, count, history=None):
+    """
+    Split {files} into {count} shards.
+
+    With a timing history the files are scheduled longest processing time
+    first: each file, slowest first, goes to the shard with the least total
+    expected duration. Files without history are expected to take the median
+    duration. Without history the files are dealt round-robin.
+    """
+    shards = [[] for i in range(min(count, len(files)))]
+    if not shards:
+        return shards
+
+    if history is None:
+        for i, file in enumerate(files):
+            shards[i % len(shards)].append(file)
+        return shards
+
+    default = history.median_duration()
+    expected = sorted(((history.expected_duration(file, default), file) for file in files), reverse=True)
+
+    loads = [(0.0, i) for i in range(len(shards))]
+    for duration, file in expected:
+        load, i = heapq.heappop(loads)
+        shards[i].append(file)
+        heapq.heappush(loads, (load + duration, i))
+
+    return shards
+
+
+class ExampleResult():
+    """The result of a single example."""
+
+    def __init__(self, spec, example, status, duration=0.0, message=None, file=None, line=None):
+        self.spec = spec
+        self.example = example
+        self.status = status
+        self.duration = duration
+        self.message = message
+        self.file = file
+        self.line = line
+
+    def is_failure(self):
+        return self.status in ('failed', 'broken')
+
+    def location(self):
+        if self.file and self.line:
+            return '{}:{}'.format(self.file, self.line)
+
+        return self.file
+
+
+class RunResult():
+    """The results of the examples of a run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.examples = []
+
+    def add(self, example):
+        with self.lock:
+            self.examples.append(example)
+
+    def counts(self):
+        counts = {}
+        with self.lock:
+            for example in self.examples:
+                counts[example.status] = counts.get(example.status, 0) + 1
+
+        return counts
+
+    def failures(self):
+        with self.lock:
+            return [example for example in self.examples if example.is_failure()]
+
+
+class JunitResultParser():
+    """
+    Incremental parser of the PHPSpec JUnit formatter output.
+
+    Output is fed in chunks as it is read. Each testcase is passed to
+    {on_example} as soon as it is parsed, and any output outside of a JUnit
+    document, e.g. PHP errors or driver markers, is passed to {on_text} line
+    by line. At most {max_buffer} characters of an unterminated line and of
+    each example message are kept. PHPSpec writes the whole document of a
+    run when it finishes, so the testcases of a run arrive together.
+    """
+
+    max_buffer = 65536
+    max_message = 4096
+
+    def __init__(self, on_example, on_text=None):
+        self.on_example = on_example
+        self.on_text = on_text
+        self.buffer = ''
+        self.parser = None
+        self.suite = None
+        self.example = None
+        self.message = None
+
+    def feed(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.feed_line(line + '\n')
+
+        if len(self.buffer) > self.max_buffer:
+            line = self.buffer
+            self.buffer = ''
+            self.feed_line(line)
+
+    def close(self):
+        if self.buffer:
+            line = self.buffer
+            self.buffer = ''
+            self.feed_line(line)
+
+        self.parser = None
+
+    def feed_line(self, line):
+        if self.parser is None:
+            stripped = line.lstrip()
+            if not (stripped.startswith('<?xml') or stripped.startswith('<testsuites')):
+                if self.on_text:
+                    self.on_text(line)
+                return
+
+            self._start_document()
+
+        try:
+            self.parser.Parse(line, False)
+        except expat.ExpatError as e:
+            debug_message('junit parse error %s', e)
+            self.parser = None
+            if self.on_text:
+                self.on_text(line)
+
+    def _start_document(self):
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self._start_element
+        self.parser.EndElementHandler = self._end_element
+        self.parser.CharacterDataHandler = self._character_data
+
+    def _start_element(self, name, attrs):
+        if name == 'testsuite':
+            self.suite = attrs.get('name')
+        elif name == 'testcase':
+            try:
+                duration = float(attrs.get('time') or 0)
+            except ValueError:
+                duration = 0.0
+
+            self.example = ExampleResult(
+                spec=attrs.get('classname') or self.suite,
+                example=attrs.get('name'),
+                status=attrs.get('status') or 'passed',
+                duration=duration
+            )
+        elif self.example is not None and name in ('failure', 'error', 'skipped'):
+            if not attrs.get('status'):
+                self.example.status = {'failure': 'failed', 'error': 'broken', 'skipped': 'pending'}[name]
+            if attrs.get('message'):
+                self.example.message = attrs['message'][:self.max_message]
+            self.message = []
+
+    def _end_element(self, name):
+        if name in ('failure', 'error', 'skipped'):
+            if self.example is not None and self.message and not self.example.message:
+                self.example.message = ''.join(self.message).strip()[:self.max_message]
+            self.message = None
+        elif name == 'testcase':
+            if self.example is not None:
+                self.on_example(self.example)
+            self.example = None
+        elif name == 'testsuites':
+            # The document is complete; the next one, if any, needs a new parser.
+            self.parser = None
+
+    def _character_data(self, data):
+        if self.message is not None and sum(len(m) for m in self.message) < self.max_message:
+            self.message.append(data)
+
+
+_example_lines = {}
+
+
+def find_example_line(spec_file, example):
+    """Return the line number of {example} e.g. 'it is initializable' in {spec_file}."""
+    mtime = get_mtime(spec_file)
+    cached = _example_lines.get(spec_file)
+    if cached is None or cached[0] != mtime:
+        lines = {}
+        contents = read_file(spec_file) or ''
+        for number, line in enumerate(contents.splitlines(), 1):
+            match = re.search('function\\s+(its?_[a-zA-Z0-9_]+)\\s*\\(', line)
+            if match:
+                lines[match.group(1).replace('_', ' ')] = number
+        cached = _example_lines[spec_file] = (mtime, lines)
+
+    return cached[1].get(example)
+
+
+def resolve_example_location(index, example):
+    """Set the spec file and line of {example} from its spec class."""
+    if example.file is None and example.spec:
+        example.file = index.file_for_spec_class(example.spec)
+
+    if example.file and example.line is None and example.example:
+        example.line = find_example_line(example.file, example.example)
+
+
+_EXAMPLE_STATUS_SYMBOLS = {
+    'passed': '\u2714',
+    'pending': '-',
+    'skipped': '?',
+    'failed': '\u2718',
+    'broken': '!'
+}
+
+
+def format_example_result(example):
+    lines = ['  {} {} ({:.0f}ms)'.format(
+        _EXAMPLE_STATUS_SYMBOLS.get(example.status, '?'), example.example, example.duration * 1000)]
+
+    if example.status != 'passed':
+        if example.message:
+            lines += ['      ' + line for line in example.message.splitlines()]
+        if example.location():
+            lines.append('      ' + example.location())
+
+    return '\n'.join(lines) + '\n'
+
+
+_last_results = {}
+
+
+def find_window(window_id):
+    for window in windows():
+        if window.id() == window_id:
+            return window
+
+
+def mark_failures(window, result):
+    """Mark the lines of the failing examples in the gutter of their open views."""
+    failures = {}
+    for example in result.failures():
+        if example.file and example.line:
+            failures.setdefault(example.file, []).append(example.line)
+
+    for view in window.views():
+        mark_view_failures(view, failures.get(view.file_name(), []))
+
+
+def mark_view_failures(view, lines):
+    if not lines:
+        return view.erase_regions('phpspec-run.failures')
+
+    view.add_regions(
+        'phpspec-run.failures',
+        [view.line(view.text_point(line - 1, 0)) for line in lines],
+        'region.redish',
+        'circle',
+        DRAW_NO_FILL | DRAW_NO_OUTLINE
+    )
+
+
+def target_file(target):
+    """Return the spec file or directory of a target e.g. 'spec/FooSpec.php:12'."""
+    return re.sub(':\\d+$', '', target)
+
+
+def batch_targets(targets):
+    """
+    Return {targets}, spec files and 'file:line' examples, in order without
+    the duplicates and the examples of spec files run as a whole.
+    """
+    files = set(target for target in targets if target == target_file(target))
+
+    batch = []
+    for target in targets:
+        if target not in batch and (target in files or target_file(target) not in files):
+            batch.append(target)
+
+    return batch
+
+
+class FailureHistory():
+    """
+    The failing examples of a project.
+
+    Failures are targets relative to the working directory: a spec file and
+    line e.g. 'spec/FooSpec.php:12' when the failing example is known, or
+    the spec file otherwise. They are stored as JSON under the cache
+    directory, keyed by the project working directory.
+    """
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.file = plugin_cache_path('failures', project_key(working_dir) + '.json')
+        self.failures = []
+
+        contents = read_file(self.file)
+        if contents:
+            try:
+                data = json.loads(contents)
+                if data.get('working_dir') == working_dir:
+                    self.failures = data.get('failures', [])
+            except ValueError:
+                debug_message('invalid failure history \'%s\'', self.file)
+
+    def update(self, targets, failures):
+        """
+        Replace the failures of the {targets} that were run with {failures}.
+
+        An empty target is the whole suite. A target without a line number
+        covers every example of the spec file or directory.
+        """
+        if '' in targets:
+            kept = []
+        else:
+            def is_covered(failure):
+                file = target_file(failure)
+                for target in targets:
+                    if target == failure:
+                        return True
+                    if target == target_file(target) and (file == target or file.startswith(target + os.sep)):
+                        return True
+                return False
+
+            kept = [failure for failure in self.failures if not is_covered(failure)]
+
+        self.failures = sorted(set(kept) | set(failures))
+
+    def save(self):
+        if not os.path.exists(os.path.dirname(self.file)):
+            os.makedirs(os.path.dirname(self.file))
+
+        with open(self.file, 'w', encoding='utf8') as f:
+            f.write(json.dumps({'working_dir': self.working_dir, 'failures': self.failures}, indent=1))
+
+
+_failure_histories = {}
+
+
+def get_failure_history(working_dir):
+    history = _failure_histories.get(working_dir)
+    if history is None:
+        history = _failure_histories[working_dir] = FailureHistory(working_dir)
+
+    return history
+
+
+_file_digests = {}
+_file_digests_lock = threading.Lock()
+
+
+def file_digest(file):
+    """
+    Return the SHA-1 of the contents of {file}, or None if it cannot be read.
+
+    Digests are cached by mtime in nanoseconds and size. A digest taken
+    within two seconds of the mtime is not reused, as the file could have
+    been changed again within the mtime resolution of the filesystem.
+    """
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+
+    stamp = (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+    with _file_digests_lock:
+        cached = _file_digests.get(file)
+    if cached and cached[0] == stamp and cached[2] - stat.st_mtime > 2:
+        return cached[1]
+
+    hashed_at = time.time()
+    try:
+        with open(file, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+    with _file_digests_lock:
+        _file_digests[file] = (stamp, digest, hashed_at)
+
+    return digest
+
+
+def environment_digest(context, options):
+    """
+    Return the digest of what every spec of a run depends on besides its
+    own files: composer.lock, the phpspec configuration, the PHP version
+    and executable, and the run options other than the format.
+    """
+    working_dir = context['working_dir']
+    php_version = read_file(os.path.join(working_dir, '.php-version'))
+
+    run_options = []
+    for i, option in enumerate(options):
+        if option != '--format' and (i == 0 or options[i - 1] != '--format') and \
+                not option.startswith('--format='):
+            run_options.append(option)
+
+    return hashlib.sha1(json.dumps([
+        file_digest(os.path.join(working_dir, 'composer.lock')),
+        file_digest(context['configuration_file']) if context['configuration_file'] else None,
+        php_version.strip() if php_version else None,
+        context['executables'].get('php'),
+        run_options
+    ]).encode('utf-8')).hexdigest()
+
+
+def spec_fingerprint(index, environment, spec):
+    """
+    Return the fingerprint of the {spec} file, relative to the working
+    directory of the project {index}: the digest of the spec file, its class
+    under test and the {environment} digest.
+    """
+    spec_file = os.path.join(index.working_dir, spec)
+    fqcn, is_spec = index.class_for_file(spec_file)
+    class_file = None
+    if fqcn and is_spec:
+        class_file = index.class_for_spec(fqcn) or index.file_for_class(fqcn, False)
+
+    return hashlib.sha1(json.dumps([
+        spec,
+        file_digest(spec_file),
+        file_digest(class_file) if class_file else None,
+        environment
+    ]).encode('utf-8')).hexdigest()
+
+
+class ResultCache():
+    """
+    The fingerprints of the spec files of a project that passed.
+
+    A spec file whose fingerprint is in the cache is unchanged since it
+    passed, with its class under test and the run environment, and can be
+    skipped. Above {max_entries} the least recently used fingerprints are
+    evicted. The cache is stored as JSON under the cache directory, keyed
+    by the project working directory.
+    """
+
+    def __init__(self, working_dir, max_entries=10000):
+        self.working_dir = working_dir
+        self.max_entries = max_entries
+        self.file = plugin_cache_path('results', project_key(working_dir) + '.json')
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        contents = read_file(self.file)
+        if contents:
+            try:
+                data = json.loads(contents)
+                if data.get('working_dir') == working_dir:
+                    self.entries = data.get('passed', {})
+            except ValueError:
+                debug_message('invalid result cache \'%s\'', self.file)
+
+    def hit(self, fingerprint):
+        """Return True, and mark it as used, if {fingerprint} is in the cache."""
+        with self.lock:
+            if fingerprint not in self.entries:
+                return False
+
+            self.entries[fingerprint] = time.time()
+
+            return True
+
+    def add(self, fingerprints):
+        now = time.time()
+        with self.lock:
+            for fingerprint in fingerprints:
+                self.entries[fingerprint] = now
+
+            if len(self.entries) > self.max_entries:
+                self.entries = dict(heapq.nlargest(
+                    self.max_entries, self.entries.items(), key=lambda entry: entry[1]))
+
+    def save(self):
+        with self.lock:
+            contents = json.dumps({
+                'working_dir': self.working_dir,
+                'passed': self.entries
+            }, separators=(',', ':'), sort_keys=True)
+
+        if not os.path.exists(os.path.dirname(self.file)):
+            os.makedirs(os.path.dirname(self.file))
+
+        with open(self.file, 'w', encoding='utf8') as f:
+            f.write(contents)
+
+
+_result_caches = {}
+
+
+def get_result_cache(working_dir):
+    cache = _result_caches.get(working_dir)
+    if cache is None:
+        cache = _result_caches[working_dir] = ResultCache(working_dir)
+
+    return cache
+
+
+def terminate_process(proc, timeout):
+    """
+    Terminate {proc} gracefully: SIGTERM, then SIGKILL if it is still
+    running after {timeout} seconds.
+    """
+    if proc.poll() is not None:
+        return
+
+    try:
+        proc.terminate()
+    except OSError:
+        return
+
+    def kill():
+        if proc.poll() is None:
+            debug_message('process %s did not terminate, killing it', proc.pid)
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+
+
+def wait_with_usage(proc):
+    """
+    Wait for the subprocess {proc} and return (exit code, usage).
+
+    The usage is a dict of the 'user' and 'sys' CPU seconds and the peak
+    resident set size 'max_rss' in bytes of the process, or None if it is
+    not available on the platform or the process was already reaped.
+    """
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None
+
+    try:
+        pid, status, rusage = os.wait4(proc.pid, 0)
+    except OSError:
+        return proc.wait(), None
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    # ru_maxrss is in kilobytes, except on OS X where it is in bytes.
+    return proc.returncode, {
+        'user': rusage.ru_utime,
+        'sys': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss * (1 if platform() == 'osx' else 1024)
+    }
+
+
+def sum_usage(usages):
+    """Return the total CPU time and the highest peak memory of {usages}, or None."""
+    usages = [usage for usage in usages if usage]
+    if not usages:
+        return None
+
+    return {
+        'user': sum(usage['user'] for usage in usages),
+        'sys': sum(usage['sys'] for usage in usages),
+        'max_rss': max(usage['max_rss'] for usage in usages)
+    }
+
+
+def format_bytes(size):
+    if size < 1024:
+        return '{} B'.format(size)
+
+    for unit in ('KB', 'MB'):
+        size /= 1024
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+
+    return '{:.2f} GB'.format(size / 1024)
+
+
+def format_usage(usage):
+    return 'CPU {:.2f}s (user {:.2f}s, sys {:.2f}s), peak memory {}'.format(
+        usage['user'] + usage['sys'], usage['user'], usage['sys'], format_bytes(usage['max_rss']))
+
+
+def usage_warnings(usage, baseline, ratio):
+    """
+    Return a list of warnings for the CPU time or peak memory of {usage}
+    that are more than {ratio} times the {baseline}.
+    """
+    if not usage or not baseline or not ratio:
+        return []
+
+    warnings = []
+    cpu = usage['user'] + usage['sys']
+    if baseline['cpu'] > 0 and cpu > baseline['cpu'] * ratio:
+        warnings.append('CPU time {:.2f}s is {:.1f}x the usual {:.2f}s'.format(
+            cpu, cpu / baseline['cpu'], baseline['cpu']))
+
+    if baseline['max_rss'] > 0 and usage['max_rss'] > baseline['max_rss'] * ratio:
+        warnings.append('Peak memory {} is {:.1f}x the usual {}'.format(
+            format_bytes(usage['max_rss']), usage['max_rss'] / baseline['max_rss'],
+            format_bytes(baseline['max_rss'])))
+
+    return warnings
+
+
+class RunSpans():
+    """
+    Timing spans of the phases of a run.
+
+    Spans are recorded with span(), as offsets from the start of the run, and
+    one-off events such as the first output with mark(). When the run
+    finishes the spans are shown in the status bar, written to the debug log
+    and appended as a JSON line to {log_file}, as enabled.
+    """
+
+    _log_lock = threading.Lock()
+
+    def __init__(self, name, status=False, log_file=None):
+        self.name = name
+        self.status = status
+        self.log_file = log_file
+        self.started_at = time.time()
+        self.spans = []
+        self.marks = {}
+        self.finished = False
+
+    def span(self, name):
+        return _RunSpan(self, name)
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = time.time() - self.started_at
+
+    def add(self, name, begin, end):
+        self.spans.append((name, begin - self.started_at, end - begin))
+
+    def totals(self):
+        """Return a list of (phase, seconds) tuples, in the order the phases started."""
+        totals = {}
+        names = []
+        for name, offset, duration in sorted(self.spans, key=lambda span: span[1]):
+            if name not in totals:
+                names.append(name)
+            totals[name] = totals.get(name, 0) + duration
+
+        return [(name, totals[name]) for name in names]
+
+    def finish(self, exit_code=None):
+        if self.finished:
+            return
+        self.finished = True
+
+        total = time.time() - self.started_at
+        totals = self.totals()
+        summary = ', '.join('{} {:.0f}ms'.format(name.replace('_', ' '), seconds * 1000) for name, seconds in
+                            totals + sorted(self.marks.items(), key=lambda mark: mark[1]))
+        summary = '{}total {:.0f}ms'.format(summary + ', ' if summary else '', total * 1000)
+
+        debug_message('timings of %s: %s', self.name, summary)
+
+        if self.status:
+            set_timeout(lambda: status_message('PHPSpec Run: ' + summary), 0)
+
+        if self.log_file:
+            line = json.dumps({
+                'timestamp': round(self.started_at, 3),
+                'run': self.name,
+                'exit_code': exit_code,
+                'total': round(total, 6),
+                'phases': dict((name, round(seconds, 6)) for name, seconds in totals),
+                'marks': dict((name, round(seconds, 6)) for name, seconds in self.marks.items()),
+                'spans': [[name, round(offset, 6), round(duration, 6)] for name, offset, duration in self.spans]
+            }, sort_keys=True)
+
+            try:
+                with self._log_lock:
+                    with open(self.log_file, 'a', encoding='utf8') as f:
+                        f.write(line + '\n')
+            except OSError as e:
+                print('PHPSpec Run: cannot write timings to \'{}\': {}'.format(self.log_file, e))
+
+
+class _RunSpan():
+
+    def __init__(self, spans, name):
+        self.spans = spans
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.time()
+
+    def __exit__(self, *exc_info):
+        self.spans.add(self.name, self.begin, time.time())
+
+
+class _NoRunSpans():
+    """Run spans that record nothing, used when timings are disabled."""
+
+    def span(self, name):
+        return self
+
+    def mark(self, name):
+        pass
+
+    def add(self, name, begin, end):
+        pass
+
+    def finish(self, exit_code=None):
+        pass
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_run_spans = _NoRunSpans()
+
+
+class ProcessScheduler():
+    """
+    Limits the number of phpspec processes running across all windows.
+
+    Jobs beyond 'phpspec-run.max_processes' wait in a queue. When a process
+    exits the next job is taken from the focused window first, then in the
+    order the jobs were submitted. Processes of background windows can be
+    started with a lower CPU ('phpspec-run.background_nice') and IO
+    ('phpspec-run.background_ionice') priority.
+
+    A job has a 'window_id', a 'description' and a launch() method, called
+    on the thread that frees the slot. The job releases its slot when done.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.max_processes = 0
+        self.nice = 0
+        self.ionice = False
+        self.running = []
+        self.queued = []
+
+    def configure(self, settings):
+        self.max_processes = settings.get('phpspec-run.max_processes') or cpu_count()
+        self.nice = settings.get('phpspec-run.background_nice') or 0
+        self.ionice = bool(settings.get('phpspec-run.background_ionice'))
+
+    def submit(self, job):
+        with self.lock:
+            if self.max_processes and len(self.running) >= self.max_processes:
+                debug_message('queued job %s', job.description)
+                self.queued.append(job)
+                return
+
+            self.running.append(job)
+
+        self.start(job)
+
+    def start(self, job):
+        job.started_at = time.time()
+        job.background = job.window_id is not None and job.window_id != focused_window_id()
+        job.launch()
+
+    def dequeue(self, job):
+        """Remove {job} from the queue, returning False if it is no longer queued."""
+        with self.lock:
+            if job in self.queued:
+                self.queued.remove(job)
+                return True
+
+        return False
+
+    def release(self, job):
+        jobs = []
+        with self.lock:
+            if job in self.running:
+                self.running.remove(job)
+
+            while self.queued and (not self.max_processes or len(self.running) < self.max_processes):
+                next_job = self.next_job()
+                self.queued.remove(next_job)
+                self.running.append(next_job)
+                jobs.append(next_job)
+
+        for next_job in jobs:
+            self.start(next_job)
+
+    def next_job(self):
+        focused = focused_window_id()
+        for job in self.queued:
+            if job.window_id == focused:
+                return job
+
+        return self.queued[0]
+
+    def lower_priority(self, pid):
+        """Lower the CPU and IO priority of the background process {pid}."""
+        if self.nice and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+            except OSError as e:
+                debug_message('cannot renice %s: %s', pid, e)
+
+        if self.ionice and shutil.which('ionice'):
+            subprocess.call(['ionice', '-c', '3', '-p', str(pid)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def jobs(self):
+        """Return the lists of running and queued jobs."""
+        with self.lock:
+            return list(self.running), list(self.queued)
+
+
+_scheduler = ProcessScheduler()
+
+
+def focused_window_id():
+    window = active_window()
+
+    return window.id() if window else None
+
+
+class SchedulerSlot():
+    """A process slot of the scheduler, for processes not started by the plugin itself."""
+
+    def __init__(self, window_id, description):
+        self.window_id = window_id
+        self.description = description
+        self.started_at = None
+        self.background = False
+        self.cancelled = False
+        self.granted = threading.Event()
+
+    def acquire(self):
+        """Block until the slot is granted, returning False if it was cancelled first."""
+        _scheduler.submit(self)
+        self.granted.wait()
+
+        return not self.cancelled
+
+    def launch(self):
+        self.granted.set()
+
+    def release(self):
+        _scheduler.release(self)
+
+    def cancel(self):
+        self.cancelled = True
+        if _scheduler.dequeue(self):
+            self.granted.set()
+
+
+class AsyncProcess():
+    """
+    A subprocess with its output read on a background thread.
+
+    The process is started when the scheduler has a free slot. Output is
+    read from the pipe in chunks as soon as it is available, decoded, and
+    passed to {on_output} cut at line ends, so that callers can append it in
+    batches. When the process exits {on_finished} is called with the exit
+    code and the duration in seconds, and {usage} is set to its resource
+    usage if available. Both callbacks are called on the reader thread.
+    """
+
+    kill_timeout = 3
+    max_chunk = 65536
+
+    def __init__(self, cmd, working_dir, env, on_output, on_finished=None, stdin=None, window_id=None,
+                 spans=_no_run_spans):
+        self.cmd = cmd
+        self.spans = spans
+        self.submitted_at = None
+        self.working_dir = working_dir
+        self.env = env
+        self.on_output = on_output
+        self.on_finished = on_finished
+        self.stdin = stdin
+        self.window_id = window_id
+        self.description = ' '.join([os.path.basename(cmd[0])] + cmd[1:])
+        self.proc = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.submitted = False
+        self.cancelled = False
+        self.background = False
+        self.exit_code = None
+        self.started_at = None
+        self.duration = None
+        self.usage = None
+        self.done = threading.Event()
+
+    def start(self):
+        self.submitted = True
+        self.submitted_at = time.time()
+        _scheduler.submit(self)
+
+    def launch(self):
+        self.spans.add('queue', self.submitted_at, time.time())
+
+        env = os.environ.copy()
+        env.update(self.env)
+
+        with self.lock:
+            if self.cancelled:
+                return self._finish(-signal.SIGTERM)
+
+            try:
+                with self.spans.span('spawn'):
+                    self.proc = subprocess.Popen(
+                        self.cmd,
+                        cwd=self.working_dir,
+                        env=env,
+                        stdin=subprocess.PIPE if self.stdin is not None else subprocess.DEVNULL,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        startupinfo=subprocess_startupinfo()
+                    )
+            except OSError as e:
+                print('PHPSpec Run: cannot run {}: {}'.format(self.cmd, e))
+                self.on_output('{}\n'.format(e))
+                return self._finish(-1)
+
+        self.pid = self.proc.pid
+        if self.background:
+            _scheduler.lower_priority(self.pid)
+
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def _read(self):
+        if self.stdin is not None:
+            try:
+                self.proc.stdin.write(self.stdin.encode('utf-8'))
+                self.proc.stdin.close()
+            except OSError:
+                pass
+
+        fd = self.proc.stdout.fileno()
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        pending = ''
+        while True:
+            try:
+                data = os.read(fd, self.max_chunk)
+            except OSError:
+                data = b''
+
+            if not data:
+                break
+
+            self.spans.mark('first_output')
+
+            text = pending + decoder.decode(data).replace('\r\n', '\n').replace('\r', '\n')
+            end = text.rfind('\n') + 1
+            if not end:
+                if len(text) < self.max_chunk:
+                    pending = text
+                    continue
+                end = len(text)
+
+            pending = text[end:]
+            self.output(text[:end])
+
+        text = pending + decoder.decode(b'', True)
+        if text:
+            self.output(text)
+
+        self.proc.stdout.close()
+        exit_code, self.usage = wait_with_usage(self.proc)
+        self._finish(exit_code)
+
+    def output(self, text):
+        """Pass {text} to the output callback, unless the process was cancelled."""
+        if not self.cancelled:
+            self.on_output(text)
+
+    def _finish(self, exit_code):
+        self.exit_code = exit_code
+        self.duration = time.time() - self.started_at if self.started_at else 0.0
+        self.done.set()
+        _scheduler.release(self)
+
+        debug_message('process %s exited with %s in %.3fs', self.pid, self.exit_code, self.duration)
+
+        if self.on_finished:
+            self.on_finished(self.exit_code, self.duration)
+
+    def poll(self):
+        return self.proc.poll() if self.proc else None
+
+    def is_running(self):
+        return self.submitted and not self.done.is_set()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            proc = self.proc
+
+        if proc:
+            terminate_process(proc, self.kill_timeout)
+        elif _scheduler.dequeue(self):
+            self._finish(-signal.SIGTERM)
+
+    def wait(self):
+        self.done.wait()
+
+        return self.exit_code
+
+
+class PanelOutput():
+    """
+    Appends text to an output panel in batches, at most every {interval} ms.
+
+    All the text is also written to the {log_file}, if any. Only the first
+    {max_lines} lines are appended to the panel, followed by a notice that
+    the output is truncated, except for text appended with force such as
+    the summary. A batch appends at most {max_flush} characters, the rest
+    is appended by the next batches.
+    """
+
+    interval = 50
+    max_flush = 65536
+
+    def __init__(self, panel, log_file=None, max_lines=None):
+        self.panel = panel
+        self.lock = threading.Lock()
+        self.pending = []
+        self.scheduled = False
+        self.max_lines = max_lines
+        self.lines = 0
+        self.truncated = False
+        self.cancelled = False
+        self.log_file = log_file
+        self.log = None
+        if log_file:
+            try:
+                if not os.path.isdir(os.path.dirname(log_file)):
+                    os.makedirs(os.path.dirname(log_file))
+                self.log = open(log_file, 'a', encoding='utf8')
+            except OSError as e:
+                print('PHPSpec Run: cannot open log file \'{}\': {}'.format(log_file, e))
+
+    def append(self, text, force=False, log=True):
+        """Append {text} to the panel, and to the log file unless not {log}."""
+        with self.lock:
+            if log and self.log:
+                self.log.write(text)
+
+            if self.cancelled:
+                return
+
+            if self.max_lines and not force:
+                if self.truncated:
+                    return
+
+                lines = text.count('\n')
+                if self.lines >= self.max_lines or self.lines + lines > self.max_lines:
+                    # Cut the text after the last line that fits, a single
+                    # chunk can hold many lines.
+                    end = -1
+                    for _ in range(self.max_lines - self.lines):
+                        end = text.find('\n', end + 1)
+                    self.truncated = True
+                    self.lines = self.max_lines
+                    text = text[:end + 1] + \
+                        '\n[Output truncated after {} lines, run PHPSpec Run: Open Full Log]\n'.format(self.lines)
+                else:
+                    self.lines += lines
+
+            self.pending.append(text)
+            if self.scheduled:
+                return
+            self.scheduled = True
+
+        set_timeout(self.flush, self.interval)
+
+    def cancel(self):
+        """Drop the text not appended yet and close the log file, the run was cancelled."""
+        with self.lock:
+            self.cancelled = True
+            self.pending = []
+            if self.log:
+                self.log.close()
+                self.log = None
+
+    def write_log(self, text):
+        """Write {text} to the log file only."""
+        with self.lock:
+            if self.log:
+                self.log.write(text)
+
+    def flush(self):
+        with self.lock:
+            text = ''.join(self.pending)
+            self.pending = []
+            if len(text) > self.max_flush:
+                end = text.rfind('\n', 0, self.max_flush) + 1 or self.max_flush
+                self.pending.append(text[end:])
+                text = text[:end]
+            else:
+                self.scheduled = False
+
+            if self.log:
+                self.log.flush()
+
+        if text:
+            self.panel.run_command('append', {'characters': text, 'force': True, 'scroll_to_end': True})
+
+        if self.pending:
+            set_timeout(self.flush, self.interval)
+
+    def close(self):
+        """Close the log file, text appended after is only shown in the panel."""
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
+
+
+def run_log_file(window_id):
+    """Return the file the full output of the runs of a window is logged to."""
+    return plugin_cache_path('logs', 'window-{}.log'.format(window_id))
+
+
+_RESIDENT_EXIT_PATTERN = re.compile(b'^##phpspec-run:exit (\\d+)\\s*$')
+_RESIDENT_USAGE_PATTERN = re.compile(b'^##phpspec-run:usage ([\\d.]+) ([\\d.]+) (\\d+)\\s*$')
+
+
+class ResidentProcess():
+    """
+    A run of a resident server, with the subset of the Popen interface used
+    by the suite runner.
+
+    The output is read from the connection to the server. The exit code and
+    the resource usage are taken from the lines the forked runner writes
+    last, and terminating the run signals the forked runner.
+    """
+
+    def __init__(self, connection, pid):
+        self.connection = connection
+        self.pid = pid
+        self.returncode = None
+        self.usage = None
+        self.terminated = False
+        self.stdout = self
+        self.file = connection.makefile('rb')
+
+    def readline(self, size=-1):
+        if self.returncode is not None:
+            return b''
+
+        line = self.file.readline(size)
+        match = _RESIDENT_USAGE_PATTERN.match(line)
+        if match:
+            self.usage = {
+                'user': float(match.group(1)),
+                'sys': float(match.group(2)),
+                'max_rss': int(match.group(3))
+            }
+            line = self.file.readline(size)
+
+        match = _RESIDENT_EXIT_PATTERN.match(line)
+        if match:
+            self.returncode = int(match.group(1))
+            return b''
+
+        return line
+
+    def close(self):
+        self.file.close()
+        self.connection.close()
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, sig):
+        self.terminated = True
+        try:
+            os.kill(self.pid, sig)
+        except OSError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def cancel(self):
+        terminate_process(self, AsyncProcess.kill_timeout)
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = -signal.SIGTERM if self.terminated else 255
+
+        return self.returncode
+
+
+class ResidentServer():
+    """
+    A long-lived PHP process that runs phpspec for a working directory.
+
+    The server boots the PHP interpreter and the Composer autoloader once and
+    forks a child process per run request received over a Unix domain
+    socket, so runs skip the startup cost. Project classes are not loaded
+    by the server itself, so changes to them are picked up by the next run.
+
+    The socket is created in a private directory, and every request carries
+    a random token passed to the server in its environment, so that other
+    users of the machine cannot run code through it.
+
+    The server is health checked before each run, exits on its own when
+    idle, and is restarted when composer.lock, the phpspec configuration or
+    the autoloader change. If it cannot be started, None is returned and the
+    caller falls back to spawning phpspec, until one of those files changes.
+    """
+
+    start_timeout = 10
+    ping_timeout = 1
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.socket_dir = None
+        self.socket_file = None
+        self.token = None
+        self.lock = threading.Lock()
+        self.proc = None
+        self.stamps = None
+        self.failed_stamps = None
+
+    @staticmethod
+    def is_supported():
+        return hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork')
+
+    def get_stamps(self, context):
+        files = [
+            os.path.join(self.working_dir, 'composer.lock'),
+            os.path.join(self.working_dir, 'vendor', 'autoload.php'),
+            context['configuration_file']
+        ]
+
+        return (tuple(context['server_cmd']), tuple((file, get_mtime(file)) for file in files if file))
+
+    def run(self, context, options, targets):
+        """Start a run of {targets}, returning a ResidentProcess, or None if the server is unavailable."""
+        with self.lock:
+            if not self.ensure_started(context):
+                return None
+
+        try:
+            connection = self.connect()
+            connection.settimeout(None)
+            connection.sendall(json.dumps({
+                'command': 'run',
+                'token': self.token,
+                'options': options,
+                'targets': targets
+            }).encode('utf-8') + b'\n')
+
+            proc = ResidentProcess(connection, 0)
+            line = proc.file.readline()
+            if not line.startswith(b'##phpspec-run:pid '):
+                raise OSError('unexpected response {!r}'.format(line))
+            proc.pid = int(line.split()[1])
+        except (OSError, ValueError) as e:
+            print('PHPSpec Run: resident server error: {}'.format(e))
+            self.stop()
+            return None
+
+        debug_message('resident server %s runs %s in %d', self.working_dir, targets, proc.pid)
+
+        return proc
+
+    def connect(self, timeout=None):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout or self.ping_timeout)
+        try:
+            connection.connect(self.socket_file)
+        except OSError:
+            connection.close()
+            raise
+
+        return connection
+
+    def ping(self):
+        try:
+            connection = self.connect()
+            try:
+                connection.sendall(json.dumps({'command': 'ping', 'token': self.token}).encode('utf-8') + b'\n')
+                return connection.makefile('rb').readline().strip() == b'pong'
+            finally:
+                connection.close()
+        except OSError as e:
+            debug_message('resident server ping failed: %s', e)
+            return False
+
+    def ensure_started(self, context):
+        stamps = self.get_stamps(context)
+
+        if self.proc:
+            if self.stamps != stamps:
+                debug_message('resident server %s is stale', self.working_dir)
+                self.stop()
+            elif self.proc.poll() is not None or not self.ping():
+                debug_message('resident server %s is gone', self.working_dir)
+                self.stop()
+            else:
+                return True
+
+        if self.failed_stamps == stamps:
+            return False
+
+        if self.start(context):
+            self.stamps = stamps
+            return True
+
+        self.failed_stamps = stamps
+        return False
+
+    def start(self, context):
+        # mkdtemp() creates the directory readable by the current user only.
+        self.socket_dir = tempfile.mkdtemp(prefix='phpspec-run-')
+        self.socket_file = os.path.join(self.socket_dir, 'server.sock')
+        self.token = codecs.encode(os.urandom(16), 'hex').decode('ascii')
+
+        cmd = context['server_cmd'] + [self.socket_file, str(context['server_idle_timeout'])]
+        debug_message('start resident server %s', cmd)
+
+        env = os.environ.copy()
+        env.update(context['env'])
+        env['PHPSPEC_RUN_SERVER_TOKEN'] = self.token
+
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                cwd=self.working_dir,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                startupinfo=subprocess_startupinfo()
+            )
+        except OSError as e:
+            print('PHPSpec Run: cannot start resident server: {}'.format(e))
+            self.remove_socket_dir()
+            return False
+
+        timer = threading.Timer(self.start_timeout, proc.kill)
+        timer.start()
+
+        output = []
+        try:
+            for line in iter(proc.stdout.readline, b''):
+                if line.startswith(b'##phpspec-run:ready '):
+                    break
+                output.append(line.decode('utf-8', 'replace'))
+            else:
+                proc.wait()
+                print('PHPSpec Run: resident server exited with {}: {}'.format(
+                    proc.returncode, ''.join(output).strip()))
+                self.remove_socket_dir()
+                return False
+        finally:
+            timer.cancel()
+
+        self.proc = proc
+
+        # Output that bypasses the connection, e.g. from PHP itself, must be
+        # drained for the server not to block on a full pipe.
+        def drain():
+            for line in iter(proc.stdout.readline, b''):
+                debug_message('resident server: %s', line.decode('utf-8', 'replace').rstrip())
+            proc.stdout.close()
+            proc.wait()
+
+        thread = threading.Thread(target=drain)
+        thread.daemon = True
+        thread.start()
+
+        return True
+
+    def stop(self):
+        proc = self.proc
+        self.proc = None
+        self.stamps = None
+
+        if proc and proc.poll() is None:
+            debug_message('stop resident server %s', self.working_dir)
+            proc.terminate()
+
+        self.remove_socket_dir()
+
+    def remove_socket_dir(self):
+        if self.socket_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+        self.socket_dir = None
+        self.socket_file = None
+        self.token = None
+
+
+_resident_servers = {}
+
+
+def get_resident_server(working_dir):
+    server = _resident_servers.get(working_dir)
+    if server is None:
+        server = _resident_servers[working_dir] = ResidentServer(working_dir)
+
+    return server
+
+
+def stop_resident_servers():
+    for server in _resident_servers.values():
+        server.stop()
+
+
+class PathMapper():
+    """
+    Translates paths between the host and the container or machine a
+    backend runs phpspec on.
+
+    The {mappings} are a dict of host directories to the directories they
+    are mounted at.
+    """
+
+    def __init__(self, mappings=None):
+        self.mappings = []
+        self.local_dirs = {}
+        for local, remote in (mappings or {}).items():
+            local = filter_path(local).rstrip('/\\')
+            remote = remote.rstrip('/')
+            self.mappings.append((local, remote))
+            self.local_dirs.setdefault(remote, local)
+
+        self.mappings.sort(key=lambda mapping: len(mapping[0]), reverse=True)
+
+        self.pattern = None
+        if self.local_dirs:
+            remotes = sorted(self.local_dirs, key=len, reverse=True)
+            self.pattern = re.compile('(?<![\\w.-])(' + '|'.join(re.escape(r) for r in remotes) + ')(?![\\w.-])')
+
+    def to_remote(self, path):
+        for local, remote in self.mappings:
+            if path == local:
+                return remote
+            if path.startswith(local + os.sep):
+                return remote + '/' + path[len(local) + 1:].replace(os.sep, '/')
+
+        return path
+
+    def to_local_text(self, text):
+        """Return {text} with the paths under the mounted directories translated to the host."""
+        if not self.pattern:
+            return text
+
+        return self.pattern.sub(lambda match: self.local_dirs[match.group(1)], text)
+
+
+class LocalBackend():
+    """Runs phpspec on the host."""
+
+    name = 'local'
+    is_local = True
+
+    def __init__(self):
+        self.paths = PathMapper()
+
+    def process(self, cmd, working_dir, env, on_output, on_finished=None, stdin=None, window_id=None,
+                spans=_no_run_spans):
+        """Return an AsyncProcess, not started yet, that runs {cmd} in {working_dir}."""
+        return AsyncProcess(cmd, working_dir, env, on_output, on_finished, stdin=stdin, window_id=window_id,
+                            spans=spans)
+
+
+class WrapperBackend(LocalBackend):
+    """
+    Runs phpspec through a wrapper command, e.g. winry or `docker compose
+    exec -T php`, started for every run.
+
+    '${working_dir}' in the wrapper command is replaced by the working
+    directory as seen by the command. Paths in the output are translated
+    back to the host.
+    """
+
+    name = 'wrapper'
+    is_local = False
+
+    def __init__(self, command, mappings=None):
+        self.command = list(command)
+        self.paths = PathMapper(mappings)
+
+    def process(self, cmd, working_dir, env, on_output, on_finished=None, stdin=None, window_id=None,
+                spans=_no_run_spans):
+        remote_dir = self.paths.to_remote(working_dir)
+        wrapped = [arg.replace('${working_dir}', remote_dir) for arg in self.command] + cmd
+
+        return AsyncProcess(wrapped, working_dir, env, lambda text: on_output(self.paths.to_local_text(text)),
+                            on_finished, stdin=stdin, window_id=window_id, spans=spans)
+
+
+_SESSION_READY = b'##phpspec-run:ready'
+_SESSION_PID_PATTERN = re.compile(b'^##phpspec-run:pid (\\d+)\\s*$')
+_SESSION_EXIT_PATTERN = re.compile(b'^##phpspec-run:exit (\\d+)\\s*$')
+
+
+class BackendSession():
+    """A long-lived shell started with a session command, running one command at a time."""
+
+    def __init__(self, command):
+        self.command = command
+        self.proc = None
+
+    def open(self):
+        """Start the shell and wait until it reads commands, raising OSError if it exits first."""
+        debug_message('open session %s', self.command)
+        self.proc = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            startupinfo=subprocess_startupinfo()
+        )
+
+        self.write('printf \'\\n##phpspec-run:ready\\n\'\n')
+        output = []
+        for line in iter(self.proc.stdout.readline, b''):
+            if line.rstrip() == _SESSION_READY:
+                return
+            output.append(line)
+
+        self.close()
+        raise OSError('session exited: {}'.format(b''.join(output).decode('utf-8', 'replace').strip()))
+
+    def write(self, script):
+        self.proc.stdin.write(script.encode('utf-8'))
+        self.proc.stdin.flush()
+
+    def readline(self):
+        return self.proc.stdout.readline()
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        terminate_process(self.proc, AsyncProcess.kill_timeout)
+
+
+class SessionBackend(WrapperBackend):
+    """
+    Runs phpspec in long-lived shells started with a session command, e.g.
+    `docker exec -i app sh`, so that runs skip the startup of the command.
+
+    Each run is written to an idle session as a command line that runs
+    phpspec in the background and reports its pid and exit code. Sessions
+    are opened while all are busy and reused once idle.
+    """
+
+    name = 'session'
+
+    def __init__(self, command, mappings=None):
+        super().__init__(command, mappings)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def process(self, cmd, working_dir, env, on_output, on_finished=None, stdin=None, window_id=None,
+                spans=_no_run_spans):
+        return SessionProcess(self, cmd, working_dir, env, on_output, on_finished, stdin=stdin,
+                              window_id=window_id, spans=spans)
+
+    def acquire(self):
+        """Return an idle session, opening a new one if there is none."""
+        with self.lock:
+            while self.idle:
+                session = self.idle.pop()
+                if session.is_alive():
+                    return session
+
+        session = BackendSession(self.command)
+        session.open()
+
+        return session
+
+    def release(self, session):
+        if session.is_alive():
+            with self.lock:
+                self.idle.append(session)
+
+    def close(self):
+        with self.lock:
+            sessions = self.idle
+            self.idle = []
+
+        for session in sessions:
+            session.close()
+
+    def script(self, cmd, working_dir, env, stdin=None):
+        """Return the command line that runs {cmd} in a session."""
+        command = ' '.join(shlex.quote(arg) for arg in cmd)
+        if env:
+            command = 'env {} {}'.format(
+                ' '.join(shlex.quote(k + '=' + v) for k, v in sorted(env.items())), command)
+
+        command = '(cd {} && exec {}) 2>&1'.format(shlex.quote(self.paths.to_remote(working_dir)), command)
+        if stdin is None:
+            command += ' </dev/null'
+        else:
+            command = 'printf %s {} | {}'.format(shlex.quote(stdin), command)
+
+        return (command + ' & pid=$!; printf \'\\n##phpspec-run:pid %s\\n\' "$pid"; '
+                'wait "$pid"; code=$?; printf \'\\n##phpspec-run:exit %s\\n\' "$code"\n')
+
+    def send_signal(self, pid, name):
+        """Send the signal {name}, e.g. 'TERM', to the process {pid} of a session."""
+        def send():
+            try:
+                proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL, startupinfo=subprocess_startupinfo())
+                proc.communicate('kill -{} {}\n'.format(name, pid).encode('utf-8'))
+            except OSError as e:
+                debug_message('cannot signal session process %s: %s', pid, e)
+
+        thread = threading.Thread(target=send)
+        thread.daemon = True
+        thread.start()
+
+
+class SessionProcess(AsyncProcess):
+    """
+    An AsyncProcess run in a session of a SessionBackend.
+
+    The pid is the pid of the process in the session, terminating it sends
+    the signal through the session command.
+    """
+
+    def __init__(self, backend, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backend = backend
+        self.terminated = False
+
+    def launch(self):
+        self.spans.add('queue', self.submitted_at, time.time())
+
+        with self.lock:
+            if self.cancelled:
+                return self._finish(-signal.SIGTERM)
+
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def _read(self):
+        try:
+            with self.spans.span('spawn'):
+                session = self.backend.acquire()
+        except OSError as e:
+            print('PHPSpec Run: cannot open a session {}: {}'.format(self.backend.command, e))
+            self.on_output('{}\n'.format(e))
+            return self._finish(-1)
+
+        if self.cancelled:
+            self.backend.release(session)
+            return self._finish(-signal.SIGTERM)
+
+        exit_code = None
+        blank = False
+        try:
+            session.write(self.backend.script(self.cmd, self.working_dir, self.env, self.stdin))
+
+            for line in iter(session.readline, b''):
+                match = _SESSION_PID_PATTERN.match(line)
+                if match:
+                    with self.lock:
+                        self.pid = int(match.group(1))
+                        cancelled = self.cancelled
+                    if cancelled:
+                        terminate_process(self, self.kill_timeout)
+                    blank = False
+                    continue
+
+                match = _SESSION_EXIT_PATTERN.match(line)
+                if match:
+                    exit_code = int(match.group(1))
+                    break
+
+                # The markers are written on a line of their own, a blank
+                # line before one is not output.
+                if blank:
+                    self.output('\n')
+                blank = line in (b'\n', b'\r\n')
+                if not blank:
+                    self.spans.mark('first_output')
+                    text = line.decode('utf-8', 'replace').replace('\r\n', '\n')
+                    self.output(self.backend.paths.to_local_text(text))
+        except OSError as e:
+            self.output('{}\n'.format(e))
+
+        if exit_code is None:
+            session.close()
+            exit_code = -1
+        else:
+            self.backend.release(session)
+            if self.terminated and exit_code > 128:
+                exit_code = 128 - exit_code
+
+        self._finish(exit_code)
+
+    def poll(self):
+        return self.exit_code if self.done.is_set() else None
+
+    def terminate(self):
+        self.terminated = True
+        self.backend.send_signal(self.pid, 'TERM')
+
+    def kill(self):
+        self.backend.send_signal(self.pid, 'KILL')
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            pid = self.pid
+
+        if pid:
+            terminate_process(self, self.kill_timeout)
+        elif _scheduler.dequeue(self):
+            self._finish(-signal.SIGTERM)
+
+
+_local_backend = LocalBackend()
+_session_backends = {}
+
+
+def get_session_backend(command, mappings=None):
+    key = json.dumps([command, mappings], sort_keys=True)
+    backend = _session_backends.get(key)
+    if backend is None:
+        backend = _session_backends[key] = SessionBackend(command, mappings)
+
+    return backend
+
+
+def close_backend_sessions():
+    for backend in _session_backends.values():
+        backend.close()
+
+
+def plugin_unloaded():
+    stop_resident_servers()
+    close_backend_sessions()
+
+
+_runners = {}
+
+
+class ShardedSuiteRunner():
+    """
+    Runs spec files across several worker processes.
+
+    The spec files are split into one shard per worker. When the driver
+    command is available each worker is a single PHP process that runs every
+    file in its shard, otherwise each file is run by its own phpspec process.
+    With a resident server each shard is a run forked by the server instead.
+    Output is prefixed with the shard number and followed by one aggregated
+    summary of all shards.
+    """
+
+    def __init__(self, panel, context, options, files=None, processes=None, fail_fast=False, history=None,
+                 result_format='text', failures=None, exclude=None, resident=None, spans=_no_run_spans,
+                 output=None, failures_only=False, result_cache=None):
+        self.panel = panel
+        self.result_cache = result_cache
+        self.fingerprints = {}
+        self.cached = []
+        self.failures_only = failures_only
+        self.coverage = context.get('coverage')
+        self.coverage_dir = None
+        self.spans = spans
+        self.resident = resident
+        self.failures = failures
+        self.exclude = exclude
+        self.next_run = None
+        self.history = history
+        self.result_format = result_format
+        self.result = RunResult() if result_format == 'junit' else None
+        self.index = None
+        self.context = context
+        self.options = options
+        self.files = files
+        self.processes = processes or cpu_count()
+        self.fail_fast = fail_fast
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.procs = {}
+        self.results = {}
+        self.counts = {}
+        self.current_specs = {}
+        self.shown_specs = {}
+        self.crashed_shards = []
+        self.usages = []
+        self.usage_warning_ratio = None
+        self.output = output or PanelOutput(panel)
+        self.finished = False
+        self.window_id = None
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            procs = list(self.procs.values())
+
+        for proc in procs:
+            proc.cancel()
+
+    def shard(self, files):
+        return schedule_shards(files, self.processes, self.history)
+
+    def _run(self):
+        started_at = time.time()
+
+        files = self.files
+        if files is None:
+            files = find_spec_files(self.context['working_dir'], self.context['configuration_file'])
+            if self.exclude:
+                files = [file for file in files if file not in self.exclude]
+
+        if self.result_cache:
+            self.fingerprint(files)
+            if self.files is None:
+                self.cached = [file for file in files if self.result_cache.hit(self.fingerprints[file])]
+                cached = set(self.cached)
+                files = [file for file in files if file not in cached]
+
+                # Without the driver every spec file would be run by its own
+                # process, when none is cached the suite is run as a whole.
+                if files and not self.cached and not self.context.get('driver_cmd'):
+                    files = ['']
+
+        if not files and not self.cached:
+            self.append('No spec files found.\n', force=True)
+            return self.finish()
+
+        if self.result:
+            self.index = get_project_index(
+                self.context['working_dir'], self.context['configuration_file'], build=False)
+
+        shards = self.shard(files)
+        debug_message('running %d files in %d shards', len(files), len(shards))
+        if self.coverage and any(all(shard) for shard in shards):
+            self.coverage_dir = tempfile.mkdtemp(prefix='phpspec-run-coverage-')
+        if len(files) > 1:
+            self.append('Running {} spec files across {} processes\n\n'.format(len(files), len(shards)))
+        elif self.result and files == ['']:
+            # The JUnit formatter writes its document when phpspec finishes,
+            # nothing is reported while the whole suite runs in one process.
+            self.append('Running the suite, the results are shown when it finishes\n\n')
+
+        threads = []
+        for index, shard in enumerate(shards):
+            thread = threading.Thread(target=self._run_shard, args=(index, shard))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        # The results of a cancelled run are partial, they are not
+        # recorded nor summarized.
+        if self.cancelled:
+            if self.coverage_dir:
+                shutil.rmtree(self.coverage_dir, ignore_errors=True)
+            return self.finish()
+
+        # The usage of a wrapped run is the one of the wrapper command, e.g.
+        # `docker compose exec`, not of phpspec.
+        usage = sum_usage(self.usages) if self.context['backend'].is_local else None
+        usage_target = self.usage_target()
+        warnings = []
+        if usage and usage_target and self.history:
+            warnings = usage_warnings(usage, self.history.usage_baseline(usage_target), self.usage_warning_ratio)
+            self.history.record_usage(usage_target, usage)
+
+        self.append(self.summary(len(files), len(shards), time.time() - started_at, usage, warnings), force=True)
+        if warnings:
+            set_timeout(lambda: status_message('PHPSpec Run: ' + warnings[0]), 0)
+
+        if self.history:
+            for target, result in self.results.items():
+                if target:
+                    self.history.record_file(target, result['duration'])
+            if self.result:
+                for example in self.result.examples:
+                    if example.file and example.line:
+                        self.history.record_example('{}:{}'.format(
+                            os.path.relpath(example.file, self.context['working_dir']), example.line),
+                            example.duration)
+            self.history.save()
+
+        if self.failures:
+            self.record_failures()
+
+        if self.result_cache:
+            self.record_passed()
+
+        if self.coverage_dir:
+            self.record_coverage()
+
+        if self.result and self.window_id is not None:
+            set_timeout(lambda: self.publish_result(), 0)
+
+        self.finish()
+
+    def usage_target(self):
+        """
+        Return the target the resource usage of the run is recorded for, or
+        None if the run is of several spec files.
+        """
+        if self.cached:
+            return None
+
+        if self.files is None:
+            return 'suite'
+
+        if len(self.files) == 1:
+            return self.files[0] or 'suite'
+
+        return None
+
+    def fingerprint(self, files):
+        """Compute the fingerprints of the spec files among {files}."""
+        with self.spans.span('fingerprint'):
+            index = get_project_index(self.context['working_dir'], self.context['configuration_file'], build=False)
+            environment = environment_digest(self.context, self.options)
+            for file in files:
+                if file and file == target_file(file) and file.endswith('.php'):
+                    self.fingerprints[file] = spec_fingerprint(index, environment, file)
+
+    def record_passed(self):
+        """Add the spec files that passed as a whole, or with the whole suite, to the result cache."""
+        if '' in self.results and not self.results['']['exit_code']:
+            passed = list(self.fingerprints.values())
+        else:
+            passed = [self.fingerprints[target] for target, result in self.results.items()
+                      if target in self.fingerprints and not result['exit_code']]
+        self.result_cache.add(passed)
+        self.result_cache.save()
+
+    def record_coverage(self):
+        """Update the coverage index of the project with the coverage collected by the shards."""
+        records = []
+        for name in sorted(os.listdir(self.coverage_dir)):
+            with open(os.path.join(self.coverage_dir, name), encoding='utf8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        debug_message('invalid coverage record in \'%s\'', name)
+        shutil.rmtree(self.coverage_dir, ignore_errors=True)
+
+        # The examples of a spec file that ran to the end and were not
+        # recorded have been removed. A spec file that crashed, e.g. on a
+        # fatal error, did not run all its examples.
+        specs = [target for target, result in self.results.items()
+                 if target and target == target_file(target) and result['exit_code'] in (0, 1)]
+
+        index = get_coverage_index(self.context['working_dir'])
+        index.update(records, specs)
+        index.save()
+
+        window = find_window(self.window_id)
+        if window:
+            set_timeout(lambda: mark_window_coverage(window, index), 0)
+
+    def record_failures(self):
+        working_dir = self.context['working_dir']
+        if self.result:
+            failing = set()
+            for example in self.result.failures():
+                if example.file:
+                    failing.add(os.path.relpath(example.file, working_dir) +
+                                (':{}'.format(example.line) if example.line else ''))
+        else:
+            # A failing run of the whole suite as one target does not tell
+            # which spec files failed, the recorded failures are kept.
+            if self.results.get('', {}).get('exit_code'):
+                return
+
+            failing = set(t for t, r in self.results.items() if r['exit_code'] and t)
+
+        targets = list(self.results)
+        if self.files is None:
+            targets.append('')
+
+        self.failures.update(targets, failing)
+        self.failures.save()
+
+    def publish_result(self):
+        window = find_window(self.window_id)
+        if window:
+            _last_results[self.window_id] = self.result
+            mark_failures(window, self.result)
+
+    def finish(self):
+        self.finished = True
+        self.output.close()
+        if self.cancelled:
+            return
+
+        self.spans.finish(max([result['exit_code'] for result in self.results.values()] or [0]))
+
+        if self.next_run:
+            set_timeout(self.next_run, 0)
+        elif self.window_id is not None:
+            set_timeout(lambda: notify_run_finished(self.window_id), 0)
+
+    def shard_commands(self, shard):
+        """Return a list of (cmd, stdin, target) tuples to run for {shard}."""
+        if self.coverage and all(shard):
+            stdin = ''.join(file + '\n' for file in shard)
+            return [(self.coverage['cmd'] + self.options, stdin, None)]
+
+        if self.context.get('driver_cmd') and all(shard):
+            stdin = ''.join(file + '\n' for file in shard)
+            return [(self.context['driver_cmd'] + self.options, stdin, None)]
+
+        return [(self.context['cmd'] + ['run'] + ([file] if file else []) + self.options, None, file)
+                for file in shard]
+
+    def _run_shard(self, index, shard):
+        if self.resident and not self.cancelled:
+            slot = SchedulerSlot(self.window_id, 'resident run of {} spec files'.format(len(shard)))
+            with self.lock:
+                self.procs[index] = slot
+            if not slot.acquire():
+                return
+
+            try:
+                started_at = time.time()
+                with self.spans.span('spawn'):
+                    proc = self.resident.run(self.context, self.options, shard)
+                if proc:
+                    if slot.background:
+                        _scheduler.lower_priority(proc.pid)
+
+                    with self.lock:
+                        self.procs[index] = proc
+                        if self.cancelled:
+                            proc.cancel()
+
+                    return self.read_output(index, proc, None, started_at)
+            finally:
+                slot.release()
+
+        env = self.context['env']
+        if self.coverage_dir:
+            env = dict(env, PHPSPEC_RUN_COVERAGE=self.coverage['driver'],
+                       PHPSPEC_RUN_COVERAGE_FILE=os.path.join(self.coverage_dir, '{}.jsonl'.format(index)))
+
+        for cmd, stdin, target in self.shard_commands(shard):
+            handle_output = self.output_handler(index)
+            proc = self.context['backend'].process(cmd, self.context['working_dir'], env,
+                                                   handle_output, stdin=stdin, window_id=self.window_id,
+                                                   spans=self.spans)
+
+            with self.lock:
+                if self.cancelled:
+                    return
+
+                self.procs[index] = proc
+                proc.start()
+
+            exit_code = proc.wait()
+            handle_output(None)
+            self.on_exit(index, target, exit_code, proc.duration, proc.usage)
+
+    def read_output(self, index, proc, target, started_at):
+        """Read the output of a resident server run {proc} until it exits."""
+        handle_output = self.output_handler(index)
+
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        for chunk in iter(lambda: proc.stdout.readline(JunitResultParser.max_buffer), b''):
+            self.spans.mark('first_output')
+            handle_output(decoder.decode(chunk))
+
+        handle_output(None)
+        proc.stdout.close()
+        self.on_exit(index, target, proc.wait(), time.time() - started_at, proc.usage)
+
+    def output_handler(self, index):
+        """
+        Return a function that handles the output of a worker of shard {index}.
+
+        The function is called with chunks of output text, then with None
+        once the worker has exited.
+        """
+        parser = None
+        if self.result:
+            parser = JunitResultParser(
+                on_example=lambda example: self.on_example(index, example),
+                on_text=lambda line: self.on_output(index, line)
+            )
+
+        def handle_output(text):
+            if parser:
+                if text is None:
+                    parser.close()
+                else:
+                    parser.feed(text)
+            elif text:
+                for line in text.splitlines(True):
+                    self.on_output(index, line)
+
+        return handle_output
+
+    def on_exit(self, index, target, exit_code, duration, usage=None):
+        if usage:
+            with self.lock:
+                self.usages.append(usage)
+
+        if target is not None:
+            self.on_target(index, target, exit_code, duration)
+        elif exit_code and not self.cancelled:
+            # The exit code of a batch is the highest exit code of its
+            # targets, anything else means the worker itself failed.
+            with self.lock:
+                reported = [r['exit_code'] for r in self.results.values() if r['shard'] == index]
+                if exit_code > max(reported or [0]):
+                    self.crashed_shards.append(index)
+            if self.fail_fast:
+                self.cancel()
+
+    def on_output(self, index, line):
+        if self.cancelled:
+            return
+
+        match = _DRIVER_TARGET_PATTERN.match(line.rstrip('\r\n'))
+        if match:
+            return self.on_target(index, match.group(3), int(match.group(1)), float(match.group(2)))
+
+        counts = parse_examples_summary(line)
+        if counts:
+            with self.lock:
+                for status, count in counts.items():
+                    self.counts[status] = self.counts.get(status, 0) + count
+
+        if line.strip():
+            self.append(self.prefix(index) + line)
+
+    def prefix(self, index):
+        if self.files is not None and len(self.files) == 1:
+            return ''
+
+        return '[{}] '.format(index + 1)
+
+    def on_example(self, index, example):
+        resolve_example_location(self.index, example)
+        self.result.add(example)
+
+        with self.lock:
+            is_new_spec = self.current_specs.get(index) != example.spec
+            self.current_specs[index] = example.spec
+
+            # Only the examples that did not pass, and their spec, are
+            # shown when failures only, the log has them all.
+            shown = not self.failures_only or example.status != 'passed'
+            is_new_shown_spec = shown and self.shown_specs.get(index) != example.spec
+            if shown:
+                self.shown_specs[index] = example.spec
+
+        text = format_example_result(example)
+        prefix = self.prefix(index)
+
+        def format_lines(text, spec_header):
+            if spec_header:
+                text = '\n{}\n'.format(example.spec) + text
+
+            return ''.join(prefix + line + '\n' for line in text.splitlines())
+
+        if not self.failures_only:
+            self.append(format_lines(text, is_new_spec))
+        else:
+            self.output.write_log(format_lines(text, is_new_spec))
+            if shown:
+                self.output.append(format_lines(text, is_new_shown_spec), log=False)
+
+        if example.is_failure() and self.fail_fast:
+            self.cancel()
+
+    def on_target(self, index, target, exit_code, duration):
+        debug_message('shard %d target %s exit %d in %.3fs', index + 1, target, exit_code, duration)
+        with self.lock:
+            self.results[target] = {'exit_code': exit_code, 'duration': duration, 'shard': index}
+
+        if exit_code and self.fail_fast:
+            self.cancel()
+
+    def summary(self, files, shards, duration, usage=None, warnings=()):
+        lines = ['']
+        failed = sorted(t for t, r in self.results.items() if r['exit_code'] and t)
+        if self.result:
+            failures = self.result.failures()
+            if failures:
+                lines.append('Failures:')
+                lines += ['  {} {}'.format(f.location() or f.spec, f.example) for f in failures]
+                lines.append('')
+        elif failed:
+            lines.append('Failed spec files:')
+            lines += ['  ' + os.path.join(self.context['working_dir'], t) for t in failed]
+            lines.append('')
+
+        for index in self.crashed_shards:
+            lines.append('Shard {} exited with an error.'.format(index + 1))
+
+        if self.cancelled:
+            lines.append('Cancelled.')
+
+        if files > 1:
+            lines.append('{} spec files across {} processes in {:.2f}s'.format(files, shards, duration))
+        else:
+            lines.append('{:.2f}s'.format(duration))
+        if files or not self.cached:
+            lines.append(format_examples_summary(self.result.counts() if self.result else self.counts))
+        if self.cached:
+            lines.append('{} spec files skipped, unchanged since they passed (phpspec-run.skip_unchanged)'.format(
+                len(self.cached)))
+
+        if usage:
+            lines.append(format_usage(usage))
+        lines += ['Warning: ' + warning for warning in warnings]
+
+        if self.failures_only:
+            lines.append('Passing examples are only in the full log, run PHPSpec Run: Open Full Log')
+
+        return '\n'.join(lines) + '\n'
+
+    def append(self, text, force=False):
+        if not self.cancelled:
+            self.output.append(text, force)
+
+    def flush(self):
+        self.output.flush()
+
+
+_processes = {}
+_outputs = {}
+_saving_all = False
+
+
+def is_running(window):
+    """Return True if tests are running in {window}."""
+    proc = _processes.get(window.id())
+    if proc and proc.is_running():
+        return True
+
+    runner = _runners.get(window.id())
+
+    return bool(runner and not runner.finished)
+
+
+def notify_run_finished(window_id):
+    queue = _run_queues.get(window_id)
+    if queue:
+        queue.on_finished()
+
+
+class RunQueue():
+    """
+    The runs requested in a window while tests are running.
+
+    A new request either preempts the current run or waits for it to finish,
+    according to the 'phpspec-run.run_policy' setting: "preempt", "wait", or
+    "auto", which waits if the current run is expected to finish within
+    'phpspec-run.run_wait_threshold' milliseconds, or its duration is not
+    known, and preempts it otherwise. A request identical to the current run
+    always waits, and identical waiting requests are coalesced into one.
+    The state of the queue is shown in the status bar.
+    """
+
+    def __init__(self, window_id):
+        self.window_id = window_id
+        self.pending = []
+        self.active = False
+        self.active_key = None
+        self.started_at = None
+        self.expected = None
+
+    @staticmethod
+    def key(method, kwargs):
+        return (method, json.dumps(kwargs, sort_keys=True))
+
+    def submit(self, phpspec, method, kwargs, expected=None, wait=False):
+        """
+        Return True if the run can start now, otherwise queue it and return
+        False. With {wait} the run waits for the current run whatever the
+        policy.
+        """
+        key = self.key(method, kwargs)
+        if is_running(phpspec.window) and (wait or key == self.active_key or
+                                           self.should_wait(phpspec.view.settings())):
+            if any(request['key'] == key for request in self.pending):
+                debug_message('coalesced run request %s', key)
+            else:
+                debug_message('queued run request %s', key)
+                self.pending.append({
+                    'key': key,
+                    'method': method,
+                    'kwargs': kwargs,
+                    'view_id': phpspec.view.id()
+                })
+
+            self.update_status()
+            return False
+
+        self.start(expected, key)
+        return True
+
+    def should_wait(self, settings):
+        policy = settings.get('phpspec-run.run_policy') or 'auto'
+        if policy == 'wait':
+            return True
+
+        if policy == 'preempt':
+            return False
+
+        if self.expected is None:
+            debug_message('current run duration unknown, waiting for it')
+            return True
+
+        remaining = self.expected - (time.time() - self.started_at)
+        debug_message('current run expected to finish in %.3fs', remaining)
+
+        return remaining <= settings.get('phpspec-run.run_wait_threshold', 1000) / 1000.0
+
+    def start(self, expected, key=None):
+        self.active = True
+        self.active_key = key
+        self.started_at = time.time()
+        self.expected = expected
+        self.update_status()
+
+    def on_finished(self):
+        self.active = False
+        self.active_key = None
+        self.expected = None
+
+        if self.pending:
+            request = self.pending.pop(0)
+            set_timeout(lambda: self.run(request), 0)
+
+        self.update_status()
+
+    def run(self, request):
+        window = find_window(self.window_id)
+        if not window:
+            self.pending = []
+            return
+
+        # Something else started in the meantime, e.g. a preempting run.
+        if is_running(window):
+            self.pending.insert(0, request)
+            return self.update_status()
+
+        try:
+            phpspec = PHPSpecRun(window)
+        except ValueError:
+            return
+
+        for view in window.views():
+            if view.id() == request['view_id']:
+                phpspec.view = view
+                break
+
+        debug_message('run queued request %s', request['key'])
+        phpspec.dequeued = True
+        getattr(phpspec, request['method'])(**request['kwargs'])
+
+        # A request that failed to start would hold up the rest of the queue.
+        if self.pending and not is_running(window):
+            self.on_finished()
+
+    def clear(self):
+        self.pending = []
+        self.active = False
+        self.active_key = None
+        self.expected = None
+        self.update_status()
+
+    def update_status(self):
+        window = find_window(self.window_id)
+        if not window:
+            return
+
+        if self.active:
+            status = 'PHPSpec: running'
+            if self.pending:
+                status += ', {} queued'.format(len(self.pending))
+        elif self.pending:
+            status = 'PHPSpec: {} queued'.format(len(self.pending))
+        else:
+            status = None
+
+        for view in window.views():
+            if status:
+                view.set_status('phpspec-run', status)
+            else:
+                view.erase_status('phpspec-run')
+
+
+_run_queues = {}
+
+
+def get_run_queue(window):
+    queue = _run_queues.get(window.id())
+    if queue is None:
+        queue = _run_queues[window.id()] = RunQueue(window.id())
+
+    return queue
+
+
+class RunOnSave():
+    """
+    Runs the specs, or spec examples ('file:line'), affected by saved files.
+
+    Saves within the debounce delay are collected into one run. The run is
+    requested through the run queue of the window and, if tests are already
+    running, waits for them to finish rather than killing them.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.specs = []
+        self.generation = 0
+
+    def on_save(self, spec, delay):
+        if spec not in self.specs:
+            self.specs.append(spec)
+
+        self.generation += 1
+        generation = self.generation
+        set_timeout(lambda: self.on_debounced(generation), delay)
+
+    def on_debounced(self, generation):
+        if generation == self.generation:
+            self.run()
+
+    def cancel(self):
+        """Drop the saves waiting for the debounce delay."""
+        self.specs = []
+        self.generation += 1
+
+    def run(self):
+        specs = self.specs
+        self.specs = []
+        if not specs:
+            return
+
+        # The examples of a spec file that is run as a whole are not run again.
+        specs = [spec for spec in specs if spec == target_file(spec) or target_file(spec) not in specs]
+        debug_message('run on save %s', specs)
+
+        try:
+            phpspec = PHPSpecRun(self.window)
+        except ValueError:
+            return
+
+        phpspec.wait = True
+        if len(specs) == 1:
+            file = target_file(specs[0])
+            line = specs[0][len(file) + 1:]
+            phpspec.run(file=file, line_number=int(line) if line else None)
+        else:
+            configuration_file, working_dir = get_configuration_cache(self.window).find(
+                specs[0], self.window.folders())
+            if working_dir:
+                phpspec.run_parallel(files=[os.path.relpath(spec, working_dir) for spec in specs])
+
+
+_run_on_save = {}
+
+
+def find_affected_spec(view):
+    """Return the spec file to run when the view is saved, or None."""
+    if has_test_spec(view):
+        return view.file_name()
+
+    switchable = find_exact_switchable(view)
+    if switchable and switchable.file.endswith('Spec.php'):
+        return switchable.file
+
+
+def run_on_save(view, examples=None):
+    """
+    Run the spec affected by the save of {view}, or the {examples}, as
+    absolute 'file:line' targets, affected according to the coverage index
+    if not None.
+    """
+    window = view.window()
+    if not window:
+        return
+
+    if examples is not None:
+        debug_message('run on save affected examples %s', examples)
+        if not examples:
+            return status_message('PHPSpec Run: no examples executed the changed lines')
+        specs = examples
+    else:
+        spec = find_affected_spec(view)
+        debug_message('run on save affected spec \'%s\'', spec)
+        if not spec:
+            return
+        specs = [spec]
+
+    watcher = _run_on_save.get(window.id())
+    if watcher is None:
+        watcher = _run_on_save[window.id()] = RunOnSave(window)
+
+    for spec in specs:
+        watcher.on_save(spec, view.settings().get('phpspec-run.run_on_save_delay', 300))
+
+
+_PHP_TOKENS_TO_STRIP_PATTERN = re.compile(
+    '\'(?:[^\'\\\\]|\\\\.)*\'|"(?:[^"\\\\]|\\\\.)*"|/\\*.*?\\*/|(?://|#(?!\\[))[^\\n]*',
+    re.DOTALL
+)
+_PHP_NAME = '\\\\?[a-zA-Z_][a-zA-Z0-9_]*(?:\\\\[a-zA-Z_][a-zA-Z0-9_]*)*'
+_PHP_REFERENCE_PATTERNS = [re.compile(pattern) for pattern in [
+    '\\bnew\\s+(' + _PHP_NAME + ')',
+    '\\b(?:extends|instanceof)\\s+(' + _PHP_NAME + ')',
+    '(' + _PHP_NAME + ')\\s*::',
+]]
+# A type declaration: nullable, union, intersection and DNF types.
+_PHP_TYPE = '\\(?\\??' + _PHP_NAME + '\\)?(?:\\s*[|&]\\s*\\(?\\??' + _PHP_NAME + '\\)?)*'
+_PHP_MODIFIERS = '(?:(?:public|protected|private|readonly|static|var)\\s+)'
+_PHP_TYPE_PATTERNS = [re.compile(pattern) for pattern in [
+    # Parameters, including constructor promoted parameters.
+    '[(,]\\s*' + _PHP_MODIFIERS + '*(' + _PHP_TYPE + ')\\s+(?:&\\s*)?(?:\\.\\.\\.\\s*)?\\$',
+    # Typed properties.
+    '\\b' + _PHP_MODIFIERS + '+(' + _PHP_TYPE + ')\\s+\\$',
+    # Return types.
+    '\\)\\s*:\\s*(' + _PHP_TYPE + ')',
+]]
+_PHP_NAME_PATTERN = re.compile(_PHP_NAME)
+_PHP_NON_CLASS_NAMES = set([
+    'array', 'bool', 'callable', 'false', 'float', 'int', 'iterable', 'mixed', 'never', 'null',
+    'object', 'parent', 'self', 'static', 'string', 'true', 'void'
+])
+
+
+def scan_php_dependencies(contents):
+    """
+    Return a (declared, referenced) tuple of fully qualified class names.
+
+    A lightweight scan of `use` imports, `new`, `extends`, `implements`,
+    `instanceof`, static access and the parameter, promoted constructor
+    parameter, property and return types, including nullable, union and
+    intersection types.
+    """
+    contents = _PHP_TOKENS_TO_STRIP_PATTERN.sub('\'\'', contents)
+
+    namespace = ''
+    match = re.search('^\\s*namespace\\s+(' + _PHP_NAME + ')\\s*[;{]', contents, re.MULTILINE)
+    if match:
+        namespace = match.group(1).strip('\\')
+
+    aliases = {}
+    for statement in re.findall('^use\\s+([^;]+);', contents, re.MULTILINE):
+        statement = statement.strip()
+        if statement.startswith('function ') or statement.startswith('const '):
+            continue
+
+        group = re.match('^(' + _PHP_NAME + ')\\\\\\s*\\{(.*)\\}$', statement, re.DOTALL)
+        if group:
+            imports = [group.group(1) + '\\' + name.strip() for name in group.group(2).split(',')]
+        else:
+            imports = statement.split(',')
+
+        for name in imports:
+            parts = re.split('\\s+as\\s+', name.strip())
+            name = parts[0].strip().strip('\\')
+            if name:
+                aliases[(parts[1] if len(parts) > 1 else name.split('\\')[-1]).strip().lower()] = name
+
+    def resolve(name):
+        if name.lower() in _PHP_NON_CLASS_NAMES:
+            return None
+
+        if name.startswith('\\'):
+            return name[1:]
+
+        first, sep, rest = name.partition('\\')
+        if first.lower() in aliases:
+            return aliases[first.lower()] + sep + rest
+
+        return namespace + '\\' + name if namespace else name
+
+    declared = []
+    for name in re.findall('(?<![:$\\w])(?:class|interface|trait|enum)\\s+([a-zA-Z_][a-zA-Z0-9_]*)', contents):
+        declared.append(namespace + '\\' + name if namespace else name)
+
+    referenced = set(aliases.values())
+    for pattern in _PHP_REFERENCE_PATTERNS:
+        for name in pattern.findall(contents):
+            fqcn = resolve(name)
+            if fqcn:
+                referenced.add(fqcn)
+
+    for pattern in _PHP_TYPE_PATTERNS:
+        for declaration in pattern.findall(contents):
+            for name in _PHP_NAME_PATTERN.findall(declaration):
+                fqcn = resolve(name)
+                if fqcn:
+                    referenced.add(fqcn)
+
+    for name in re.findall('^[ \\t]+use\\s+(' + _PHP_NAME + ')\\s*[;{,]', contents, re.MULTILINE):
+        fqcn = resolve(name)
+        if fqcn:
+            referenced.add(fqcn)
+
+    for names in re.findall('\\bimplements\\s+([^{]+)\\{', contents):
+        for name in names.split(','):
+            fqcn = resolve(name.strip())
+            if fqcn:
+                referenced.add(fqcn)
+
+    referenced.difference_update(declared)
+
+    return declared, sorted(referenced)
+
+
+class DependencyGraph():
+    """
+    Reverse dependency graph from classes to the specs that use them.
+
+    Each PHP file of the project is scanned for the classes it declares and
+    references. A spec also depends on its class under test. The graph is
+    persisted under the cache directory and files are only rescanned when
+    their mtime changes.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.working_dir = index.working_dir
+        self.file = plugin_cache_path('dependencies', project_key(self.working_dir) + '.json')
+        self.lock = threading.Lock()
+        self.files = {}
+        self.last_run = None
+        self.declared_by = {}
+        self.referenced_by = {}
+        self.save_scheduled = False
+
+        contents = read_file(self.file)
+        if contents:
+            try:
+                data = json.loads(contents)
+                if data.get('working_dir') == self.working_dir:
+                    self.files = data.get('files', {})
+                    self.last_run = data.get('last_run')
+            except ValueError:
+                debug_message('invalid dependency graph \'%s\'', self.file)
+
+        for file, entry in self.files.items():
+            self._link(file, entry)
+
+    def _link(self, file, entry):
+        for fqcn in entry['declares']:
+            self.declared_by.setdefault(fqcn, set()).add(file)
+        for fqcn in entry['references']:
+            self.referenced_by.setdefault(fqcn, set()).add(file)
+
+    def _unlink(self, file):
+        entry = self.files.pop(file, None)
+        if entry:
+            for fqcn in entry['declares']:
+                self.declared_by.get(fqcn, set()).discard(file)
+            for fqcn in entry['references']:
+                self.referenced_by.get(fqcn, set()).discard(file)
+
+    def update_file(self, file):
+        """Rescan {file}; returns True if it changed since it was last scanned."""
+        relative = os.path.relpath(file, self.working_dir)
+        mtime = get_mtime(file)
+        entry = self.files.get(relative)
+        if entry and entry['mtime'] == mtime:
+            return False
+
+        contents = read_file(file)
+        if contents is None:
+            with self.lock:
+                self._unlink(relative)
+            return True
+
+        declared, referenced = scan_php_dependencies(contents)
+        fqcn, is_spec = self.index.class_for_file(file)
+        if is_spec and fqcn not in referenced:
+            referenced.append(fqcn)
+
+        entry = {'mtime': mtime, 'declares': declared, 'references': referenced, 'spec': is_spec}
+        with self.lock:
+            self._unlink(relative)
+            self.files[relative] = entry
+            self._link(relative, entry)
+
+        return True
+
+    def remove_file(self, file):
+        with self.lock:
+            self._unlink(os.path.relpath(file, self.working_dir))
+
+    def refresh(self):
+        """Rescan every changed, new or removed file of the project."""
+        seen = set()
+        changed = 0
+        for file in walk_php_files(self.index.roots()):
+            seen.add(os.path.relpath(file, self.working_dir))
+            if self.update_file(file):
+                changed += 1
+
+        with self.lock:
+            for relative in [f for f in self.files if f not in seen]:
+                self._unlink(relative)
+
+        debug_message('dependency graph refreshed %d of %d files', changed, len(seen))
+
+    def modified_since(self, timestamp):
+        """Return the files modified after {timestamp} (in ns)."""
+        return sorted(f for f, entry in self.files.items() if entry['mtime'] and entry['mtime'] > timestamp)
+
+    def affected_specs(self, files):
+        """Return the spec files that depend, directly or transitively, on {files}."""
+        visited = set(files)
+        queue = list(files)
+        while queue:
+            entry = self.files.get(queue.pop())
+            if not entry:
+                continue
+
+            for fqcn in entry['declares']:
+                for dependent in self.referenced_by.get(fqcn, ()):
+                    if dependent not in visited:
+                        visited.add(dependent)
+                        queue.append(dependent)
+
+        return sorted(f for f in visited if f in self.files and self.files[f]['spec'])
+
+    def save(self):
+        with self.lock:
+            self.save_scheduled = False
+            contents = json.dumps({
+                'working_dir': self.working_dir,
+                'last_run': self.last_run,
+                'files': self.files
+            }, separators=(',', ':'), sort_keys=True)
+
+        if not os.path.exists(os.path.dirname(self.file)):
+            os.makedirs(os.path.dirname(self.file))
+
+        with open(self.file, 'w', encoding='utf8') as f:
+            f.write(contents)
+
+    def schedule_save(self, delay=5000):
+        with self.lock:
+            if self.save_scheduled:
+                return
+            self.save_scheduled = True
+
+        set_timeout_async(self.save, delay)
+
+
+_dependency_graphs = {}
+
+
+def get_dependency_graph(index):
+    graph = _dependency_graphs.get(index.working_dir)
+    if graph is None or graph.index is not index:
+        graph = _dependency_graphs[index.working_dir] = DependencyGraph(index)
+
+    return graph
+
+
+def git_changed_files(working_dir, base_ref):
+    """Return the files changed since {base_ref}, including untracked files."""
+    files = set()
+    for cmd in (['git', 'diff', '--name-only', '--relative', base_ref],
+                ['git', 'ls-files', '--others', '--exclude-standard']):
+        output = subprocess.check_output(
+            cmd, cwd=working_dir, stderr=subprocess.STDOUT, startupinfo=subprocess_startupinfo())
+        files.update(line for line in output.decode('utf-8', 'replace').splitlines() if line)
+
+    return sorted(os.path.normpath(file) for file in files if file.endswith('.php'))
+
+
+def encode_line_ranges(lines):
+    """Return the sorted {lines} as ranges, e.g. '3-7,9'."""
+    ranges = []
+    for line in sorted(set(lines)):
+        if ranges and ranges[-1][1] == line - 1:
+            ranges[-1][1] = line
+        else:
+            ranges.append([line, line])
+
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+
+
+def decode_line_ranges(ranges):
+    lines = []
+    for part in ranges.split(','):
+        if part:
+            a, _, b = part.partition('-')
+            lines.extend(range(int(a), int(b or a) + 1))
+
+    return lines
+
+
+def changed_lines(opcodes):
+    """Return the lines of the old text changed by the difflib {opcodes}; an insertion changes the lines around it."""
+    lines = set()
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            continue
+        if i2 > i1:
+            lines.update(range(i1 + 1, i2 + 1))
+        else:
+            lines.update((i1, i1 + 1))
+
+    return lines
+
+
+def remap_lines(lines, opcodes):
+    """
+    Return the {lines} of the old text mapped to the new text of the difflib
+    {opcodes}. Replaced lines move into the replacement, deleted lines are
+    dropped.
+    """
+    starts = [opcode[1] for opcode in opcodes]
+    mapped = set()
+    for line in lines:
+        position = bisect.bisect_right(starts, line - 1) - 1
+        if position < 0:
+            continue
+
+        tag, i1, i2, j1, j2 = opcodes[position]
+        offset = line - 1 - i1
+        if offset >= i2 - i1 or j2 == j1:
+            continue
+        mapped.add(j1 + min(offset, j2 - j1 - 1) + 1)
+
+    return sorted(mapped)
+
+
+class CoverageIndex():
+    """
+    Map of the source lines executed by each spec example of a project.
+
+    The coverage collected by the driver replaces the entries of the
+    examples that were run. Lines are stored as ranges, with the mtime of
+    each file when its lines were recorded: the lines of a file modified
+    since are stale, except for saves in Sublime Text, whose line changes
+    are applied to the index. The index is persisted as JSON under the cache
+    directory, keyed by the project working directory.
+    """
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.file = plugin_cache_path('coverage', project_key(working_dir) + '.json')
+        self.lock = threading.Lock()
+        self.examples = {}
+        self.mtimes = {}
+        self.by_file = {}
+        self.save_scheduled = False
+
+        contents = read_file(self.file)
+        if contents:
+            try:
+                data = json.loads(contents)
+                if data.get('working_dir') == working_dir:
+                    self.examples = data.get('examples', {})
+                    self.mtimes = data.get('mtimes', {})
+            except ValueError:
+                debug_message('invalid coverage index \'%s\'', self.file)
+
+        for example, files in self.examples.items():
+            for file in files:
+                self.by_file.setdefault(file, set()).add(example)
+
+    def _remove_example(self, example):
+        for file in self.examples.pop(example, {}):
+            self.by_file.get(file, set()).discard(example)
+
+    def update(self, records, specs=()):
+        """
+        Replace the coverage of the examples of {records}, the dicts of an
+        'example' and its 'files' lines written by the driver. Examples of
+        the {specs} run as a whole that are not recorded are removed.
+        """
+        with self.lock:
+            recorded = set()
+            for record in records:
+                example = record['example']
+                recorded.add(example)
+                self._remove_example(example)
+                self.examples[example] = {}
+                for file, lines in record['files'].items():
+                    self.examples[example][file] = encode_line_ranges(lines)
+                    self.by_file.setdefault(file, set()).add(example)
+                    self.mtimes[file] = get_mtime(os.path.join(self.working_dir, file))
+
+            for spec in specs:
+                for example in [e for e in self.examples if target_file(e) == spec and e not in recorded]:
+                    self._remove_example(example)
+
+        debug_message('coverage of %d examples recorded', len(recorded))
+
+    def covers(self, file):
+        return bool(self.by_file.get(file))
+
+    def is_fresh(self, file):
+        return file in self.mtimes and self.mtimes[file] == get_mtime(os.path.join(self.working_dir, file))
+
+    def examples_for_lines(self, file, lines=None):
+        """Return the examples that executed any of {lines} of {file}, or any line if None."""
+        with self.lock:
+            examples = []
+            for example in self.by_file.get(file, ()):
+                if lines is None or not lines.isdisjoint(decode_line_ranges(self.examples[example][file])):
+                    examples.append(example)
+
+        return sorted(examples)
+
+    def covered_lines(self, file):
+        with self.lock:
+            lines = set()
+            for example in self.by_file.get(file, ()):
+                lines.update(decode_line_ranges(self.examples[example][file]))
+
+        return sorted(lines)
+
+    def on_file_saved(self, file, old_contents, fresh):
+        """
+        Return the examples affected by the save of {file}, whose contents
+        were {old_contents}, or None if it is not covered.
+
+        If the index was {fresh} for the old contents the examples that
+        executed the changed lines are returned and the lines of the file
+        are moved to the new contents, otherwise all the examples that
+        executed the file.
+        """
+        relative = os.path.relpath(file, self.working_dir)
+        contents = read_file(file)
+        if relative not in self.by_file or old_contents is None or contents is None:
+            return None
+
+        if not fresh:
+            return self.examples_for_lines(relative)
+
+        opcodes = difflib.SequenceMatcher(
+            None, old_contents.splitlines(), contents.splitlines(), autojunk=False).get_opcodes()
+        examples = self.examples_for_lines(relative, changed_lines(opcodes))
+
+        with self.lock:
+            for example in self.by_file[relative]:
+                lines = remap_lines(decode_line_ranges(self.examples[example][relative]), opcodes)
+                self.examples[example][relative] = encode_line_ranges(lines)
+            self.mtimes[relative] = get_mtime(file)
+
+        self.schedule_save()
+
+        return examples
+
+    def save(self):
+        with self.lock:
+            self.save_scheduled = False
+            contents = json.dumps({
+                'working_dir': self.working_dir,
+                'examples': self.examples,
+                'mtimes': self.mtimes
+            }, separators=(',', ':'), sort_keys=True)
+
+        if not os.path.exists(os.path.dirname(self.file)):
+            os.makedirs(os.path.dirname(self.file))
+
+        with open(self.file, 'w', encoding='utf8') as f:
+            f.write(contents)
+
+    def schedule_save(self, delay=5000):
+        with self.lock:
+            if self.save_scheduled:
+                return
+            self.save_scheduled = True
+
+        set_timeout_async(self.save, delay)
+
+
+_coverage_indexes = {}
+
+
+def get_coverage_index(working_dir):
+    index = _coverage_indexes.get(working_dir)
+    if index is None:
+        index = _coverage_indexes[working_dir] = CoverageIndex(working_dir)
+
+    return index
+
+
+def find_coverage_index(window, file):
+    """Return the coverage index of the project of {file}, or None if no coverage was collected."""
+    configuration_file, working_dir = get_configuration_cache(window).find(file, window.folders())
+    if not working_dir:
+        return None
+
+    if working_dir not in _coverage_indexes and \
+            not os.path.isfile(plugin_cache_path('coverage', project_key(working_dir) + '.json')):
+        return None
+
+    return get_coverage_index(working_dir)
+
+
+def mark_view_coverage(view, index):
+    """Mark the lines of {view} executed by the specs in the gutter, if the coverage of the file is fresh."""
+    file = os.path.relpath(view.file_name(), index.working_dir)
+    lines = index.covered_lines(file) if index.is_fresh(file) else []
+    if not lines:
+        return view.erase_regions('phpspec-run.coverage')
+
+    view.add_regions(
+        'phpspec-run.coverage',
+        [view.line(view.text_point(line - 1, 0)) for line in lines],
+        'region.greenish',
+        'dot',
+        DRAW_NO_FILL | DRAW_NO_OUTLINE
+    )
+
+
+def mark_window_coverage(window, index):
+    for view in window.views():
+        file = view.file_name()
+        if file and file.startswith(index.working_dir + os.sep) and view.settings().get('phpspec-run.coverage_marks'):
+            mark_view_coverage(view, index)
+
+
+_coverage_drivers = {}
+
+
+def coverage_driver_key(php):
+    """Return the key of the coverage driver of the PHP executable {php}, or None if it is not found."""
+    executable = php if os.path.dirname(php) else shutil.which(php)
+    if not executable:
+        return None
+
+    return executable, get_mtime(executable)
+
+
+def is_coverage_driver_known(php):
+    """Return True if the coverage driver of {php} can be returned without running PHP."""
+    key = coverage_driver_key(php)
+
+    return key is None or key in _coverage_drivers
+
+
+def find_coverage_driver(php):
+    """
+    Return the coverage driver available to the PHP executable {php}: 'pcov',
+    'xdebug', 'phpdbg' or None.
+
+    The extensions are checked by running PHP, only once per executable, see
+    PHPSpecRun.find_coverage_driver_async() to avoid blocking the UI thread.
+    """
+    key = coverage_driver_key(php)
+    if not key:
+        return None
+
+    executable = key[0]
+    if key not in _coverage_drivers:
+        driver = None
+        try:
+            output = subprocess.check_output(
+                [executable, '-r', 'echo extension_loaded("pcov") ? "pcov" : '
+                                   '(extension_loaded("xdebug") ? "xdebug" : "");'],
+                stderr=subprocess.DEVNULL, startupinfo=subprocess_startupinfo(), timeout=10)
+            driver = output.decode('utf-8', 'replace').strip() or None
+        except (OSError, subprocess.SubprocessError) as e:
+            debug_message('cannot check the coverage extensions of %s: %s', executable, e)
+
+        if driver not in ('pcov', 'xdebug'):
+            driver = None
+            if is_file_executable(os.path.join(os.path.dirname(executable), 'phpdbg')):
+                driver = 'phpdbg'
+
+        debug_message('coverage driver of %s is %s', executable, driver)
+        _coverage_drivers[key] = driver
+
+    return _coverage_drivers[key]
+
+
+def coverage_driver_command(driver, driver_cmd, working_dir):
+    """Return the driver command {driver_cmd} run with the coverage {driver} enabled."""
+    php, script, autoload = driver_cmd[:3]
+
+    if driver == 'pcov':
+        return [php, '-d', 'pcov.enabled=1', '-d', 'pcov.directory=' + working_dir, script, autoload]
+
+    if driver == 'xdebug':
+        return [php, '-d', 'xdebug.mode=coverage', script, autoload]
+
+    return [os.path.join(os.path.dirname(php), 'phpdbg'), '-qrr', script, autoload]
+
+
+class PHPSpecRun():
+
+    dequeued = False
+    wait = False
+    spans = _no_run_spans
+
+    def __init__(self, window):
+        self.window = window
+        self.view = self.window.active_view()
+        if not self.view:
+            raise ValueError('view not found')
+
+        debug_message('view %d %s', self.view.id(), self.view.file_name())
+
+    def run(self, working_dir=None, file=None, options=None, line_number=None, directory=None):
+        debug_message('phpspec run with working_dir=%s, file=%s, line_number=%s, directory=%s, options=%s', working_dir, file, line_number, directory, options)
+
+        kwargs = {
+            'working_dir': working_dir,
+            'file': file,
+            'options': dict(options) if options else options,
+            'line_number': line_number,
+            'directory': directory
+        }
+
+        self.spans = self.create_spans()
+
+        original_file = ''
+        target = None
+        result_format = self.get_result_format()
+
+        try:
+            context = self.prepare_command(working_dir)
+            working_dir = context['working_dir']
+            env = context['env']
+
+            options = self.filter_options(options)
+            debug_message('options %s', options)
+
+            if file:
+                if os.path.isfile(file):
+                    file = os.path.relpath(file, working_dir)
+                    original_file = file
+                    if line_number:
+                        file+= ':' + str(line_number)
                     elif directory:
                         file = os.path.dirname(file)
-                    cmd.append(file)
+                    target = file
                     debug_message('file %s', file)
                 else:
                     raise ValueError('test file \'%s\' not found' % file)
 
-        except ValueError as e:
-            status_message('PHPSpec Run: {}'.format(e))
-            print('PHPSpec Run: {}'.format(e))
-            return
-        except Exception as e:
-            status_message('PHPSpec Run: {}'.format(e))
-            print('PHPSpec Run: \'{}\''.format(e))
-            raise e
+        except ValueError as e:
+            status_message('PHPSpec Run: {}'.format(e))
+            print('PHPSpec Run: {}'.format(e))
+            return
+        except Exception as e:
+            status_message('PHPSpec Run: {}'.format(e))
+            print('PHPSpec Run: \'{}\''.format(e))
+            raise e
+
+        expected = None
+        if target:
+            expected = get_timing_history(working_dir).expected_duration(target)
+
+        if target and self.view.settings().get('phpspec-run.coverage') and \
+                self.find_coverage_driver_async(context, 'run', kwargs):
+            return
+
+        if not self.queue_run('run', kwargs, expected):
+            return
+
+        self.spans.name = target or 'suite'
+
+        self.save_all()
+
+        set_window_setting('phpspec-run._test_last', {
+            'options': options,
+            'file': original_file,
+            'directory': directory,
+            'working_dir': working_dir,
+            'line_number': line_number
+        }, window=self.window)
+
+        if target and self.view.settings().get('phpspec-run.coverage'):
+            context['coverage'] = self.get_coverage(context)
+
+        skip_unchanged = not target and self.view.settings().get('phpspec-run.skip_unchanged')
+        if result_format == 'junit' or context.get('coverage') or skip_unchanged or \
+                self.get_resident_server(context):
+            if result_format == 'junit':
+                options = dict(options, format='junit')
+            run_options = self.build_run_options(context, options)
+            # The suite is run in parallel by run_parallel(), the spec files
+            # that are not skipped are run one after the other.
+            return self.start_runner(context, run_options, files=None if skip_unchanged else [target or ''],
+                                     processes=1, result_format=result_format, spans=self.spans)
+
+        cmd = context['cmd']
+        cmd.append('run')
+        cmd = build_cmd_options(options, cmd)
+        if target:
+            cmd.append(target)
+
+        if self.view.settings().get('phpspec-run.suffix'):
+            cmd.append(self.view.settings().get('phpspec-run.suffix'))
+
+        if context['configuration_file']:
+            relative_phpspec_configuration_file = os.path.relpath(context['configuration_file'], working_dir)
+            cmd.append('--config=' + relative_phpspec_configuration_file)
+
+        debug_message('env %s', env)
+        debug_message('****** cmd \'%s\'', cmd)
+
+        self.run_process(context, cmd, target)
+
+    def run_process(self, context, cmd, target):
+        """
+        Run {cmd} and show its output in the results panel.
+
+        When it exits the duration of a spec file {target} is recorded, the
+        failures of {target}, and the CPU time and peak memory of the run.
+        """
+        working_dir = context['working_dir']
+        window_id = self.window.id()
+
+        panel = self.create_results_panel(working_dir)
+        output = self.create_output(panel)
+
+        if is_debug(self.view):
+            output.append('[{}]\n[dir: {}]\n'.format(' '.join(cmd), working_dir))
+
+        def on_output(text):
+            if not proc.cancelled:
+                output.append(text)
+
+        def on_finished(exit_code, duration):
+            if proc.cancelled:
+                output.close()
+                return
+
+            spans.finish(exit_code)
+
+            if exit_code:
+                output.append('[Finished in {:.1f}s with exit code {}]\n'.format(duration, exit_code), force=True)
+            else:
+                output.append('[Finished in {:.1f}s]\n'.format(duration), force=True)
+
+            history = get_timing_history(working_dir)
+            if proc.usage and context['backend'].is_local:
+                output.append('[{}]\n'.format(format_usage(proc.usage)), force=True)
+                warnings = usage_warnings(proc.usage, history.usage_baseline(target or 'suite'), warning_ratio)
+                for warning in warnings:
+                    output.append('[Warning: {}]\n'.format(warning), force=True)
+                if warnings:
+                    set_timeout(lambda: status_message('PHPSpec Run: ' + warnings[0]), 0)
+                history.record_usage(target or 'suite', proc.usage)
+            output.close()
+
+            if target and os.path.isfile(os.path.join(working_dir, target)):
+                history.record_file(target, duration)
+            history.save()
+
+            if target:
+                failures = get_failure_history(working_dir)
+                failures.update([target], [target] if exit_code else [])
+                failures.save()
+
+            def finish():
+                if _processes.get(window_id) is proc:
+                    del _processes[window_id]
+                    notify_run_finished(window_id)
+
+            set_timeout(finish, 0)
+
+        spans = self.spans
+        warning_ratio = self.get_usage_warning_ratio()
+        proc = context['backend'].process(cmd, working_dir, context['env'], on_output, on_finished,
+                                          window_id=window_id, spans=spans)
+        _processes[window_id] = proc
+        proc.start()
+
+    def queue_run(self, method, kwargs, expected=None):
+        """
+        Return True, after cancelling the current run, if the run of {method}
+        with {kwargs} should start now.
+
+        Otherwise the request is added to the run queue of the window. The
+        {expected} duration of the run in seconds is used by the queue policy.
+        """
+        # The process limits are shared by all windows, they are not project settings.
+        _scheduler.configure(load_settings('Preferences.sublime-settings'))
+
+        queue = get_run_queue(self.window)
+        if self.dequeued:
+            queue.start(expected, queue.key(method, kwargs))
+        elif not queue.submit(self, method, kwargs, expected, self.wait):
+            return False
+
+        # Kill any currently running tests
+        self.cancel()
+
+        return True
+
+    def create_spans(self):
+        """
+        Return the RunSpans of a run, or a no-op if timings are not enabled
+        by the 'phpspec-run.show_timings' or 'phpspec-run.timings_file'
+        settings or debug mode.
+        """
+        settings = self.view.settings()
+        show_timings = settings.get('phpspec-run.show_timings')
+        log_file = settings.get('phpspec-run.timings_file')
+        if not (show_timings or log_file or _DEBUG):
+            return _no_run_spans
+
+        if log_file:
+            log_file = filter_path(log_file)
+
+        return RunSpans('run', status=bool(show_timings), log_file=log_file)
+
+    def get_usage_warning_ratio(self):
+        return self.view.settings().get('phpspec-run.usage_warning_ratio', 1.5)
+
+    def get_result_format(self):
+        """Return the result format, 'junit' when only failures are shown, see 'phpspec-run.results_mode'."""
+        if self.is_failures_only():
+            return 'junit'
+
+        return self.view.settings().get('phpspec-run.result_format') or 'text'
 
-        debug_message('env %s', env)
-        debug_message('cmd %s', cmd)
+    def is_failures_only(self):
+        return self.view.settings().get('phpspec-run.results_mode') == 'failures'
 
-        if self.view.settings().get('phpspec-run.save_all_on_run'):
-            # Write out every buffer in active
-            # window that has changes and is
-            # a real file on disk.
-            for view in self.window.views():
-                if view.is_dirty() and view.file_name():
-                    view.run_command('save')
+    def create_output(self, panel):
+        """Return the PanelOutput of a run in the results {panel}, logging the full output."""
+        output = PanelOutput(panel, log_file=run_log_file(self.window.id()),
+                             max_lines=self.view.settings().get('phpspec-run.panel_max_lines', 20000))
+        _outputs[self.window.id()] = output
+
+        return output
+
+    def build_run_options(self, context, options):
+        """Return the phpspec run command line options, including the suffix and configuration file."""
+        run_options = build_cmd_options(options, [])
+        run_options.append('--no-interaction')
 
         if self.view.settings().get('phpspec-run.suffix'):
-            cmd.append(self.view.settings().get('phpspec-run.suffix'))
+            run_options.append(self.view.settings().get('phpspec-run.suffix'))
+
+        if context['configuration_file']:
+            run_options.append('--config=' + os.path.relpath(
+                context['configuration_file'], context['working_dir']))
+
+        return run_options
+
+    def start_runner(self, context, options, files=None, processes=None, fail_fast=False, result_format='text',
+                     panel=None, exclude=None, next_run=None, spans=_no_run_spans, skip_unchanged=True):
+        panel = panel or self.create_results_panel(context['working_dir'])
+        runner = ShardedSuiteRunner(
+            spans=spans,
+            resident=None if context.get('coverage') else self.get_resident_server(context),
+            panel=panel,
+            context=context,
+            options=options,
+            files=files,
+            processes=processes,
+            fail_fast=fail_fast,
+            history=get_timing_history(context['working_dir']),
+            result_format=result_format,
+            failures=get_failure_history(context['working_dir']),
+            exclude=exclude,
+            output=self.create_output(panel),
+            failures_only=self.is_failures_only(),
+            result_cache=self.get_result_cache(context) if skip_unchanged else None
+        )
 
-        phpspec_configuration_file = find_phpspec_configuration_file(self.view.file_name(), self.window.folders())
+        runner.window_id = self.window.id()
+        runner.next_run = next_run
+        runner.usage_warning_ratio = self.get_usage_warning_ratio()
+        _runners[self.window.id()] = runner
 
-        relative_phpspec_configuration_file = file = os.path.relpath(phpspec_configuration_file, working_dir)
+        runner.start()
 
-        cmd.append('--config=' + relative_phpspec_configuration_file)
+        return runner
 
-        debug_message('****** cmd \'%s\'', cmd)
+    def get_result_cache(self, context):
+        """
+        Return the result cache of the project if 'phpspec-run.skip_unchanged'
+        is enabled, otherwise None.
+        """
+        if not self.view.settings().get('phpspec-run.skip_unchanged'):
+            return None
 
-        self.window.run_command('exec', {
-            'env': env,
-            'cmd': cmd,
-            'file_regex': exec_file_regex(),
-            'quiet': not is_debug(self.view),
-            'shell': False,
-            'syntax': 'Packages/{}/res/text-ui-result.sublime-syntax'.format(__name__.split('.')[0]),
-            'word_wrap': False,
-            'working_dir': working_dir
-        })
+        cache = get_result_cache(context['working_dir'])
+        cache.max_entries = self.view.settings().get('phpspec-run.skip_unchanged_cache_size', 10000)
 
-        set_window_setting('phpspec-run._test_last', {
-            'options': options,
-            'file': original_file,
-            'directory': directory,
+        return cache
+
+    def get_coverage(self, context):
+        """
+        Return the coverage collection of a run, a dict of the coverage
+        'driver' and the driver 'cmd' that collects it, or None if coverage
+        cannot be collected.
+
+        The driver is set by 'phpspec-run.coverage_driver', or found from
+        the extensions of the PHP executable.
+        """
+        driver_cmd = context.get('driver_cmd') or self.get_driver_command(context)
+        if not driver_cmd:
+            return None
+
+        context['driver_cmd'] = driver_cmd
+
+        driver = self.view.settings().get('phpspec-run.coverage_driver') or 'auto'
+        if driver == 'auto':
+            driver = find_coverage_driver(driver_cmd[0])
+        if not driver:
+            return None
+
+        return {'driver': driver, 'cmd': coverage_driver_command(driver, driver_cmd, context['working_dir'])}
+
+    def find_coverage_driver_async(self, context, method, kwargs):
+        """
+        Return True if the coverage driver of the run is not known yet. It is
+        then found on a background thread, because that runs PHP, and
+        {method} is called again with {kwargs} once it is found.
+        """
+        if (self.view.settings().get('phpspec-run.coverage_driver') or 'auto') != 'auto':
+            return False
+
+        driver_cmd = context.get('driver_cmd') or self.get_driver_command(context)
+        if not driver_cmd or is_coverage_driver_known(driver_cmd[0]):
+            return False
+
+        status_message('PHPSpec Run: finding the coverage driver...')
+
+        def find():
+            find_coverage_driver(driver_cmd[0])
+            set_timeout(lambda: getattr(self, method)(**kwargs), 0)
+
+        set_timeout_async(find)
+
+        return True
+
+    def collect_coverage(self):
+        """Run the suite collecting the lines executed by each example into the coverage index."""
+        prepared = self.prepare_runner(method='collect_coverage', kwargs={})
+        if not prepared:
+            return
+
+        context, run_options, result_format = prepared
+        if self.find_coverage_driver_async(context, 'collect_coverage', {}):
+            return
+
+        context['coverage'] = self.get_coverage(context)
+        if not context['coverage']:
+            return status_message('PHPSpec Run: coverage needs phpspec installed with Composer '
+                                  'and pcov, xdebug or phpdbg')
+
+        if not self.queue_run('collect_coverage', {}):
+            return
+
+        self.save_all()
+        self.start_runner(context, run_options,
+                          processes=self.view.settings().get('phpspec-run.parallel_processes') or cpu_count(),
+                          result_format=result_format, skip_unchanged=False)
+
+    def get_resident_server(self, context):
+        """
+        Return the resident server of the working directory, or None.
+
+        The resident server is used if enabled and phpspec is installed in
+        the project vendor directory, the same as the driver.
+        """
+        if not self.view.settings().get('phpspec-run.resident') or not ResidentServer.is_supported():
+            return None
+
+        driver_cmd = context.get('driver_cmd') or self.get_driver_command(context)
+        if not driver_cmd:
+            return None
+
+        context['server_cmd'] = [driver_cmd[0], get_resource_file('phpspec-run-server.php'), driver_cmd[2]]
+        context['server_idle_timeout'] = self.view.settings().get('phpspec-run.resident_idle_timeout', 600)
+
+        return get_resident_server(context['working_dir'])
+
+    def prepare_command(self, working_dir=None):
+        """
+        Return the context needed to run phpspec.
+
+        The context is a dict of the 'working_dir', 'configuration_file',
+        'executables', 'env', 'backend' and 'cmd', where 'cmd' is the command
+        that runs phpspec without the run command and its options, to be run
+        by the backend.
+
+        Raises ValueError if the working directory or executables cannot be
+        resolved.
+        """
+        env = {}
+        cmd = []
+
+        with self.spans.span('discovery'):
+            phpspec_configuration_file, configuration_dir = get_configuration_cache(self.window).find(
+                self.view.file_name(), self.window.folders())
+
+        if not working_dir:
+            working_dir = configuration_dir
+            if not working_dir:
+                raise ValueError('working directory not found')
+
+        if not os.path.isdir(working_dir):
+            raise ValueError('working directory does not exist or is not a valid directory')
+
+        debug_message('working dir \'%s\'', working_dir)
+
+        with self.spans.span('executables'):
+            backend = self.get_backend()
+            if backend.is_local:
+                executables = self.resolve_executables(working_dir)
+                if executables['winry']:
+                    backend = WrapperBackend([executables['winry']])
+            else:
+                executables = {'winry': None, 'php': None, 'phpspec': self.get_backend_phpspec(working_dir)}
+
+        debug_message('backend %s', backend.name)
+
+        if not backend.is_local:
+            cmd.append(executables['phpspec'] or 'phpspec')
+        else:
+            php_executable = executables['php']
+            if php_executable:
+                env['PATH'] = os.path.dirname(php_executable) + os.pathsep + os.environ['PATH']
+                debug_message('php executable = %s', php_executable)
+
+            phpspec_executable = executables['phpspec']
+            cmd.append(phpspec_executable)
+            debug_message('executable \'%s\'', phpspec_executable)
+
+        return {
             'working_dir': working_dir,
-            'line_number': line_number
-        }, window=self.window)
+            'configuration_file': phpspec_configuration_file,
+            'executables': executables,
+            'env': env,
+            'backend': backend,
+            'cmd': cmd
+        }
+
+    def get_driver_command(self, context):
+        """
+        Return the command that runs several targets in one PHP process.
+
+        Only a Composer installed phpspec run on the host can be driven,
+        because the driver boots phpspec from the project autoloader.
+        Returns None otherwise.
+        """
+        executables = context['executables']
+        if not context['backend'].is_local or not executables['phpspec']:
+            return None
+
+        vendor_dir = os.path.join(context['working_dir'], 'vendor')
+        if os.path.dirname(executables['phpspec']) != os.path.join(vendor_dir, 'bin'):
+            return None
+
+        autoload_file = os.path.join(vendor_dir, 'autoload.php')
+        if not os.path.isfile(autoload_file):
+            return None
+
+        # The driver requires the coverage listener from its own directory,
+        # both are extracted from the package.
+        get_resource_file('phpspec-run-coverage.php')
+
+        return [executables['php'] or 'php', get_resource_file('phpspec-run-driver.php'), autoload_file]
+
+    def save_all(self):
+        global _saving_all
+
+        if self.view.settings().get('phpspec-run.save_all_on_run'):
+            # Write out every buffer in active
+            # window that has changes and is
+            # a real file on disk.
+            _saving_all = True
+            try:
+                with self.spans.span('save_all'):
+                    for view in self.window.views():
+                        if view.is_dirty() and view.file_name():
+                            view.run_command('save')
+            finally:
+                _saving_all = False
+
+    def create_results_panel(self, working_dir):
+        # The output of a preempted run may still be open, its log is removed.
+        output = _outputs.pop(self.window.id(), None)
+        if output:
+            output.cancel()
+
+        try:
+            os.remove(run_log_file(self.window.id()))
+        except OSError:
+            pass
 
         panel = self.window.create_output_panel('exec')
+        panel_settings = panel.settings()
+        panel_settings.set('result_file_regex', exec_file_regex())
+        panel_settings.set('result_base_dir', working_dir)
+        panel_settings.set('word_wrap', False)
+        panel.assign_syntax(results_syntax())
+
+        self.prepare_results_panel(panel)
+
+        return panel
+
+    def prepare_results_panel(self, panel):
         panel_settings = panel.settings()
         panel_settings.set('rulers', [])
 
@@ -649,14 +5434,230 @@ class PHPSpecRun():
                 self.view.settings().get('phpspec-run.text_ui_result_font_size')
             )
 
-        color_scheme = self.get_auto_generated_color_scheme()
+        with self.spans.span('color_scheme'):
+            color_scheme = self.get_auto_generated_color_scheme()
         panel_settings.set('color_scheme', color_scheme)
         self.window.run_command("show_panel", {"panel": "output.exec"})
 
+    def run_suite(self):
+        if self.view.settings().get('phpspec-run.parallel'):
+            self.run_parallel()
+        elif self.view.settings().get('phpspec-run.failures_first'):
+            self.run_suite_failures_first()
+        else:
+            self.run()
+
+    def prepare_runner(self, options=None, method=None, kwargs=None):
+        """
+        Return a (context, run_options, result_format) tuple for the plugin runner.
+
+        Returns None, after reporting the error, if phpspec cannot be run,
+        or while the coverage driver is being found, in which case {method}
+        is called again with {kwargs} once it is.
+        """
+        result_format = self.get_result_format()
+
+        try:
+            context = self.prepare_command()
+
+            options = self.filter_options(options)
+            if result_format == 'junit':
+                options = dict(options, format='junit')
+            debug_message('options %s', options)
+
+            run_options = self.build_run_options(context, options)
+
+            context['driver_cmd'] = self.get_driver_command(context)
+            if self.view.settings().get('phpspec-run.coverage'):
+                if method and self.find_coverage_driver_async(context, method, kwargs):
+                    return None
+                context['coverage'] = self.get_coverage(context)
+        except ValueError as e:
+            status_message('PHPSpec Run: {}'.format(e))
+            print('PHPSpec Run: {}'.format(e))
+            return None
+
+        debug_message('driver cmd %s', context['driver_cmd'])
+
+        return context, run_options, result_format
+
+    def run_parallel(self, options=None, files=None):
+        """
+        Run the suite, or only {files}, sharded across several processes.
+
+        {files} are spec files relative to the working directory. If not
+        given, the spec files are discovered from the suites spec paths.
+        """
+        debug_message('phpspec run parallel with files=%s, options=%s', files, options)
+
+        kwargs = {'options': dict(options) if options else options, 'files': files}
+
+        prepared = self.prepare_runner(options, 'run_parallel', kwargs)
+        if not prepared:
+            return
+
+        context, run_options, result_format = prepared
+
+        processes = self.view.settings().get('phpspec-run.parallel_processes') or cpu_count()
+        expected = None
+        if files:
+            history = get_timing_history(context['working_dir'])
+            default = history.median_duration()
+            expected = sum(history.expected_duration(file, default) for file in files) / min(processes, len(files))
+
+        if not self.queue_run('run_parallel', kwargs, expected):
+            return
+
+        self.save_all()
+
+        def run_files(panel=None, exclude=None):
+            return self.start_runner(
+                context,
+                run_options,
+                files=files,
+                processes=processes,
+                fail_fast=self.view.settings().get('phpspec-run.parallel_fail_fast'),
+                result_format=result_format,
+                panel=panel,
+                exclude=exclude
+            )
+
+        if files is None and self.view.settings().get('phpspec-run.failures_first'):
+            self.run_failures_first(context, run_options, result_format, run_files)
+        else:
+            run_files()
+
+    def run_suite_failures_first(self):
+        prepared = self.prepare_runner(method='run_suite_failures_first', kwargs={})
+        if not prepared:
+            return
+
+        context, run_options, result_format = prepared
+
+        if not self.queue_run('run_suite_failures_first', {}):
+            return
+
+        self.save_all()
+
+        def run_suite(panel=None, exclude=None):
+            # The rest of the suite is listed without the spec files that
+            # already ran when the driver runs it in one process, otherwise
+            # it is run as a whole.
+            if self.view.settings().get('phpspec-run.skip_unchanged'):
+                return self.start_runner(context, run_options, processes=1, result_format=result_format,
+                                         panel=panel, exclude=exclude)
+
+            if exclude and context['driver_cmd']:
+                return self.start_runner(context, run_options, processes=1, result_format=result_format,
+                                         panel=panel, exclude=exclude)
+
+            return self.start_runner(context, run_options, files=[''], processes=1,
+                                     result_format=result_format, panel=panel)
+
+        self.run_failures_first(context, run_options, result_format, run_suite)
+
+    def run_failures_first(self, context, run_options, result_format, run_rest):
+        """
+        Run the previously failing examples in one process, then {run_rest}.
+
+        Spec files that failed as a whole have already been run by the first
+        batch and are excluded from the rest.
+        """
+        failures = get_failure_history(context['working_dir']).failures
+        if not failures:
+            return run_rest()
+
+        debug_message('failures first %s', failures)
+
+        exclude = set(failure for failure in failures if failure == target_file(failure))
+
+        def next_run():
+            status_message('PHPSpec Run: previous failures done, running the rest')
+            runner.append('\nRunning the rest of the suite\n\n')
+            runner.flush()
+            run_rest(panel=runner.panel, exclude=exclude)
+
+        runner = self.start_runner(context, run_options, files=failures, processes=1,
+                                   result_format=result_format, next_run=next_run)
+
+    def run_failures(self):
+        """Run the previously failing examples of the project in one process."""
+        prepared = self.prepare_runner(method='run_failures', kwargs={})
+        if not prepared:
+            return
+
+        context, run_options, result_format = prepared
+
+        failures = get_failure_history(context['working_dir']).failures
+        if not failures:
+            return status_message('PHPSpec Run: no failures recorded')
+
+        if not self.queue_run('run_failures', {}):
+            return
+
+        self.save_all()
+        self.start_runner(context, run_options, files=failures, processes=1, result_format=result_format)
+
+    def run_targets(self, targets, options=None):
+        """
+        Run {targets}, spec files and 'file:line' examples, as one run.
+
+        Targets are absolute or relative to the working directory. With the
+        driver all the targets are run by one phpspec process, otherwise each
+        target is run by its own process, one after the other. The results
+        are reported together with one summary.
+        """
+        debug_message('phpspec run targets %s with options=%s', targets, options)
+
+        kwargs = {'targets': list(targets), 'options': dict(options) if options else options}
+
+        self.spans = self.create_spans()
+
+        prepared = self.prepare_runner(options, 'run_targets', kwargs)
+        if not prepared:
+            return
+
+        context, run_options, result_format = prepared
+        working_dir = context['working_dir']
+
+        batch = []
+        for target in targets:
+            file = target_file(target)
+            path = os.path.join(working_dir, file)
+            if not os.path.isfile(path):
+                return status_message('PHPSpec Run: test file \'{}\' not found'.format(file))
+
+            batch.append(os.path.relpath(path, working_dir) + target[len(file):])
+
+        batch = batch_targets(batch)
+        if not batch:
+            return status_message('PHPSpec Run: nothing to run')
+
+        history = get_timing_history(working_dir)
+        default = history.median_duration()
+        expected = sum(history.expected_duration(target, default) for target in batch)
+
+        if not self.queue_run('run_targets', kwargs, expected):
+            return
+
+        self.spans.name = '{} targets'.format(len(batch))
+
+        self.save_all()
+
+        set_window_setting('phpspec-run._test_last', {
+            'targets': [os.path.join(working_dir, target) for target in batch],
+            'options': options
+        }, window=self.window)
+
+        self.start_runner(context, run_options, files=batch, processes=1, result_format=result_format,
+                          spans=self.spans)
+
     def run_previous(self):
         kwargs = get_window_setting('phpspec-run._test_last', window=self.window)
         debug_message('run last %s', kwargs)
-        if kwargs:
+        if kwargs and 'targets' in kwargs:
+            self.run_targets(**kwargs)
+        elif kwargs:
             self.run(**kwargs)
         else:
             return status_message('PHPSpec Run: no tests were run so far')
@@ -688,6 +5689,10 @@ class PHPSpecRun():
         debug_message('run here')
         if has_test_spec(self.view):
             file = self.view.file_name()
+            examples = find_selected_examples(self.view)
+            if len(examples) > 1:
+                return self.run_targets(['{}:{}'.format(file, example['line']) for example in examples])
+
             options = {}
             line_number = find_line_number(self.view)
             if line_number:
@@ -698,11 +5703,204 @@ class PHPSpecRun():
         else:
             find_switchable(self.view, on_select=lambda switchable: self.run(file=switchable.file))
 
+    def run_affected(self, base_ref=None):
+        """
+        Run the specs affected by the files modified since the last run.
+
+        If {base_ref}, or the 'phpspec-run.affected_base_ref' setting, is set
+        the files changed since that git ref are used instead.
+        """
+        configuration_file, working_dir = get_configuration_cache(self.window).find(
+            self.view.file_name(), self.window.folders())
+        if not working_dir:
+            return status_message('PHPSpec Run: working directory not found')
+
+        if base_ref is None:
+            base_ref = self.view.settings().get('phpspec-run.affected_base_ref')
+
+        index = get_project_index(working_dir, configuration_file, build=False)
+
+        status_message('PHPSpec Run: finding affected specs...')
+        set_timeout_async(lambda: self._find_affected_specs(index, base_ref))
+
+    def _find_affected_specs(self, index, base_ref):
+        working_dir = index.working_dir
+        graph = get_dependency_graph(index)
+        started_at = int(time.time() * 1e9)
+        graph.refresh()
+
+        if base_ref:
+            try:
+                changed = git_changed_files(working_dir, base_ref)
+            except (OSError, subprocess.CalledProcessError) as e:
+                return status_message('PHPSpec Run: git diff against \'{}\' failed: {}'.format(base_ref, e))
+        elif graph.last_run is None:
+            changed = None
+        else:
+            changed = graph.modified_since(graph.last_run)
+
+        specs = None
+        if changed is None:
+            # Without a previous run the changes are not known, the specs
+            # affected by the active file are run, or else the suite.
+            file = self.view.file_name()
+            relative = os.path.relpath(file, working_dir) if file else None
+            if relative not in graph.files:
+                status_message('PHPSpec Run: no previous affected run, running the suite')
+            else:
+                status_message('PHPSpec Run: no previous affected run, running the specs affected by this file')
+                changed = [relative]
+
+        if changed is not None:
+            specs = graph.affected_specs(changed)
+            debug_message('%d changed files affect %d specs %s', len(changed), len(specs), specs)
+
+        set_timeout(lambda: self.run_affected_specs(working_dir, specs, started_at), 0)
+
+    def run_affected_specs(self, working_dir, specs, started_at):
+        """
+        Run the affected {specs}, or the suite if None, and record {started_at}
+        as the time of the last affected run once the run started, so that
+        the changes of a run that is cancelled while queued are not lost.
+        """
+        graph = _dependency_graphs.get(working_dir)
+
+        if specs is not None and not specs:
+            status_message('PHPSpec Run: no affected specs')
+        else:
+            kwargs = {'working_dir': working_dir, 'specs': specs, 'started_at': started_at}
+            if not self.queue_run('run_affected_specs', kwargs):
+                return
+
+            # The run below is the one that was just allowed to start.
+            self.dequeued = True
+            if specs is None:
+                self.run_suite()
+            elif len(specs) == 1:
+                self.run(file=os.path.join(working_dir, specs[0]))
+            else:
+                self.run_parallel(files=specs)
+
+            if not is_running(self.window):
+                return
+
+        if graph:
+            graph.last_run = max(graph.last_run or 0, started_at)
+            set_timeout_async(graph.save, 0)
+
+    def show_slowest_specs(self):
+        configuration_file, working_dir = get_configuration_cache(self.window).find(
+            self.view.file_name(), self.window.folders())
+        if not working_dir:
+            return status_message('PHPSpec Run: working directory not found')
+
+        slowest = get_timing_history(working_dir).slowest()
+        if not slowest:
+            return status_message('PHPSpec Run: no spec timings recorded so far')
+
+        def on_select(index):
+            if index == -1:
+                return
+
+            self.window.open_file(os.path.join(working_dir, slowest[index][0]))
+
+        self.window.show_quick_panel(
+            [[file, '{:.3f}s {}'.format(duration, trend)] for file, duration, trend in slowest],
+            on_select
+        )
+
+    def run_any_example(self):
+        """
+        Show the examples of the whole project in a quick panel and run the
+        selected one. The panel is shown from the example index as it is,
+        and the index is refreshed in the background for the next time.
+        """
+        cache = get_configuration_cache(self.window)
+        configuration_file, working_dir = cache.find(self.view.file_name(), self.window.folders())
+        if not working_dir:
+            # The active view has no file or a file outside of the project,
+            # the first folder with a configuration file is used.
+            for folder in self.window.folders():
+                configuration_file, working_dir = cache.find(os.path.join(folder, _CONFIGURATION_FILE_NAMES[0]),
+                                                             [folder])
+                if working_dir:
+                    break
+            else:
+                return status_message('PHPSpec Run: working directory not found')
+
+        index = get_example_index(working_dir, configuration_file)
+        if index.files:
+            self.show_examples(working_dir, index.examples())
+            index.refresh_async()
+        else:
+            status_message('PHPSpec Run: indexing the examples...')
+            index.refresh_async(lambda: self.show_examples(working_dir, index.examples()))
+
+    def show_examples(self, working_dir, examples):
+        if not examples:
+            return status_message('PHPSpec Run: no examples found')
+
+        def on_select(index):
+            if index == -1:
+                return
+
+            file, class_name, name, line = examples[index]
+            self.run(file=os.path.join(working_dir, file), line_number=line)
+
+        self.window.show_quick_panel(
+            [[class_name + ': ' + name.replace('_', ' '), '{}:{}'.format(file, line)]
+             for file, class_name, name, line in examples],
+            on_select
+        )
+
+    def show_jobs(self):
+        """List the running and queued phpspec processes and queued runs of all windows."""
+        def window_name(window_id):
+            window = find_window(window_id)
+            if window and window.folders():
+                return os.path.basename(window.folders()[0])
+
+            return 'window {}'.format(window_id)
+
+        now = time.time()
+        running, queued = _scheduler.jobs()
+
+        items = []
+        for job in running:
+            items.append([job.description, 'running {:.1f}s{} - {}'.format(
+                now - job.started_at if job.started_at else 0,
+                ' (background)' if job.background else '',
+                window_name(job.window_id))])
+        for job in queued:
+            items.append([job.description, 'waiting for a process - {}'.format(window_name(job.window_id))])
+        for window_id, queue in _run_queues.items():
+            for request in queue.pending:
+                items.append([request['method'] + ' ' + request['key'][1], 'queued - {}'.format(
+                    window_name(window_id))])
+
+        if not items:
+            return status_message('PHPSpec Run: no jobs')
+
+        self.window.show_quick_panel(items, lambda index: None)
+
     def show_results(self):
         self.window.run_command('show_panel', {'panel': 'output.exec'})
 
+    def open_full_log(self):
+        log_file = run_log_file(self.window.id())
+        if not os.path.isfile(log_file):
+            return status_message('PHPSpec Run: no log of the last run')
+
+        self.window.open_file(log_file)
+
     def cancel(self):
-        self.window.run_command('exec', {'kill': True})
+        proc = _processes.pop(self.window.id(), None)
+        if proc:
+            proc.cancel()
+
+        runner = _runners.pop(self.window.id(), None)
+        if runner:
+            runner.cancel()
 
     def toggle_option(self, option):
         options = get_window_setting('phpspec-run.options', default={}, window=self.window)
@@ -727,21 +5925,66 @@ class PHPSpecRun():
 
         return options
 
-    def get_php_executable(self, working_dir):
-        versions_path = self.view.settings().get('phpspec-run.php_versions_path')
-        executable = self.view.settings().get('phpspec-run.php_executable')
+    def resolve_executables(self, working_dir):
+        settings = self.view.settings()
+
+        return _executable_resolver.resolve(
+            working_dir,
+            composer=settings.get('phpspec-run.composer'),
+            winry=settings.get('phpspec-run.winry'),
+            php_versions_path=settings.get('phpspec-run.php_versions_path'),
+            php_executable=settings.get('phpspec-run.php_executable')
+        )
+
+    def get_backend(self):
+        """
+        Return the backend that runs phpspec, see 'phpspec-run.backend'.
+
+        Raises ValueError if the backend is not valid.
+        """
+        settings = self.view.settings()
+        name = settings.get('phpspec-run.backend') or 'local'
+        if name == 'local':
+            return _local_backend
 
-        return _get_php_executable(working_dir, versions_path, executable)
+        if name not in ('wrapper', 'session'):
+            raise ValueError('unknown backend \'%s\'' % name)
 
-    def get_phpspec_executable(self, working_dir):
-        composer = self.view.settings().get('phpspec-run.composer')
+        command = settings.get('phpspec-run.backend_command')
+        if not command:
+            raise ValueError('\'phpspec-run.backend_command\' is not set')
 
-        return _get_phpspec_executable(working_dir, composer)
+        mappings = settings.get('phpspec-run.path_mappings') or {}
+        if name == 'wrapper':
+            return WrapperBackend(command, mappings)
 
-    def get_winry_executable(self, working_dir):
-        winry = self.view.settings().get('phpspec-run.winry')
+        return get_session_backend(command, mappings)
 
-        return _get_winry_executable(working_dir, winry)
+    def get_backend_phpspec(self, working_dir):
+        """Return the phpspec executable, relative to the working directory, of a backend other than local."""
+        if self.view.settings().get('phpspec-run.composer') and \
+                os.path.isfile(os.path.join(working_dir, 'vendor', 'bin', 'phpspec')):
+            return 'vendor/bin/phpspec'
+
+        return 'phpspec'
+
+    def show_executables(self):
+        configuration_file, working_dir = get_configuration_cache(self.window).find(
+            self.view.file_name(), self.window.folders())
+        if not working_dir:
+            return status_message('PHPSpec Run: working directory not found')
+
+        try:
+            executables = self.resolve_executables(working_dir)
+        except ValueError as e:
+            executables = {'error': str(e)}
+
+        print('PHPSpec Run: executables for \'{}\' (hits={}, misses={})'.format(
+            working_dir, _executable_resolver.hits, _executable_resolver.misses))
+        for name in sorted(executables):
+            print('PHPSpec Run:   {} = {}'.format(name, executables[name]))
+
+        self.window.run_command('show_panel', {'panel': 'console'})
 
     def get_auto_generated_color_scheme(self):
         color_scheme = self.view.settings().get('color_scheme')
@@ -750,46 +5993,44 @@ class PHPSpecRun():
         if color_scheme.endswith('.sublime-color-scheme'):
             return color_scheme
 
+        if color_scheme in _color_scheme_cache:
+            debug_message('color scheme cache hit \'%s\'', _color_scheme_cache[color_scheme])
+            return _color_scheme_cache[color_scheme]
+
         try:
             # Try to patch color scheme with default test result colors
 
             color_scheme_resource = load_resource(color_scheme)
             if 'phpspecrun' in color_scheme_resource or 'phpspec-run' in color_scheme_resource:
                 debug_message('color scheme has plugin support')
+                _color_scheme_cache[color_scheme] = color_scheme
                 return color_scheme
 
             if 'region.greenish' in color_scheme_resource:
                 debug_message('color scheme has region colorish support')
+                _color_scheme_cache[color_scheme] = color_scheme
                 return color_scheme
 
-            cs_head, cs_tail = os.path.split(color_scheme)
-            cs_package = os.path.split(cs_head)[1]
-            cs_name = os.path.splitext(cs_tail)[0]
-
-            file_name = cs_package + '__' + cs_name + '.hidden-tmTheme'
-            abs_file = os.path.join(cache_path(), __name__.split('.')[0], 'color-schemes', file_name)
-            rel_file = 'Cache/{}/color-schemes/{}'.format(__name__.split('.')[0], file_name)
-
-            debug_message('auto generated color scheme = %s', rel_file)
-
-            if not os.path.exists(os.path.dirname(abs_file)):
-                os.makedirs(os.path.dirname(abs_file))
-
             color_scheme_resource_partial = load_resource(
                 'Packages/{}/res/text-ui-result-theme-partial.txt'.format(__name__.split('.')[0]))
 
-            with open(abs_file, 'w', encoding='utf8') as f:
-                f.write(re.sub(
-                    '</array>\\s*'
-                    '((<!--\\s*)?<key>.*</key>\\s*<string>[^<]*</string>\\s*(-->\\s*)?)*'
-                    '</dict>\\s*</plist>\\s*'
-                    '$',
+            digest = hashlib.sha1(
+                (color_scheme_resource + color_scheme_resource_partial).encode('utf8')).hexdigest()
 
-                    color_scheme_resource_partial + '\\n</array></dict></plist>',
-                    color_scheme_resource
-                ))
+            generated_color_scheme = None
+            if int(version()) >= 3149 and self.view.settings().get('phpspec-run.color_scheme_override'):
+                generated_color_scheme = write_color_scheme_override(
+                    color_scheme, color_scheme_resource_partial, digest)
+            else:
+                remove_color_scheme_override(color_scheme)
+
+            if not generated_color_scheme:
+                generated_color_scheme = write_patched_color_scheme(
+                    color_scheme, color_scheme_resource, color_scheme_resource_partial, digest)
 
-            return rel_file
+            _color_scheme_cache[color_scheme] = generated_color_scheme
+
+            return generated_color_scheme
         except Exception as e:
             print('PHPSpec Run: an error occurred trying to patch color'
                   ' scheme with PHPSpec test results colors: {}'.format(str(e)))
@@ -800,7 +6041,13 @@ class PHPSpecRun():
 class PhpspecRunSuiteCommand(sublime_plugin.WindowCommand):
 
     def run(self):
-        PHPSpecRun(self.window).run()
+        PHPSpecRun(self.window).run_suite()
+
+
+class PhpspecRunSuiteParallelCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        PHPSpecRun(self.window).run_parallel()
 
 
 class PhpspecRunDirectoryCommand(sublime_plugin.WindowCommand):
@@ -815,6 +6062,12 @@ class PhpspecRunSpecCommand(sublime_plugin.WindowCommand):
         PHPSpecRun(self.window).run_spec()
 
 
+class PhpspecRunTargetsCommand(sublime_plugin.WindowCommand):
+
+    def run(self, targets, options=None):
+        PHPSpecRun(self.window).run_targets(targets, options)
+
+
 class PhpspecRunPreviousCommand(sublime_plugin.WindowCommand):
 
     def run(self):
@@ -827,18 +6080,152 @@ class PhpspecRunHereCommand(sublime_plugin.WindowCommand):
         PHPSpecRun(self.window).run_here()
 
 
+class PhpspecRunFailuresCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        PHPSpecRun(self.window).run_failures()
+
+
+class PhpspecRunAffectedCommand(sublime_plugin.WindowCommand):
+
+    def run(self, base_ref=None):
+        PHPSpecRun(self.window).run_affected(base_ref)
+
+
+class PhpspecRunSlowestSpecsCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        PHPSpecRun(self.window).show_slowest_specs()
+
+
+class PhpspecRunAnyExampleCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        PHPSpecRun(self.window).run_any_example()
+
+
 class PhpspecRunResultsCommand(sublime_plugin.WindowCommand):
 
     def run(self):
         PHPSpecRun(self.window).show_results()
 
 
+class PhpspecRunCollectCoverageCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        PHPSpecRun(self.window).collect_coverage()
+
+
+class PhpspecRunOpenFullLogCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        PHPSpecRun(self.window).open_full_log()
+
+
 class PhpspecRunCancelCommand(sublime_plugin.WindowCommand):
 
     def run(self):
+        get_run_queue(self.window).clear()
         PHPSpecRun(self.window).cancel()
 
+        watcher = _run_on_save.get(self.window.id())
+        if watcher:
+            watcher.cancel()
+        status_message('PHPSpec Run: cancelled')
+
+class PhpspecRunShowJobsCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        PHPSpecRun(self.window).show_jobs()
+
+
+class PhpspecRunShowExecutablesCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        PHPSpecRun(self.window).show_executables()
+
 class PhpspecRunToggleOptionCommand(sublime_plugin.WindowCommand):
 
     def run(self, option):
         PHPSpecRun(self.window).toggle_option(option)
+
+
+class PhpspecRunEventListener(sublime_plugin.EventListener):
+
+    def __init__(self):
+        self.view_files = {}
+        self.saved_contents = {}
+
+    def on_load(self, view):
+        self.view_files[view.id()] = view.file_name()
+
+        result = _last_results.get(view.window().id()) if view.window() else None
+        if result:
+            mark_view_failures(view, [f.line for f in result.failures() if f.file == view.file_name() and f.line])
+
+        file = view.file_name()
+        if file and file.endswith('.php') and view.window() and view.settings().get('phpspec-run.coverage_marks'):
+            index = find_coverage_index(view.window(), file)
+            if index:
+                mark_view_coverage(view, index)
+
+    def on_pre_save(self, view):
+        # The contents before the save give the lines changed by it, to find
+        # the examples that executed them.
+        file = view.file_name()
+        if file and file.endswith('.php') and view.window() and not has_test_spec(view):
+            index = find_coverage_index(view.window(), file)
+            relative = os.path.relpath(file, index.working_dir) if index else None
+            if index and index.covers(relative):
+                self.saved_contents[view.id()] = (index, read_file(file), index.is_fresh(relative))
+
+    def on_close(self, view):
+        self.view_files.pop(view.id(), None)
+        discard_view_structure(view)
+
+    def on_post_save(self, view):
+        file = view.file_name()
+        if file and file.endswith('.tmTheme'):
+            clear_color_scheme_cache()
+
+        examples = None
+        saved = self.saved_contents.pop(view.id(), None)
+        if saved and file:
+            index, old_contents, fresh = saved
+            examples = index.on_file_saved(file, old_contents, fresh)
+            if examples is not None:
+                examples = [os.path.join(index.working_dir, example) for example in examples]
+            if view.settings().get('phpspec-run.coverage_marks'):
+                mark_view_coverage(view, index)
+
+        if file and file.endswith('.php') and view.settings().get('phpspec-run.run_on_save') and not _saving_all:
+            run_on_save(view, examples)
+
+        if file and file.endswith('.php') and view.window():
+            index = find_project_index(view.window(), file)
+            if index:
+                previous_file = self.view_files.get(view.id())
+                if previous_file and previous_file != file:
+                    index.rename_file(previous_file, file)
+                else:
+                    index.add_file(file)
+
+                graph = _dependency_graphs.get(index.working_dir)
+                if graph and graph.index is index:
+                    if previous_file and previous_file != file:
+                        graph.remove_file(previous_file)
+                    set_timeout_async(lambda: graph.update_file(file) and graph.schedule_save())
+
+        self.view_files[view.id()] = file
+
+    def on_post_window_command(self, window, command_name, args):
+        if command_name == 'delete_file' and args:
+            for file in args.get('files') or []:
+                index = find_project_index(window, file)
+                if index:
+                    index.remove_file(file)
+
+                    graph = _dependency_graphs.get(index.working_dir)
+                    if graph and graph.index is index:
+                        graph.remove_file(file)
+                        graph.schedule_save()
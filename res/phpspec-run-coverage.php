@@ -0,0 +1,105 @@
+<?php
+
+/*
+ * Collects the lines executed by each PHPSpec example.
+ *
+ * Loaded by the driver when the PHPSPEC_RUN_COVERAGE environment variable
+ * names the coverage driver, "pcov", "xdebug" or "phpdbg", and
+ * PHPSPEC_RUN_COVERAGE_FILE the file to append the coverage to. After each
+ * example a JSON line is appended to the file:
+ *
+ *     {"example": "<spec file>:<example line>", "files": {"<file>": [<line>, ...]}}
+ *
+ * Paths are relative to the working directory. Only the files under the
+ * working directory, outside of its vendor directory, are recorded.
+ */
+
+class PhpSpecRunCoverageListener implements Symfony\Component\EventDispatcher\EventSubscriberInterface
+{
+    private $driver;
+    private $output;
+    private $root;
+
+    public function __construct($driver, $file, $root)
+    {
+        $this->driver = $driver;
+        $this->output = fopen($file, 'a');
+        $this->root = rtrim($root, '/') . '/';
+    }
+
+    public static function getSubscribedEvents()
+    {
+        // Start after, and stop before, the other example listeners.
+        return array(
+            'beforeExample' => array('beforeExample', -1000),
+            'afterExample' => array('afterExample', 1000),
+        );
+    }
+
+    public function register(PhpSpec\Console\Application $application)
+    {
+        $listener = $this;
+        $application->getContainer()->define('phpspec_run.coverage_listener', function () use ($listener) {
+            return $listener;
+        }, array('event_dispatcher.listeners'));
+    }
+
+    public function beforeExample($event)
+    {
+        switch ($this->driver) {
+            case 'pcov':
+                \pcov\clear();
+                \pcov\start();
+                break;
+            case 'xdebug':
+                xdebug_start_code_coverage();
+                break;
+            case 'phpdbg':
+                phpdbg_start_oplog();
+                break;
+        }
+    }
+
+    public function afterExample($event)
+    {
+        switch ($this->driver) {
+            case 'pcov':
+                \pcov\stop();
+                $coverage = \pcov\collect(\pcov\inclusive);
+                break;
+            case 'xdebug':
+                $coverage = xdebug_get_code_coverage();
+                xdebug_stop_code_coverage(true);
+                break;
+            case 'phpdbg':
+                $coverage = phpdbg_end_oplog();
+                break;
+            default:
+                return;
+        }
+
+        $files = array();
+        foreach ($coverage as $file => $lines) {
+            if (strpos($file, $this->root) !== 0 || strpos($file, $this->root . 'vendor/') === 0) {
+                continue;
+            }
+
+            $executed = array();
+            foreach ($lines as $line => $hits) {
+                if ($hits > 0) {
+                    $executed[] = $line;
+                }
+            }
+
+            if ($executed) {
+                $files[substr($file, strlen($this->root))] = $executed;
+            }
+        }
+
+        $function = $event->getExample()->getFunctionReflection();
+        fwrite($this->output, json_encode(array(
+            'example' => substr($function->getFileName(), strlen($this->root)) . ':' . $function->getStartLine(),
+            'files' => (object) $files,
+        )) . "\n");
+    }
+}
@@ -0,0 +1,64 @@
+<?php
+
+/*
+ * Runs several PHPSpec targets in a single PHP process.
+ *
+ * Usage: php phpspec-run-driver.php <autoload> [<phpspec run options>...]
+ *
+ * The targets, one spec file or spec file:line per line, are read from STDIN.
+ * Each target is run in turn with a new PHPSpec application, so the PHP
+ * interpreter and the Composer autoloader are only booted once. After each
+ * target a line is written to STDOUT in the format:
+ *
+ *     ##phpspec-run:target <exit code> <duration in seconds> <target>
+ *
+ * The exit code of the driver is the highest exit code of all the targets.
+ *
+ * If the PHPSPEC_RUN_COVERAGE_FILE environment variable is set the lines
+ * executed by each example are collected, see phpspec-run-coverage.php.
+ */
+
+if ($argc < 2) {
+    fwrite(STDERR, "usage: php phpspec-run-driver.php <autoload> [<phpspec run options>...]\n");
+    exit(2);
+}
+
+require $argv[1];
+
+$options = array_slice($argv, 2);
+$targets = array_values(array_filter(array_map('trim', explode("\n", stream_get_contents(STDIN))), 'strlen'));
+
+$version = 'dev';
+if (class_exists('Composer\InstalledVersions') && Composer\InstalledVersions::isInstalled('phpspec/phpspec')) {
+    $version = Composer\InstalledVersions::getPrettyVersion('phpspec/phpspec');
+}
+
+$coverage = null;
+if (getenv('PHPSPEC_RUN_COVERAGE_FILE')) {
+    require __DIR__ . '/phpspec-run-coverage.php';
+    $coverage = new PhpSpecRunCoverageListener(
+        getenv('PHPSPEC_RUN_COVERAGE'),
+        getenv('PHPSPEC_RUN_COVERAGE_FILE'),
+        getcwd()
+    );
+}
+
+$exitCode = 0;
+foreach ($targets as $target) {
+    $start = microtime(true);
+
+    $application = new PhpSpec\Console\Application($version);
+    $application->setAutoExit(false);
+    if ($coverage) {
+        $coverage->register($application);
+    }
+    $code = $application->run(new Symfony\Component\Console\Input\ArgvInput(
+        array_merge(array('phpspec', 'run', $target), $options)
+    ));
+
+    fwrite(STDOUT, sprintf("\n##phpspec-run:target %d %.6f %s\n", $code, microtime(true) - $start, $target));
+
+    $exitCode = max($exitCode, $code);
+}
+
+exit($exitCode);
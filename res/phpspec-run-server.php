@@ -0,0 +1,196 @@
+<?php
+
+/*
+ * A resident PHPSpec runner for one working directory.
+ *
+ * Usage: php phpspec-run-server.php <autoload> <socket> <idle timeout>
+ *
+ * The PHP interpreter, the Composer autoloader and the PHPSpec console are
+ * booted once, then the server listens on the Unix domain socket, which must
+ * not exist yet and is only accessible by the current user. Each connection
+ * sends one JSON request line with the token given in the
+ * PHPSPEC_RUN_SERVER_TOKEN environment variable:
+ *
+ *     {"command": "ping", "token": <token>}
+ *     {"command": "run", "token": <token>, "options": [<phpspec run options>...], "targets": [<target>...]}
+ *
+ * Requests without the token are ignored. A ping is answered with "pong". A run is handled by a forked child process,
+ * so every run starts from the same warm state and nothing leaks from one
+ * run into the next. The child writes to the connection its pid, the output
+ * of each target followed by the same target line as the driver, its
+ * resource usage and finally its exit code:
+ *
+ *     ##phpspec-run:pid <pid>
+ *     ##phpspec-run:target <exit code> <duration in seconds> <target>
+ *     ##phpspec-run:usage <user cpu seconds> <system cpu seconds> <peak rss bytes>
+ *     ##phpspec-run:exit <exit code>
+ *
+ * An empty target runs the whole suite. The server writes a ready line to
+ * STDOUT once it is listening, and exits after being idle for the idle
+ * timeout in seconds.
+ */
+
+if ($argc < 4) {
+    fwrite(STDERR, "usage: php phpspec-run-server.php <autoload> <socket> <idle timeout>\n");
+    exit(2);
+}
+
+if (!function_exists('pcntl_fork')) {
+    fwrite(STDERR, "the pcntl extension is required\n");
+    exit(3);
+}
+
+$token = (string) getenv('PHPSPEC_RUN_SERVER_TOKEN');
+if (strlen($token) < 32) {
+    fwrite(STDERR, "the PHPSPEC_RUN_SERVER_TOKEN environment variable is required\n");
+    exit(2);
+}
+
+// The specs run by the children must not see the token.
+putenv('PHPSPEC_RUN_SERVER_TOKEN');
+unset($_ENV['PHPSPEC_RUN_SERVER_TOKEN'], $_SERVER['PHPSPEC_RUN_SERVER_TOKEN']);
+
+require $argv[1];
+
+$socketFile = $argv[2];
+$idleTimeout = (int) $argv[3];
+
+// Load the console classes up front, every forked child inherits them.
+class_exists('PhpSpec\Console\Application');
+class_exists('Symfony\Component\Console\Input\ArgvInput');
+class_exists('Symfony\Component\Console\Output\StreamOutput');
+
+$version = 'dev';
+if (class_exists('Composer\InstalledVersions') && Composer\InstalledVersions::isInstalled('phpspec/phpspec')) {
+    $version = Composer\InstalledVersions::getPrettyVersion('phpspec/phpspec');
+}
+
+// Never listen on, or remove, a socket someone else created.
+if (file_exists($socketFile)) {
+    fwrite(STDERR, sprintf("%s already exists\n", $socketFile));
+    exit(1);
+}
+
+$umask = umask(0077);
+$server = @stream_socket_server('unix://' . $socketFile, $errno, $errstr);
+umask($umask);
+if (!$server) {
+    fwrite(STDERR, sprintf("cannot listen on %s: %s\n", $socketFile, $errstr));
+    exit(1);
+}
+
+fwrite(STDOUT, sprintf("##phpspec-run:ready %d\n", getmypid()));
+
+$children = array();
+$lastActive = time();
+
+while (true) {
+    while (($pid = pcntl_waitpid(-1, $status, WNOHANG)) > 0) {
+        unset($children[$pid]);
+        $lastActive = time();
+    }
+
+    if (!$children && $idleTimeout > 0 && time() - $lastActive >= $idleTimeout) {
+        break;
+    }
+
+    $read = array($server);
+    $write = null;
+    $except = null;
+    if (@stream_select($read, $write, $except, 1) < 1) {
+        continue;
+    }
+
+    $connection = @stream_socket_accept($server, 0);
+    if (!$connection) {
+        continue;
+    }
+
+    $lastActive = time();
+
+    $request = json_decode(trim((string) fgets($connection)), true);
+    if (!is_array($request) || !isset($request['command'], $request['token'])
+        || !hash_equals($token, (string) $request['token'])) {
+        fclose($connection);
+        continue;
+    }
+
+    if ($request['command'] === 'ping') {
+        fwrite($connection, "pong\n");
+        fclose($connection);
+        continue;
+    }
+
+    if ($request['command'] !== 'run') {
+        fclose($connection);
+        continue;
+    }
+
+    $pid = pcntl_fork();
+    if ($pid === -1) {
+        fwrite($connection, "cannot fork a runner\n##phpspec-run:exit 255\n");
+        fclose($connection);
+        continue;
+    }
+
+    if ($pid === 0) {
+        fclose($server);
+        $token = null;
+        exit(runTargets($connection, $request, $version));
+    }
+
+    $children[$pid] = true;
+    fclose($connection);
+}
+
+fclose($server);
+unlink($socketFile);
+
+exit(0);
+
+function runTargets($connection, array $request, $version)
+{
+    $options = isset($request['options']) ? $request['options'] : array();
+    $targets = isset($request['targets']) ? $request['targets'] : array('');
+
+    fwrite($connection, sprintf("##phpspec-run:pid %d\n", getmypid()));
+
+    // Anything the specs echo goes to the connection too.
+    ob_start(function ($buffer) use ($connection) {
+        fwrite($connection, $buffer);
+
+        return '';
+    }, 1);
+
+    $output = new Symfony\Component\Console\Output\StreamOutput($connection);
+
+    $exitCode = 0;
+    foreach ($targets as $target) {
+        $start = microtime(true);
+
+        $application = new PhpSpec\Console\Application($version);
+        $application->setAutoExit(false);
+        $code = $application->run(new Symfony\Component\Console\Input\ArgvInput(
+            array_merge(array('phpspec', 'run'), strlen($target) ? array($target) : array(), $options)
+        ), $output);
+
+        fwrite($connection, sprintf("\n##phpspec-run:target %d %.6f %s\n", $code, microtime(true) - $start, $target));
+
+        $exitCode = max($exitCode, $code);
+    }
+
+    ob_end_flush();
+
+    // ru_maxrss is in kilobytes, except on macOS where it is in bytes.
+    $usage = getrusage();
+    fwrite($connection, sprintf(
+        "\n##phpspec-run:usage %.6f %.6f %d\n",
+        $usage['ru_utime.tv_sec'] + $usage['ru_utime.tv_usec'] / 1e6,
+        $usage['ru_stime.tv_sec'] + $usage['ru_stime.tv_usec'] / 1e6,
+        $usage['ru_maxrss'] * (PHP_OS === 'Darwin' ? 1 : 1024)
+    ));
+    fwrite($connection, sprintf("\n##phpspec-run:exit %d\n", $exitCode));
+    fclose($connection);
+
+    return $exitCode;
+}